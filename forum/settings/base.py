@@ -23,6 +23,13 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # Первыми — чтобы в замер попало время всех остальных слоёв.
+    'main.tracing.TracingMiddleware',
+    'main.metrics.MetricsMiddleware',
+    'main.query_budgets.QueryBudgetMiddleware',
+    'main.slow_queries.SlowQueryMiddleware',
+    # До всех слоёв, читающих базу (сессия, пользователь).
+    'main.db_routing.ReplicaRoutingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -30,6 +37,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    # Последним: интервал «view» трассы (main/tracing.py).
+    'main.tracing.ViewTracingMiddleware',
 ]
 
 ROOT_URLCONF = 'forum.urls'
@@ -73,10 +82,126 @@ STATIC_URL = 'static/'
 # Media files (user uploads)
 MEDIA_URL = '/media/'
 # MEDIA_ROOT
+# Кто отдаёт байты файлов после проверки прав (main/media.py):
+# None — сам Django (только для разработки), 'nginx' — X-Accel-Redirect
+# на внутренний location MEDIA_ACCEL_PREFIX, 'sendfile' — X-Sendfile.
+MEDIA_SENDFILE_BACKEND = None
+MEDIA_ACCEL_PREFIX = '/protected-media/'
+# Префиксы (от MEDIA_URL) закрытых файлов: с прокси только они идут через
+# Django, остальные файлы прокси отдаёт сам.
+MEDIA_PRIVATE_PREFIXES = []
 
 # Default primary key field type
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 # Authentication redirects
 LOGIN_REDIRECT_URL = '/'
-LOGOUT_REDIRECT_URL = '/'
\ No newline at end of file
+LOGOUT_REDIRECT_URL = '/'
+
+# Cache
+# Локальный кэш процесса; в production переопределяется общим для всех воркеров.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'forum',
+    }
+}
+
+# Время жизни фрагментов главной страницы (секунды).
+# Фрагменты также сбрасываются сигналами при изменении данных (main/caching.py).
+HOME_CACHE_TIMEOUT = 300
+
+# Глобальная статистика форума (main/stats.py)
+# 'counters' — шардированные счётчики; 'estimate' — для таблиц крупнее
+# FORUM_STATS_ESTIMATE_THRESHOLD строк берётся оценка pg_class.reltuples.
+FORUM_STATS_MODE = 'counters'
+FORUM_STATS_SHARDS = 8
+FORUM_STATS_ESTIMATE_THRESHOLD = 1_000_000
+
+# Отметки о прочтении тем (main/read_markers.py): буфер сбрасывается в БД
+# при накоплении READ_MARKERS_BATCH_SIZE отметок или раз в N секунд.
+READ_MARKERS_BATCH_SIZE = 200
+READ_MARKERS_FLUSH_INTERVAL = 10
+
+# Уменьшенные копии изображений к сообщениям и аватаров (main/images.py)
+POST_IMAGE_VARIANT_WIDTHS = (320, 640, 1280)
+
+# Очередь задач (main/tasks.py, manage.py run_worker).
+# TASKS_EAGER: True — выполнять задачи в процессе сразу после коммита,
+# None — так же, но только на SQLite.
+TASKS_EAGER = None
+# Через сколько секунд задача «выполняется» без ответа считается зависшей.
+TASKS_LOCK_TIMEOUT = 15 * 60
+
+# Загрузка файлов (main/uploads.py): изображения проверяются по сигнатуре
+# и заголовку прямо во время приёма и пишутся во временный файл на диске.
+FILE_UPLOAD_HANDLERS = ['main.uploads.ImageUploadHandler']
+# Лимиты по полю формы и по формату; действует меньший.
+UPLOAD_IMAGE_FIELDS = {
+    'avatar': {'max_bytes': 5 * 1024 * 1024, 'max_pixels': 4096 * 4096},
+    'image': {'max_bytes': 10 * 1024 * 1024, 'max_pixels': 50_000_000},
+}
+UPLOAD_IMAGE_FORMATS = {
+    'jpeg': {'max_pixels': 50_000_000},
+    'png': {'max_pixels': 25_000_000},
+    'gif': {'max_bytes': 8 * 1024 * 1024, 'max_pixels': 4_000_000},
+}
+
+# Фоновая очистка удалённых тем, записей стены и пользователей (main/purge.py):
+# сколько строк удалять одним запросом.
+PURGE_BATCH_SIZE = 1000
+
+# Метрики запросов для Prometheus (main/metrics.py, /metrics — для персонала
+# или по заголовку «Authorization: Bearer <METRICS_TOKEN>»).
+METRICS_ENABLED = True
+METRICS_TOKEN = None
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Общий каталог для суммирования метрик нескольких воркеров (None — только
+# текущий процесс) и как часто воркер пишет туда свой снимок, в секундах.
+METRICS_SHARED_DIR = None
+METRICS_FLUSH_INTERVAL = 5
+
+# Бюджеты SQL-запросов представлений (main/query_budgets.py): {имя URL: N}
+# поверх декораторов @query_budget. STRICT — бросать исключение (в тестах),
+# иначе только предупреждение в лог. QUERY_INSPECTION (None — как DEBUG)
+# ищет N+1: один и тот же запрос NPLUSONE_THRESHOLD раз за запрос.
+QUERY_BUDGETS = {}
+QUERY_BUDGETS_STRICT = False
+QUERY_INSPECTION = None
+NPLUSONE_THRESHOLD = 5
+
+# Журнал медленных запросов (main/slow_queries.py). Порог в миллисекундах
+# (None — выключено). Для формы запроса, медленной SLOW_QUERY_EXPLAIN_AFTER
+# раз, план снимается с вероятностью SLOW_QUERY_EXPLAIN_RATE, но не чаще
+# раза в SLOW_QUERY_EXPLAIN_INTERVAL секунд.
+SLOW_QUERY_THRESHOLD_MS = 200
+SLOW_QUERY_PARAMS_MAX_LENGTH = 500
+SLOW_QUERY_EXPLAIN_AFTER = 3
+SLOW_QUERY_EXPLAIN_RATE = 0.1
+SLOW_QUERY_EXPLAIN_INTERVAL = 600
+
+# Трассировка запросов (main/tracing.py): доля запросов в выборке (0 —
+# выключено) и файл, куда дописываются трассы в формате OTLP/JSON.
+TRACING_SAMPLE_RATE = 0.0
+TRACING_EXPORT_PATH = BASE_DIR / 'logs' / 'traces.jsonl'
+
+# Реплики для чтения (main/db_routing.py): алиасы из DATABASES, с которых
+# читают GET-запросы. После POST браузер ещё DATABASE_REPLICA_PIN_SECONDS
+# секунд читает с основной базы (cookie DATABASE_REPLICA_PIN_COOKIE).
+DATABASE_ROUTERS = ['main.sharding.ShardRouter', 'main.db_routing.ReplicaRouter']
+DATABASE_REPLICAS = []
+DATABASE_REPLICA_PIN_SECONDS = 10
+DATABASE_REPLICA_PIN_COOKIE = 'db_primary'
+
+# Шарды личных сообщений (main/sharding.py): алиасы из DATABASES, по которым
+# диалоги раскладываются по id. Пустой список — всё в default. После
+# изменения списка (и при включении) запустите rebalance_message_shards.
+MESSAGE_SHARDS = []
+
+# Архив личных сообщений (main/message_archive.py): месяцы старше
+# MESSAGE_ARCHIVE_AFTER_MONTHS команда archive_messages выгружает в сжатые
+# JSONL-файлы и убирает из базы. На PostgreSQL секции создаются на
+# MESSAGE_PARTITIONS_AHEAD месяцев вперёд.
+MESSAGE_ARCHIVE_DIR = BASE_DIR / 'archive' / 'messages'
+MESSAGE_ARCHIVE_AFTER_MONTHS = 12
+MESSAGE_PARTITIONS_AHEAD = 3
@@ -28,6 +28,24 @@ DATABASES = {
     }
 }
 
+# Проверка чтения с реплик без PostgreSQL: DB_SQLITE — файл основной базы,
+# DB_SQLITE_REPLICA — её копия (реплика «отстаёт» до следующего копирования).
+if os.getenv('DB_SQLITE'):
+    DATABASES = {'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': os.getenv('DB_SQLITE')}}
+if os.getenv('DB_SQLITE_REPLICA'):
+    DATABASES['replica'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.getenv('DB_SQLITE_REPLICA'),
+        'TEST': {'MIRROR': 'default'},
+    }
+    DATABASE_REPLICAS = ['replica']
+
+# Шардирование личных сообщений на нескольких файлах SQLite:
+# DB_SQLITE_SHARDS=shard1.sqlite3,shard2.sqlite3 (default — тоже шард).
+for index, name in enumerate(filter(None, os.getenv('DB_SQLITE_SHARDS', '').split(',')), start=1):
+    DATABASES[f'shard{index}'] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': name.strip()}
+    MESSAGE_SHARDS = [*(MESSAGE_SHARDS or ['default']), f'shard{index}']
+
 # Пути к статике и медиа — внутри проекта
 STATIC_ROOT = BASE_DIR / 'staticfiles'
 MEDIA_ROOT = BASE_DIR / 'media'
@@ -41,8 +41,44 @@ except Exception as e:
     logger.critical(f'Ошибка подключения к PostgreSQL: {e}')
     raise
 
+# Реплики PostgreSQL для чтения: DB_REPLICA_HOSTS=host1,host2 (те же база и
+# пользователь). В тестах реплики — зеркала default.
+for index, host in enumerate(filter(None, os.environ.get('DB_REPLICA_HOSTS', '').split(',')), start=1):
+    alias = f'replica{index}'
+    DATABASES[alias] = {
+        **DATABASES['default'],
+        'HOST': host.strip(),
+        'ATOMIC_REQUESTS': False,
+        'TEST': {'MIRROR': 'default'},
+    }
+    DATABASE_REPLICAS = [*DATABASE_REPLICAS, alias]
+
+# Шарды личных сообщений (MESSAGE_SHARDS) здесь не включаются: на
+# PostgreSQL migrate, создание и отправка диалогов, списки диалогов и
+# rebalance_message_shards ещё не проверены, проверены только шарды SQLite
+# (local.py). Алиас шарда, когда он появится, — копия default с
+# 'ATOMIC_REQUESTS': False, как у реплик: иначе каждое представление
+# открывает транзакцию на каждом шарде.
+
 STATIC_ROOT = '/var/www/forum/staticfiles'
 MEDIA_ROOT = '/var/www/forum/media'
+MESSAGE_ARCHIVE_DIR = os.environ.get('MESSAGE_ARCHIVE_DIR', '/var/lib/forum/archive/messages')
+# Открытые файлы nginx отдаёт сам; закрытые (MEDIA_PRIVATE_PREFIXES) — по
+# X-Accel-Redirect после проверки доступа воркером.
+MEDIA_SENDFILE_BACKEND = os.environ.get('MEDIA_SENDFILE_BACKEND', 'nginx')
+
+# Метрики всех воркеров gunicorn суммируются через файлы в памяти.
+METRICS_SHARED_DIR = os.environ.get('METRICS_SHARED_DIR', '/dev/shm/forum-metrics')
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN') or None
+
+# Общий для всех воркеров кэш: версия фрагментов главной страницы
+# должна быть видна каждому процессу.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get('CACHE_DIR', '/var/tmp/forum_cache'),
+    }
+}
 
 # Безопасность на продакшене
 SECURE_SSL_REDIRECT = True
@@ -62,6 +98,9 @@ SECURE_CONTENT_SECURITY_POLICY = {
 LOGS_DIR = BASE_DIR / 'logs'
 os.makedirs(LOGS_DIR, exist_ok=True)
 
+TRACING_SAMPLE_RATE = float(os.environ.get('TRACING_SAMPLE_RATE', '0.01'))
+TRACING_EXPORT_PATH = LOGS_DIR / 'traces.jsonl'
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -92,6 +131,22 @@ LOGGING = {
             'backupCount': 3,
             'formatter': 'verbose',
         },
+        'slow_queries': {
+            'level': 'WARNING',
+            'class': 'logging.handlers.RotatingFileHandler',
+            'filename': LOGS_DIR / 'slow_queries.log',
+            'maxBytes': 10 * 1024 * 1024,  # 10MB
+            'backupCount': 5,
+            'formatter': 'verbose',
+        },
+        'query_plans': {
+            'level': 'WARNING',
+            'class': 'logging.handlers.RotatingFileHandler',
+            'filename': LOGS_DIR / 'query_plans.log',
+            'maxBytes': 10 * 1024 * 1024,  # 10MB
+            'backupCount': 3,
+            'formatter': 'verbose',
+        },
         'console': {
             'level': 'WARNING',
             'class': 'logging.StreamHandler',
@@ -128,5 +183,15 @@ LOGGING = {
             'level': 'INFO',
             'propagate': False,
         },
+        'main.slow_queries': {
+            'handlers': ['slow_queries'],
+            'level': 'WARNING',
+            'propagate': False,
+        },
+        'main.slow_queries.explain': {
+            'handlers': ['query_plans'],
+            'level': 'WARNING',
+            'propagate': False,
+        },
     },
 }
\ No newline at end of file
@@ -1,15 +1,14 @@
-from django.conf import settings
-from django.conf.urls.static import static
 from django.contrib import admin
 from django.urls import path, include
 
+from main.media import media_urlpatterns
+from main.metrics import metrics_view
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('', include('main.urls')),
     path('accounts/', include('django.contrib.auth.urls')),
-    
+    path('metrics', metrics_view, name='metrics'),
+    # Права проверяет Django, байты отдаёт прокси; открытые файлы прокси отдаёт сам (см. main/media.py).
+    *media_urlpatterns(),
 ]
-
-
-if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
\ No newline at end of file
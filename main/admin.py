@@ -1,5 +1,8 @@
 from django.contrib import admin
+from django.contrib.auth.admin import UserAdmin
+from django.contrib.auth.models import User
 from .models import Profile, Section, Subsection, Thread, Post, Conversation, Message, WallPost, WallComment
+from . import purge
 
 @admin.register(Section)
 class SectionAdmin(admin.ModelAdmin):
@@ -15,6 +18,12 @@ class ThreadAdmin(admin.ModelAdmin):
     list_display = ('title', 'author', 'subsection', 'created_at')
     list_filter = ('subsection', 'created_at')
     search_fields = ('title', 'author__username')
+    actions = ['soft_delete']
+
+    @admin.action(description='Удалить в фоне (сообщения удаляются пачками)')
+    def soft_delete(self, request, queryset):
+        for thread in queryset:
+            purge.soft_delete_thread(thread)
 
 @admin.register(Post)
 class PostAdmin(admin.ModelAdmin):
@@ -28,7 +37,32 @@ class PostAdmin(admin.ModelAdmin):
 
 @admin.register(Profile)
 class ProfileAdmin(admin.ModelAdmin):
-    list_display = ['user', 'avatar']
+    list_display = ['user', 'avatar', 'deleted_at']
+    actions = ['soft_delete_users']
+
+    @admin.action(description='Удалить пользователей в фоне')
+    def soft_delete_users(self, request, queryset):
+        for profile in queryset.select_related('user'):
+            purge.soft_delete_user(profile.user)
+
+
+admin.site.unregister(User)
+
+
+@admin.register(User)
+class ForumUserAdmin(UserAdmin):
+    """Удаление пользователя — мягкое, содержимое очищается в фоне (main/purge.py)."""
+
+    def get_deleted_objects(self, objs, request):
+        # Без обхода всех связанных строк: у активного пользователя их сотни тысяч.
+        return [str(obj) for obj in objs], {User._meta.verbose_name_plural: len(objs)}, set(), []
+
+    def delete_model(self, request, obj):
+        purge.soft_delete_user(obj)
+
+    def delete_queryset(self, request, queryset):
+        for user in queryset:
+            purge.soft_delete_user(user)
 
 
 @admin.register(Conversation)
@@ -49,6 +83,12 @@ class WallPostAdmin(admin.ModelAdmin):
     list_display = ('id', 'owner', 'author', 'created_at')
     list_filter = ('created_at',)
     search_fields = ('body', 'author__username', 'owner__username')
+    actions = ['soft_delete']
+
+    @admin.action(description='Удалить в фоне')
+    def soft_delete(self, request, queryset):
+        for wall_post in queryset:
+            purge.soft_delete_wall_post(wall_post)
 
 
 @admin.register(WallComment)
@@ -0,0 +1,178 @@
+"""Сквозной замер основных страниц форума (команда ``forumbench``).
+
+Каждая точка входа запрашивается через тестовый клиент Django
+``iterations`` раз (после ``warmup`` прогревочных запросов). Для неё
+записываются p50/p95/среднее время ответа, число SQL-запросов (на основной
+базе, репликах и шардах сообщений) и пик выделенной памяти (отдельным
+запросом под ``tracemalloc``, чтобы его накладные расходы не попали во
+время).
+
+Всё выполняется в транзакции, которая в конце откатывается: ``new_post``
+не оставляет сообщений, а on_commit-задачи (варианты картинок, индекс)
+не запускаются и в замер не входят.
+
+Отчёт — JSON; ``compare()`` сравнивает его с сохранённым базовым отчётом.
+"""
+import platform
+import statistics
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection, connections, transaction
+from django.db.models import Count
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from . import db_routing, sharding
+from .models import Conversation, Message, Post, Thread
+from .views import POSTS_PER_PAGE
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def _entry_points():
+    """Точки входа: [(имя, метод, url, данные)] для самых «тяжёлых» объектов базы."""
+    thread = Thread.objects.annotate(total=Count('posts')).order_by('-total', 'id').first()
+    if thread is None:
+        raise BenchmarkError('В базе нет тем — сначала запустите seed_forum')
+    # Диалоги лежат на шардах: участников и сообщения считаем на каждом.
+    totals = Counter()
+    for _, rows in sharding.fan_out(lambda alias: sharding.Participant.objects.using(alias)
+                                    .values('user_id').annotate(total=Count('id')).values_list('user_id', 'total')):
+        totals.update(dict(rows))
+    active = User.objects.filter(is_active=True)
+    active_ids = set(active.filter(id__in=totals).values_list('id', flat=True))
+    if active_ids:
+        user = active.get(id=min(active_ids, key=lambda user_id: (-totals[user_id], user_id)))
+    else:
+        user = active.order_by('id').first()
+    candidates = [
+        conversation for _, conversation in sharding.fan_out(
+            lambda alias: Conversation.objects.using(alias).filter(participants=user)
+            .annotate(total=Count('messages')).order_by('-total').first()
+        ) if conversation is not None
+    ]
+    conversation = max(candidates, key=lambda item: item.total, default=None)
+
+    last_page = max(1, -(-thread.total // POSTS_PER_PAGE))
+    post_list = reverse('post_list', args=[thread.id])
+    points = [
+        ('section_list', 'get', reverse('section_list'), None),
+        ('thread_list', 'get', reverse('thread_list', args=[thread.subsection_id]), None),
+        ('post_list?page=1', 'get', post_list, {'page': 1}),
+        ('post_list?page=middle', 'get', post_list, {'page': max(1, last_page // 2)}),
+        ('post_list?page=last', 'get', post_list, {'page': last_page}),
+        ('user_profile', 'get', reverse('user_profile', args=[user.id]), None),
+        ('messages_list', 'get', reverse('messages_list'), None),
+        ('messages_poll', 'get', reverse('messages_poll'), None),
+    ]
+    if conversation is not None:
+        last_id = conversation.messages.order_by('-id').values_list('id', flat=True).first() or 0
+        # Типичный опрос открытой вкладки: новых сообщений нет.
+        points.append(('message_poll', 'get', reverse('message_poll', args=[conversation.id]), {'after': last_id}))
+    points.append(('new_post', 'post', reverse('new_post', args=[thread.id]), {'text': 'Замер :fire:'}))
+    return user, points
+
+
+def _measure(client, method, url, data, iterations, warmup):
+    request = getattr(client, method)
+    for _ in range(warmup):
+        request(url, data)
+    timings, queries, status = [], [], None
+    aliases = dict.fromkeys([connection.alias, *db_routing.replicas(), *sharding.shards()])
+    for _ in range(iterations):
+        with ExitStack() as stack:
+            captured = [stack.enter_context(CaptureQueriesContext(connections[alias])) for alias in aliases]
+            started = time.perf_counter()
+            response = request(url, data)
+            timings.append((time.perf_counter() - started) * 1000)
+        queries.append(sum(len(context) for context in captured))
+        status = response.status_code
+
+    tracemalloc.start()
+    try:
+        request(url, data)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'status': status,
+        'p50_ms': round(percentile(timings, 0.5), 2),
+        'p95_ms': round(percentile(timings, 0.95), 2),
+        'mean_ms': round(statistics.fmean(timings), 2),
+        'queries': max(queries),
+        'peak_kib': round(peak / 1024, 1),
+    }
+
+
+def run(iterations=20, warmup=2, only=None, stdout=None):
+    """Замерить точки входа и вернуть отчёт (dict)."""
+    report = {
+        'meta': {
+            'created_at': timezone.now().isoformat(),
+            'database': connection.vendor,
+            'python': platform.python_version(),
+            'iterations': iterations,
+            'rows': {
+                'threads': Thread.objects.count(),
+                'posts': Post.objects.count(),
+                'messages': sum(count for _, count in sharding.fan_out(
+                    lambda alias: Message.objects.using(alias).count()
+                )),
+            },
+        },
+        'views': {},
+    }
+    hosts = [*settings.ALLOWED_HOSTS, 'testserver']
+    with override_settings(ALLOWED_HOSTS=hosts, RATELIMIT_ENABLE=False, TRACING_SAMPLE_RATE=0), transaction.atomic():
+        user, points = _entry_points()
+        client = Client()
+        client.force_login(user)
+        for name, method, url, data in points:
+            if only and name.split('?')[0] not in only:
+                continue
+            result = _measure(client, method, url, data, iterations, warmup)
+            report['views'][name] = result
+            if stdout:
+                stdout.write(
+                    f"{name:24} {result['status']}  p50 {result['p50_ms']:8.2f} мс  "
+                    f"p95 {result['p95_ms']:8.2f} мс  запросов {result['queries']:3}  "
+                    f"память {result['peak_kib']:9.1f} КиБ"
+                )
+        transaction.set_rollback(True)
+    return report
+
+
+def compare(report, baseline, tolerance=0.2):
+    """Регрессии относительно базового отчёта: список строк.
+
+    Регрессия — p95 выше базового больше чем на ``tolerance``, рост числа
+    SQL-запросов или смена кода ответа.
+    """
+    regressions = []
+    for name, current in report['views'].items():
+        previous = baseline.get('views', {}).get(name)
+        if previous is None:
+            continue
+        if current['status'] != previous['status']:
+            regressions.append(f"{name}: код ответа {previous['status']} -> {current['status']}")
+        if current['queries'] > previous['queries']:
+            regressions.append(f"{name}: SQL-запросов {previous['queries']} -> {current['queries']}")
+        if current['p95_ms'] > previous['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {previous['p95_ms']} -> {current['p95_ms']} мс")
+    return regressions
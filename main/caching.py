@@ -0,0 +1,39 @@
+"""Кэширование фрагментов главной страницы.
+
+Фрагменты шаблона ``section_list.html`` кэшируются под ключом, включающим
+номер версии. Сигналы моделей увеличивают версию, после чего все старые
+фрагменты перестают использоваться и со временем вытесняются по таймауту.
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+HOME_VERSION_KEY = 'home:version'
+
+
+def _initial_version():
+    # Начальное значение зависит от времени, чтобы после вытеснения ключа
+    # версия не совпала с одной из уже использованных.
+    return time.time_ns() // 1_000_000
+
+
+def get_home_version():
+    """Текущая версия фрагментов главной страницы."""
+    version = cache.get(HOME_VERSION_KEY)
+    if version is None:
+        cache.add(HOME_VERSION_KEY, _initial_version(), None)
+        version = cache.get(HOME_VERSION_KEY)
+    return version
+
+
+def bump_home_version():
+    """Инвалидировать все кэшированные фрагменты главной страницы."""
+    try:
+        cache.incr(HOME_VERSION_KEY)
+    except ValueError:
+        cache.set(HOME_VERSION_KEY, _initial_version(), None)
+
+
+def home_cache_timeout():
+    return getattr(settings, 'HOME_CACHE_TIMEOUT', 300)
@@ -0,0 +1,359 @@
+"""Нагрузочная модель личных сообщений (команда ``simulate_chat``).
+
+Основная нагрузка чата — не отправка, а открытые вкладки: каждая опрашивает
+``message_poll`` раз в 3 с и ``messages_poll`` раз в 12 с (см.
+message_detail.html), а при наборе текста шлёт ``typing_ping`` не чаще раза
+в 1,5 с. Модель воспроизводит это для N пользователей, вызывая
+ASGI-приложение ``forum.asgi`` прямо в процессе, без сети и сервера.
+
+Интервалы настраиваются и делятся на ``speed`` — так можно сравнивать
+стратегии опроса (реже/чаще, длинный опрос) на одной базе. Как и под
+uvicorn/daphne, каждый запрос выполняется в своём потоке пула
+(``ThreadSensitiveContext``), поэтому на SQLite конкурирующие записи
+(``typing_ping``) дают «database is locked» — такие ответы считаются ошибками.
+
+Отчёт: пропускная способность, распределение задержек по точкам входа и
+частота SQL-запросов (по счётчикам ``main.metrics``).
+
+Модель работает на настоящей базе, поэтому после прогона возвращает её в
+исходное состояние: удаляет отправленные сообщения (если не задан
+``keep_messages``) и сессии, снова помечает непрочитанными сообщения,
+которые «прочитали» открытые страницы диалогов, убирает и откатывает
+статусы набора и восстанавливает даты последнего сообщения диалогов.
+"""
+import asyncio
+import heapq
+import json
+import random
+import statistics
+import time
+from dataclasses import dataclass, field
+from importlib import import_module
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.models import User
+from django.middleware.csrf import CSRF_ALLOWED_CHARS, CSRF_SECRET_LENGTH
+from django.test import override_settings
+from django.urls import reverse
+from django.utils.crypto import get_random_string
+
+from . import metrics, sharding
+from .benchmark import percentile
+from .models import Conversation, Message, TypingStatus
+from .seeding import WORDS, chunked
+
+HOST = 'testserver'
+
+
+class ChatLoadError(Exception):
+    pass
+
+
+@dataclass
+class ChatTimings:
+    """Интервалы поведения пользователя, секунды (до деления на speed)."""
+    message_poll: float = 3.0
+    inbox_poll: float = 12.0
+    typing_ping: float = 1.5
+    # Средняя пауза между отправками и скорость набора (символов в секунду).
+    think: float = 30.0
+    typing_speed: float = 5.0
+
+
+@dataclass
+class Recorder:
+    latencies: dict = field(default_factory=dict)
+    errors: dict = field(default_factory=dict)
+
+    def record(self, name, elapsed_ms, status):
+        self.latencies.setdefault(name, []).append(elapsed_ms)
+        if status >= 400:
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+
+class ASGIClient:
+    """Минимальный HTTP-клиент для вызова ASGI-приложения в процессе."""
+
+    def __init__(self, app, cookies, csrf_token):
+        self.app = app
+        self.cookie_header = '; '.join(f'{name}={value}' for name, value in cookies.items()).encode()
+        self.csrf_token = csrf_token
+
+    async def request(self, method, path, query=None, data=None, xhr=True):
+        body = urlencode(data).encode() if data else b''
+        headers = [(b'host', HOST.encode()), (b'cookie', self.cookie_header)]
+        if xhr:
+            headers.append((b'x-requested-with', b'XMLHttpRequest'))
+        if method == 'POST':
+            headers += [
+                (b'content-type', b'application/x-www-form-urlencoded'),
+                (b'content-length', str(len(body)).encode()),
+                (b'x-csrftoken', self.csrf_token.encode()),
+            ]
+        scope = {
+            'type': 'http',
+            'asgi': {'version': '3.0'},
+            'http_version': '1.1',
+            'method': method,
+            'scheme': 'http',
+            'path': path,
+            'raw_path': path.encode(),
+            'query_string': urlencode(query or {}).encode(),
+            'root_path': '',
+            'headers': headers,
+            'client': ('127.0.0.1', 0),
+            'server': (HOST, 80),
+        }
+        pending = [{'type': 'http.request', 'body': body, 'more_body': False}]
+        finished = asyncio.Event()
+        response = {'status': 0, 'body': []}
+
+        async def receive():
+            if pending:
+                return pending.pop()
+            await finished.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                response['status'] = message['status']
+            elif message['type'] == 'http.response.body':
+                response['body'].append(message.get('body', b''))
+                if not message.get('more_body'):
+                    finished.set()
+
+        started = time.perf_counter()
+        await self.app(scope, receive, send)
+        finished.set()
+        return response['status'], b''.join(response['body']), (time.perf_counter() - started) * 1000
+
+
+def login_cookies(user):
+    """Сессия и CSRF-cookie, как после входа (аналог Client.force_login)."""
+    store = import_module(settings.SESSION_ENGINE).SessionStore()
+    store[SESSION_KEY] = str(user.pk)
+    store[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+    store[HASH_SESSION_KEY] = user.get_session_auth_hash()
+    store.save()
+    csrf_secret = get_random_string(CSRF_SECRET_LENGTH, allowed_chars=CSRF_ALLOWED_CHARS)
+    cookies = {settings.SESSION_COOKIE_NAME: store.session_key, settings.CSRF_COOKIE_NAME: csrf_secret}
+    return cookies, csrf_secret, store.session_key
+
+
+@dataclass
+class SimulatedUser:
+    user_id: int
+    conversation_id: int
+    client: ASGIClient
+    last_message_id: int = 0
+
+
+class ChatSimulation:
+    def __init__(self, app, users, timings, duration, speed=1.0, tabs=1, seed=None):
+        self.app = app
+        self.users = users
+        self.timings = timings
+        self.duration = duration
+        self.speed = speed
+        self.tabs = tabs
+        self.rng = random.Random(seed)
+        self.recorder = Recorder()
+        self.deadline = 0.0
+
+    async def sleep(self, seconds):
+        remaining = self.deadline - time.monotonic()
+        await asyncio.sleep(max(0.0, min(seconds / self.speed, remaining)))
+
+    def running(self):
+        return time.monotonic() < self.deadline
+
+    async def call(self, user, name, method, path, query=None, data=None, xhr=True):
+        status, body, elapsed = await user.client.request(method, path, query, data, xhr)
+        self.recorder.record(name, elapsed, status)
+        return status, body
+
+    async def poll_messages(self, user):
+        path = reverse('message_poll', args=[user.conversation_id])
+        await self.sleep(self.rng.uniform(0, self.timings.message_poll))
+        while self.running():
+            status, body = await self.call(user, 'message_poll', 'GET', path, {'after': user.last_message_id})
+            if status == 200:
+                for message in json.loads(body)['messages']:
+                    user.last_message_id = max(user.last_message_id, message['id'])
+            await self.sleep(self.timings.message_poll)
+
+    async def poll_inbox(self, user):
+        path = reverse('messages_poll')
+        await self.sleep(self.rng.uniform(0, self.timings.inbox_poll))
+        while self.running():
+            await self.call(user, 'messages_poll', 'GET', path)
+            await self.sleep(self.timings.inbox_poll)
+
+    async def compose(self, user):
+        typing_path = reverse('typing_ping', args=[user.conversation_id])
+        detail_path = reverse('message_detail', args=[user.conversation_id])
+        while self.running():
+            await self.sleep(self.rng.expovariate(1 / self.timings.think))
+            text = ' '.join(self.rng.choices(WORDS, k=self.rng.randint(2, 15)))
+            typing_left = len(text) / self.timings.typing_speed
+            while typing_left > 0 and self.running():
+                await self.call(user, 'typing_ping', 'POST', typing_path)
+                await self.sleep(self.timings.typing_ping)
+                typing_left -= self.timings.typing_ping
+            if not self.running():
+                break
+            # Отправка формы и перезагрузка страницы диалога после редиректа.
+            await self.call(user, 'message_send', 'POST', detail_path, data={'body': text}, xhr=False)
+            await self.call(user, 'message_detail', 'GET', detail_path, xhr=False)
+
+    async def run(self):
+        self.deadline = time.monotonic() + self.duration
+        tasks = []
+        for user in self.users:
+            tasks.append(self.compose(user))
+            for _ in range(self.tabs):
+                tasks += [self.poll_messages(user), self.poll_inbox(user)]
+        started = time.monotonic()
+        await asyncio.gather(*tasks)
+        return time.monotonic() - started
+
+
+def build_report(recorder, elapsed, queries_before, queries_after):
+    views = {}
+    total = 0
+    for name, latencies in sorted(recorder.latencies.items()):
+        total += len(latencies)
+        views[name] = {
+            'requests': len(latencies),
+            'errors': recorder.errors.get(name, 0),
+            'rps': round(len(latencies) / elapsed, 2),
+            'p50_ms': round(percentile(latencies, 0.5), 2),
+            'p95_ms': round(percentile(latencies, 0.95), 2),
+            'p99_ms': round(percentile(latencies, 0.99), 2),
+            'mean_ms': round(statistics.fmean(latencies), 2),
+        }
+    queries = sum(entry['queries'] for entry in queries_after.values()) - \
+        sum(entry['queries'] for entry in queries_before.values())
+    return {
+        'elapsed_s': round(elapsed, 2),
+        'requests': total,
+        'rps': round(total / elapsed, 2) if elapsed else 0,
+        'queries': queries,
+        'queries_per_s': round(queries / elapsed, 2) if elapsed else 0,
+        'queries_per_request': round(queries / total, 2) if total else 0,
+        'views': views,
+    }
+
+
+def prepare_users(count):
+    """Пользователи с диалогами: берутся оба участника самых свежих диалогов (со всех шардов)."""
+    chosen = {}
+    streams = [
+        Conversation.objects.using(alias).filter(last_message_at__isnull=False)
+        .order_by('-last_message_at').iterator(chunk_size=200)
+        for alias in sharding.shards()
+    ]
+    recent = heapq.merge(*streams, key=lambda conversation: conversation.last_message_at, reverse=True)
+    for batch in chunked(recent, 200):
+        participants = sharding.participant_ids(batch)
+        active = set(User.objects.filter(
+            is_active=True, id__in={user_id for ids in participants.values() for user_id in ids},
+        ).values_list('id', flat=True))
+        for conversation in batch:
+            for user_id in participants.get(conversation.pk, []):
+                if user_id in active and user_id not in chosen:
+                    chosen[user_id] = conversation.pk
+        if len(chosen) >= count:
+            break
+    return list(chosen.items())[:count]
+
+
+@dataclass
+class ShardSnapshot:
+    """Состояние диалогов одного шарда, которое меняет прогон модели."""
+    conversations: list
+    unread_ids: list
+    typing_statuses: list
+
+
+def snapshot_chat_state(conversation_ids, user_ids):
+    by_shard = {}
+    for conversation_id in conversation_ids:
+        by_shard.setdefault(sharding.shard_for(conversation_id), []).append(conversation_id)
+    return {
+        alias: ShardSnapshot(
+            conversations=list(Conversation.objects.using(alias).filter(id__in=ids).only('last_message_at', 'updated_at')),
+            unread_ids=list(Message.objects.using(alias).filter(
+                conversation_id__in=ids, recipient_id__in=user_ids, is_read=False,
+            ).values_list('id', flat=True)),
+            typing_statuses=list(TypingStatus.objects.using(alias).filter(conversation_id__in=ids)),
+        )
+        for alias, ids in by_shard.items()
+    }
+
+
+def restore_chat_state(snapshots, restore_last_message=True):
+    """Вернуть прочтение, статусы набора и (по желанию) даты диалогов из снимка."""
+    for alias, snapshot in snapshots.items():
+        conversation_ids = [conversation.pk for conversation in snapshot.conversations]
+        for ids in chunked(snapshot.unread_ids, 500):
+            Message.objects.using(alias).filter(id__in=ids).update(is_read=False, read_at=None)
+        TypingStatus.objects.using(alias).filter(conversation_id__in=conversation_ids).exclude(
+            id__in=[status.pk for status in snapshot.typing_statuses],
+        ).delete()
+        TypingStatus.objects.using(alias).bulk_update(snapshot.typing_statuses, ['updated_at'], batch_size=500)
+        if restore_last_message:
+            # bulk_update не вызывает pre_save, и auto_now не перезапишет updated_at.
+            Conversation.objects.using(alias).bulk_update(
+                snapshot.conversations, ['last_message_at', 'updated_at'], batch_size=500,
+            )
+
+
+def simulate(app, count, duration, timings=None, speed=1.0, tabs=1, seed=None, keep_messages=False):
+    """Подготовить пользователей, прогнать модель и вернуть отчёт."""
+    pairs = prepare_users(count)
+    if not pairs:
+        raise ChatLoadError('В базе нет диалогов — сначала запустите seed_forum')
+    # Id сообщений на каждом шарде свои.
+    first_new_ids = {
+        alias: (Message.objects.using(alias).order_by('-id').values_list('id', flat=True).first() or 0) + 1
+        for alias in sharding.shards()
+    }
+    conversations = dict(pairs)
+    session_keys = []
+    users = []
+    for user in User.objects.filter(pk__in=conversations):
+        cookies, csrf_token, session_key = login_cookies(user)
+        session_keys.append(session_key)
+        users.append(SimulatedUser(
+            user_id=user.pk,
+            conversation_id=conversations[user.pk],
+            client=ASGIClient(app, cookies, csrf_token),
+            last_message_id=first_new_ids[sharding.shard_for(conversations[user.pk])] - 1,
+        ))
+
+    snapshots = snapshot_chat_state(set(conversations.values()), list(conversations))
+    simulation = ChatSimulation(app, users, timings or ChatTimings(), duration, speed, tabs, seed)
+    queries_before = metrics.snapshot()
+    hosts = [*settings.ALLOWED_HOSTS, HOST]
+    try:
+        with override_settings(ALLOWED_HOSTS=hosts, RATELIMIT_ENABLE=False, TRACING_SAMPLE_RATE=0):
+            elapsed = asyncio.run(simulation.run())
+    finally:
+        store_class = import_module(settings.SESSION_ENGINE).SessionStore
+        for session_key in session_keys:
+            store_class(session_key).delete()
+        if not keep_messages:
+            for alias, first_new_id in first_new_ids.items():
+                Message.objects.using(alias).filter(
+                    id__gte=first_new_id, sender_id__in=[u.user_id for u in users],
+                ).delete()
+        # Оставленные сообщения — настоящие, и даты диалогов должны им соответствовать.
+        restore_chat_state(snapshots, restore_last_message=not keep_messages)
+    report = build_report(simulation.recorder, elapsed, queries_before, metrics.snapshot())
+    report['users'] = len(users)
+    report['tabs_per_user'] = tabs
+    report['speed'] = speed
+    return report
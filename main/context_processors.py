@@ -1,8 +1,8 @@
-from .models import Message
+from . import sharding
 
 
 def unread_message_count(request):
     if request.user.is_authenticated:
-        count = Message.objects.filter(recipient=request.user, is_read=False).count()
+        count = sharding.unread_count(request.user)
         return {'unread_message_count': count}
     return {'unread_message_count': 0}
@@ -0,0 +1,105 @@
+"""Чтение с реплик базы данных.
+
+``ReplicaRouter`` отправляет чтения на одну из реплик ``DATABASE_REPLICAS``
+только внутри запросов GET/HEAD/OPTIONS, помеченных
+``ReplicaRoutingMiddleware``. Всё остальное — записи, чтения «для записи»
+(``select_for_update``, ``get_or_create``), POST-запросы, команды и фоновые
+задачи — идёт в ``default``.
+
+Чтобы пользователь видел свои изменения, несмотря на отставание реплик:
+
+- после первой записи в запросе все его дальнейшие чтения идут в ``default``;
+- ответ на POST (и другие небезопасные методы) ставит cookie
+  ``DATABASE_REPLICA_PIN_COOKIE``, и ещё ``DATABASE_REPLICA_PIN_SECONDS``
+  секунд запросы этого браузера читают из ``default``. Cookie работает и до
+  входа (регистрация, логин) и одинаково во всех воркерах. Попутные записи
+  GET-запросов (отметки прочтения, сессия) cookie не ставят — иначе
+  просмотр тем никогда не попадал бы на реплики.
+
+Без ``DATABASE_REPLICAS`` маршрутизатор ничего не меняет.
+"""
+import contextvars
+import random
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+_state = contextvars.ContextVar('forum_db_routing', default=None)
+
+
+def replicas():
+    return list(getattr(settings, 'DATABASE_REPLICAS', ()))
+
+
+def pin_seconds():
+    return getattr(settings, 'DATABASE_REPLICA_PIN_SECONDS', 10)
+
+
+def pin_cookie():
+    return getattr(settings, 'DATABASE_REPLICA_PIN_COOKIE', 'db_primary')
+
+
+class RoutingState:
+    """Маршрутизация одного запроса."""
+
+    def __init__(self, use_replica):
+        self.use_replica = use_replica
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        state = _state.get()
+        if state is None or not state.use_replica:
+            return DEFAULT_DB_ALIAS
+        aliases = replicas()
+        return random.choice(aliases) if aliases else DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        if state is not None:
+            state.use_replica = False
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *replicas()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Схему реплик приносит репликация, а не migrate.
+        if db in replicas():
+            return False
+        return None
+
+
+def _pinned(request):
+    try:
+        return float(request.COOKIES.get(pin_cookie(), 0)) > time.time()
+    except ValueError:
+        return False
+
+
+class ReplicaRoutingMiddleware:
+    """Разрешает чтение с реплик безопасным запросам без «прилипания» к default."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        use_replica = bool(replicas()) and request.method in SAFE_METHODS and not _pinned(request)
+        token = _state.set(RoutingState(use_replica))
+        try:
+            response = self.get_response(request)
+        finally:
+            _state.reset(token)
+        if replicas() and request.method not in SAFE_METHODS:
+            seconds = pin_seconds()
+            response.set_cookie(
+                pin_cookie(), str(time.time() + seconds), max_age=seconds,
+                httponly=True, samesite='Lax', secure=settings.SESSION_COOKIE_SECURE,
+            )
+        return response
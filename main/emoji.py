@@ -5,6 +5,8 @@ from django.templatetags.static import static
 from django.utils.html import escape
 from django.utils.safestring import mark_safe
 
+from .tracing import span
+
 EMOJI_MAP = {
     'smile_okay': '😊',
     'thumbs_up': '👍',
@@ -77,7 +79,11 @@ def get_emoji_catalog():
 def render_emoji_html(value):
     if value is None:
         return ''
+    with span('emoji', length=len(str(value))):
+        return _render_emoji_html(value)
+
 
+def _render_emoji_html(value):
     text = escape(str(value))
 
     def replacer(match):
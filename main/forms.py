@@ -1,6 +1,7 @@
 # main/forms.py
 from django import forms
 from django.core.exceptions import ValidationError
+from django.core.files.uploadedfile import UploadedFile
 from django.utils.html import escape
 from .models import Profile, WallPost, WallComment
 from django.contrib.auth.models import User
@@ -158,7 +159,8 @@ class AvatarForm(forms.ModelForm):
     def clean_avatar(self):
         """Валидация размера и формата аватарки."""
         avatar = self.cleaned_data.get('avatar')
-        if avatar:
+        # Проверяем только новую загрузку; текущий файл профиля уже проверен.
+        if isinstance(avatar, UploadedFile):
             # Проверка размера (максимум 5MB)
             if avatar.size > 5 * 1024 * 1024:
                 raise ValidationError("Размер файла не должен превышать 5MB.")
@@ -0,0 +1,148 @@
+"""Обработка загруженных изображений.
+
+Для картинок к сообщениям создаются уменьшенные копии (WebP и JPEG нескольких
+ширин), по которым шаблон строит ``srcset``; для аватаров — квадратные копии
+``AVATAR_SIZES``. Генерация выполняется воркером очереди задач (main/tasks.py)
+уже после коммита запроса, поэтому не задерживает ответ.
+"""
+import io
+import logging
+import os
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from PIL import Image, ImageOps
+
+from .models import Post, PostImageVariant, Profile
+from .tasks import task
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_VARIANT_WIDTHS = (320, 640, 1280)
+VARIANT_QUALITY = {
+    PostImageVariant.FORMAT_WEBP: 80,
+    PostImageVariant.FORMAT_JPEG: 82,
+}
+
+AVATAR_SIZES = (40, 96, 300)
+
+
+def variant_widths():
+    return tuple(getattr(settings, 'POST_IMAGE_VARIANT_WIDTHS', DEFAULT_VARIANT_WIDTHS))
+
+
+def _encode(img, image_format):
+    if image_format == PostImageVariant.FORMAT_JPEG and img.mode != 'RGB':
+        # У JPEG нет прозрачности — подкладываем белый фон.
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        rgba = img.convert('RGBA')
+        background.paste(rgba, mask=rgba.getchannel('A'))
+        img = background
+    buffer = io.BytesIO()
+    img.save(buffer, format=image_format.upper(), quality=VARIANT_QUALITY[image_format], optimize=True)
+    return buffer.getvalue()
+
+
+def generate_post_variants(post):
+    """Создать (или пересоздать) уменьшенные копии изображения сообщения."""
+    if not post.image:
+        return []
+
+    with post.image.open('rb') as source:
+        with Image.open(source) as img:
+            if getattr(img, 'is_animated', False):
+                # Анимированные GIF отдаём как есть.
+                return []
+            img = ImageOps.exif_transpose(img)
+            if img.mode not in ('RGB', 'RGBA'):
+                img = img.convert('RGBA' if 'transparency' in img.info or img.mode in ('LA', 'PA') else 'RGB')
+            original_width, original_height = img.size
+
+            old_variants = list(post.image_variants.all())
+            variants = []
+            base_name = os.path.splitext(os.path.basename(post.image.name))[0]
+            for width in variant_widths():
+                if width >= original_width:
+                    continue
+                height = max(1, round(original_height * width / original_width))
+                resized = img.resize((width, height), Image.LANCZOS)
+                for image_format in (PostImageVariant.FORMAT_WEBP, PostImageVariant.FORMAT_JPEG):
+                    data = _encode(resized, image_format)
+                    variant = PostImageVariant(
+                        post=post,
+                        format=image_format,
+                        width=width,
+                        height=height,
+                        bytes=len(data),
+                    )
+                    extension = 'jpg' if image_format == PostImageVariant.FORMAT_JPEG else image_format
+                    variant.file.save(f'{base_name}_{width}w.{extension}', ContentFile(data), save=False)
+                    variants.append(variant)
+
+    with transaction.atomic():
+        PostImageVariant.objects.filter(id__in=[v.id for v in old_variants]).delete()
+        PostImageVariant.objects.bulk_create(variants)
+    for variant in old_variants:
+        variant.file.delete(save=False)
+    return variants
+
+
+@task(max_attempts=3)
+def process_post_image(post_id):
+    """Задача очереди: сгенерировать варианты для сообщения ``post_id``."""
+    post = Post.objects.filter(id=post_id).first()
+    if post is not None:
+        generate_post_variants(post)
+
+
+def schedule_post_variants(post_id):
+    """Поставить генерацию вариантов в очередь (выполнится после коммита)."""
+    process_post_image.delay(post_id)
+
+
+def generate_avatar_variants(profile):
+    """Создать квадратные копии аватара.
+
+    Имена файлов строятся из хэша содержимого, поэтому копии одного и того
+    же изображения создаются один раз.
+    """
+    if not profile.avatar_hash:
+        return {}
+    # Копии лежат в обычном хранилище под именами из хэша аватара.
+    storage = default_storage
+    variants = {}
+    img = None
+    try:
+        for size in AVATAR_SIZES:
+            name = f'avatars/derived/{profile.avatar_hash}_{size}.webp'
+            if not storage.exists(name):
+                if img is None:
+                    with profile.avatar.open('rb') as source:
+                        img = ImageOps.exif_transpose(Image.open(source))
+                        img = img.convert('RGBA' if img.mode in ('RGBA', 'LA', 'P') else 'RGB')
+                thumb = ImageOps.fit(img, (size, size), Image.LANCZOS)
+                buffer = io.BytesIO()
+                thumb.save(buffer, format='WEBP', quality=85)
+                name = storage.save(name, ContentFile(buffer.getvalue()))
+            variants[str(size)] = name
+    finally:
+        if img is not None:
+            img.close()
+
+    # Аватар могли сменить, пока шла обработка.
+    Profile.objects.filter(pk=profile.pk, avatar_hash=profile.avatar_hash).update(avatar_variants=variants)
+    return variants
+
+
+@task(max_attempts=3)
+def process_avatar(profile_id):
+    """Задача очереди: сгенерировать копии аватара профиля ``profile_id``."""
+    profile = Profile.objects.filter(pk=profile_id).first()
+    if profile is not None:
+        generate_avatar_variants(profile)
+
+
+def schedule_avatar_variants(profile_id):
+    process_avatar.delay(profile_id)
@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.utils import timezone
+
+from main import message_archive, sharding
+
+
+class Command(BaseCommand):
+    help = ('Выгружает личные сообщения старше заданного числа месяцев в сжатые JSONL-файлы и убирает '
+            'их из базы; на PostgreSQL заранее создаёт помесячные секции.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, default=None, metavar='MONTHS',
+                            help='Архивировать месяцы старше этого числа месяцев '
+                                 '(по умолчанию MESSAGE_ARCHIVE_AFTER_MONTHS).')
+        parser.add_argument('--dry-run', action='store_true', help='Только показать, какие месяцы будут выгружены.')
+
+    def handle(self, *args, **options):
+        older_than = options['older_than']
+        if older_than is None:
+            older_than = message_archive.archive_after_months()
+        if older_than < 1:
+            raise CommandError('--older-than должен быть не меньше 1')
+
+        before = message_archive.add_months(message_archive.month_start(timezone.localdate()), -older_than)
+        total = months_total = 0
+        for alias in sharding.shards():
+            prefix = f'[{alias}] ' if sharding.enabled() else ''
+            if message_archive.partitioning_supported(alias) and not options['dry_run']:
+                with connections[alias].cursor() as cursor:
+                    created = message_archive.ensure_partitions(cursor)
+                for month in created:
+                    self.stdout.write(f'{prefix}Создана секция {message_archive.partition_name(month)}')
+
+            months = message_archive.months_to_archive(before, using=alias)
+            months_total += len(months)
+            for month in months:
+                if options['dry_run']:
+                    self.stdout.write(f'{prefix}{month:%Y-%m}: будет выгружен')
+                    continue
+                count = message_archive.archive_month(month, using=alias)
+                total += count
+                self.stdout.write(f'{prefix}{month:%Y-%m}: выгружено сообщений {count}')
+        if not months_total:
+            self.stdout.write('Архивировать нечего')
+            return
+        if not options['dry_run']:
+            self.stdout.write(self.style.SUCCESS(
+                f'Месяцев: {months_total}, сообщений: {total}, каталог {message_archive.archive_directory()}'
+            ))
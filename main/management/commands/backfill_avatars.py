@@ -0,0 +1,49 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from main.images import generate_avatar_variants
+from main.models import DEFAULT_AVATAR_NAME, Profile
+
+
+def _process(profile):
+    try:
+        profile.refresh_avatar_metadata()
+        profile.save(update_fields=['avatar_hash', 'avatar_width', 'avatar_height'])
+        generate_avatar_variants(profile)
+        return profile.pk, None
+    except Exception as exc:
+        return profile.pk, exc
+    finally:
+        connections.close_all()
+
+
+class Command(BaseCommand):
+    help = 'Считает хэш и размеры существующих аватаров и создаёт их уменьшенные копии.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4, help='Число потоков обработки.')
+        parser.add_argument('--batch-size', type=int, default=200, help='Сколько профилей читать за раз.')
+
+    def handle(self, *args, **options):
+        profiles = Profile.objects.select_related('user').filter(avatar_hash='')\
+            .exclude(avatar='').exclude(avatar=DEFAULT_AVATAR_NAME).order_by('pk')
+
+        processed = failed = 0
+        last_pk = 0
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            while True:
+                batch = list(profiles.filter(pk__gt=last_pk)[:options['batch_size']])
+                if not batch:
+                    break
+                last_pk = batch[-1].pk
+                for pk, error in executor.map(_process, batch):
+                    if error:
+                        failed += 1
+                        self.stderr.write(f'Профиль {pk}: {error}')
+                    else:
+                        processed += 1
+                self.stdout.write(f'Обработано {processed}, ошибок {failed}')
+
+        self.stdout.write(self.style.SUCCESS(f'Готово: {processed} аватаров, ошибок {failed}'))
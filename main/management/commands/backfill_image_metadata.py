@@ -0,0 +1,73 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from main.models import DEFAULT_AVATAR_NAME, Post, Profile, read_image_header
+
+
+def _read(field_file):
+    """(ширина, высота, формат, байт) или исключение — в отдельном потоке."""
+    try:
+        with field_file.open('rb'):
+            width, height, image_format = read_image_header(field_file)
+            return (width, height, image_format, field_file.size), None
+    except Exception as exc:
+        return None, exc
+
+
+class Command(BaseCommand):
+    help = 'Заполняет размеры, вес и формат уже загруженных изображений сообщений и аватаров.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=8, help='Число потоков чтения файлов.')
+        parser.add_argument('--batch-size', type=int, default=500, help='Сколько строк читать за раз.')
+        parser.add_argument(
+            '--all', action='store_true',
+            help='Пересчитать и уже заполненные строки (например, размеры снимков с EXIF-поворотом).',
+        )
+
+    def handle(self, *args, **options):
+        posts = Post.objects.exclude(image='').exclude(image__isnull=True)
+        profiles = Profile.objects.exclude(avatar='').exclude(avatar=DEFAULT_AVATAR_NAME)
+        if not options['all']:
+            posts = posts.filter(image_width__isnull=True)
+            profiles = profiles.filter(avatar_width__isnull=True)
+
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            self._backfill(
+                executor, posts, 'image',
+                ['image_width', 'image_height', 'image_format', 'image_bytes'], options['batch_size'],
+            )
+            self._backfill(
+                executor, profiles, 'avatar',
+                ['avatar_width', 'avatar_height', 'avatar_format', 'avatar_bytes'], options['batch_size'],
+            )
+
+    def _backfill(self, executor, queryset, field_name, metadata_fields, batch_size):
+        model = queryset.model
+        queryset = queryset.only('pk', field_name).order_by('pk')
+        processed = failed = 0
+        last_pk = 0
+        while True:
+            batch = list(queryset.filter(pk__gt=last_pk)[:batch_size])
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+            updated = []
+            files = [getattr(obj, field_name) for obj in batch]
+            for obj, (metadata, error) in zip(batch, executor.map(_read, files)):
+                if error:
+                    failed += 1
+                    self.stderr.write(f'{model.__name__} {obj.pk}: {error}')
+                    continue
+                for attname, value in zip(metadata_fields, metadata):
+                    setattr(obj, attname, value)
+                updated.append(obj)
+            # bulk_update не вызывает save() и сигналы — только UPDATE по батчу.
+            model.objects.bulk_update(updated, metadata_fields)
+            processed += len(updated)
+            self.stdout.write(f'{model._meta.verbose_name_plural}: обработано {processed}, ошибок {failed}')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'{model._meta.verbose_name_plural}: готово, {processed} файлов, ошибок {failed}'
+        ))
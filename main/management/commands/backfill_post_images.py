@@ -0,0 +1,48 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from main.images import generate_post_variants
+from main.models import Post
+
+
+def _process(post):
+    try:
+        return post.id, len(generate_post_variants(post)), None
+    except Exception as exc:
+        return post.id, 0, exc
+    finally:
+        connections.close_all()
+
+
+class Command(BaseCommand):
+    help = 'Создаёт уменьшенные копии изображений существующих сообщений.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4, help='Число потоков обработки.')
+        parser.add_argument('--batch-size', type=int, default=200, help='Сколько сообщений читать за раз.')
+        parser.add_argument('--force', action='store_true', help='Пересоздать варианты и там, где они уже есть.')
+
+    def handle(self, *args, **options):
+        posts = Post.objects.exclude(image='').exclude(image__isnull=True).order_by('id')
+        if not options['force']:
+            posts = posts.filter(image_variants__isnull=True)
+
+        processed = failed = 0
+        last_id = 0
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            while True:
+                batch = list(posts.filter(id__gt=last_id).distinct()[:options['batch_size']])
+                if not batch:
+                    break
+                last_id = batch[-1].id
+                for post_id, count, error in executor.map(_process, batch):
+                    if error:
+                        failed += 1
+                        self.stderr.write(f'Сообщение {post_id}: {error}')
+                    else:
+                        processed += 1
+                self.stdout.write(f'Обработано {processed}, ошибок {failed} (до id {last_id})')
+
+        self.stdout.write(self.style.SUCCESS(f'Готово: {processed} сообщений, ошибок {failed}'))
@@ -0,0 +1,93 @@
+from collections import Counter
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from main.models import DEFAULT_AVATAR_NAME, MediaBlob
+from main.storage import REFCOUNTED_FIELDS, content_storage, is_content_addressed
+
+
+class Command(BaseCommand):
+    help = ('Переносит загруженные файлы в контентно-адресуемое хранилище '
+            '(одинаковые файлы хранятся один раз) и пересчитывает ссылки на них.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Сколько строк читать за раз.')
+        parser.add_argument('--recount', action='store_true',
+                            help='Только пересчитать ссылки, файлы не переносить.')
+        parser.add_argument('--dry-run', action='store_true', help='Показать, что будет сделано.')
+
+    def handle(self, *args, **options):
+        if not options['recount']:
+            for model, field_names in REFCOUNTED_FIELDS.items():
+                for field_name in field_names:
+                    self._migrate_field(model, field_name, options)
+        if not options['dry_run']:
+            self._recount()
+
+    def _migrate_field(self, model, field_name, options):
+        rows = model.objects.exclude(**{field_name: ''}).exclude(**{f'{field_name}__isnull': True})\
+            .exclude(**{field_name: DEFAULT_AVATAR_NAME}).order_by('pk')
+        moved = {}
+        missing = 0
+        last_pk = 0
+        while True:
+            batch = list(rows.filter(pk__gt=last_pk).values_list('pk', field_name)[:options['batch_size']])
+            if not batch:
+                break
+            last_pk = batch[-1][0]
+            for pk, name in batch:
+                if is_content_addressed(name):
+                    continue
+                if name not in moved:
+                    if not default_storage.exists(name):
+                        missing += 1
+                        self.stderr.write(f'{model.__name__} {pk}: файл {name} не найден')
+                        continue
+                    if options['dry_run']:
+                        moved[name] = name
+                    else:
+                        with default_storage.open(name, 'rb') as source:
+                            moved[name] = content_storage.save(name, source)
+                if not options['dry_run']:
+                    model.objects.filter(pk=pk, **{field_name: name}).update(**{field_name: moved[name]})
+
+        if not options['dry_run']:
+            # Старые файлы удаляются, только когда на них больше никто не ссылается.
+            for old_name, new_name in moved.items():
+                if old_name != new_name and not model.objects.filter(**{field_name: old_name}).exists():
+                    default_storage.delete(old_name)
+        unique = len(set(moved.values())) if not options['dry_run'] else '?'
+        self.stdout.write(
+            f'{model._meta.verbose_name_plural}.{field_name}: перенесено {len(moved)} файлов '
+            f'(уникальных {unique}), не найдено {missing}'
+        )
+
+    def _recount(self):
+        counts = Counter()
+        for model, field_names in REFCOUNTED_FIELDS.items():
+            for field_name in field_names:
+                names = model.objects.values_list(field_name, flat=True).iterator(chunk_size=2000)
+                counts.update(name for name in names if is_content_addressed(name))
+
+        with transaction.atomic():
+            orphans = list(MediaBlob.objects.exclude(name__in=list(counts)).values_list('name', flat=True))
+            MediaBlob.objects.filter(name__in=orphans).delete()
+            existing = {blob.name: blob for blob in MediaBlob.objects.filter(name__in=list(counts))}
+            changed = []
+            for name, refcount in counts.items():
+                blob = existing.get(name)
+                if blob is None:
+                    existing[name] = MediaBlob(name=name, refcount=refcount)
+                elif blob.refcount != refcount:
+                    blob.refcount = refcount
+                    changed.append(blob)
+            MediaBlob.objects.bulk_create([blob for blob in existing.values() if blob.pk is None], batch_size=1000)
+            MediaBlob.objects.bulk_update(changed, ['refcount'], batch_size=1000)
+
+        for name in orphans:
+            content_storage.delete(name)
+        self.stdout.write(self.style.SUCCESS(
+            f'Ссылки пересчитаны: {len(counts)} файлов, исправлено {len(changed)}, удалено без ссылок {len(orphans)}'
+        ))
@@ -0,0 +1,48 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from main.benchmark import BenchmarkError, compare, run
+
+
+class Command(BaseCommand):
+    help = ('Замеряет основные страницы форума на текущей базе (p50/p95, SQL-запросы, память), '
+            'пишет JSON-отчёт и сравнивает его с базовым.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=20, help='Запросов на точку входа.')
+        parser.add_argument('--warmup', type=int, default=2, help='Прогревочных запросов (не учитываются).')
+        parser.add_argument('--only', nargs='+', metavar='VIEW', help='Замерить только эти представления.')
+        parser.add_argument('--output', help='Куда записать JSON-отчёт.')
+        parser.add_argument('--baseline', help='Базовый отчёт для сравнения; при регрессиях — код выхода 1.')
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help='Допустимый рост p95 относительно базового (по умолчанию 0.2 = 20%%).')
+
+    def handle(self, *args, **options):
+        if options['iterations'] < 1 or options['warmup'] < 0:
+            raise CommandError('--iterations должен быть не меньше 1, --warmup — не меньше 0')
+        baseline = None
+        if options['baseline']:
+            try:
+                with open(options['baseline'], encoding='utf-8') as source:
+                    baseline = json.load(source)
+            except (OSError, ValueError) as exc:
+                raise CommandError(f'Не удалось прочитать базовый отчёт: {exc}')
+
+        try:
+            report = run(options['iterations'], options['warmup'], options['only'], stdout=self.stdout)
+        except BenchmarkError as exc:
+            raise CommandError(str(exc))
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as output:
+                json.dump(report, output, ensure_ascii=False, indent=2, sort_keys=True)
+            self.stdout.write(f"Отчёт записан в {options['output']}")
+
+        if baseline is not None:
+            regressions = compare(report, baseline, options['tolerance'])
+            if regressions:
+                for line in regressions:
+                    self.stderr.write(line)
+                raise CommandError(f'Регрессий: {len(regressions)}')
+            self.stdout.write(self.style.SUCCESS('Регрессий относительно базового отчёта нет'))
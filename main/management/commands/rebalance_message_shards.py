@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from main import sharding
+
+
+class Command(BaseCommand):
+    help = ('Переносит диалоги (с участниками, сообщениями и архивами) на шарды, которые им назначает '
+            'текущий MESSAGE_SHARDS. Запускать после добавления или удаления шарда; повторный запуск '
+            'безопасен.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Только посчитать диалоги для переноса.')
+        parser.add_argument('--limit', type=int, default=None, help='Перенести не больше стольких диалогов.')
+
+    def handle(self, *args, **options):
+        if options['limit'] is not None and options['limit'] < 1:
+            raise CommandError('--limit должен быть не меньше 1')
+        if not sharding.enabled():
+            self.stdout.write('MESSAGE_SHARDS не задан: все диалоги в default')
+            return
+        moved = sharding.rebalance(dry_run=options['dry_run'], limit=options['limit'], stdout=self.stdout)
+        if not moved:
+            self.stdout.write('Все диалоги на своих шардах')
+            return
+        verb = 'будет перенесено' if options['dry_run'] else 'перенесено'
+        for (source, target), count in sorted(moved.items()):
+            self.stdout.write(f'{source} → {target}: {verb} диалогов {count}')
+        if not options['dry_run']:
+            self.stdout.write(self.style.SUCCESS(f'Перенесено диалогов: {sum(moved.values())}'))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from main import search
+
+
+class Command(BaseCommand):
+    help = 'Перестраивает полнотекстовый индекс тем и сообщений.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000, help='Размер диапазона id за один UPDATE.')
+
+    def handle(self, *args, **options):
+        if search.get_backend() is None:
+            raise CommandError('Полнотекстовый поиск не поддерживается этой СУБД.')
+        total = search.rebuild(batch_size=options['batch_size'], stdout=self.stdout)
+        self.stdout.write(self.style.SUCCESS(f'Готово, документов: {total}'))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from main.stats import STAT_MODELS, reconcile
+
+
+class Command(BaseCommand):
+    help = 'Сверяет счётчики глобальной статистики форума с фактическим числом строк.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'names',
+            nargs='*',
+            help=f"Какие счётчики сверять: {', '.join(STAT_MODELS)} (по умолчанию все).",
+        )
+
+    def handle(self, *args, **options):
+        unknown = set(options['names']) - set(STAT_MODELS)
+        if unknown:
+            raise CommandError(f"Неизвестные счётчики: {', '.join(sorted(unknown))}")
+        for name, (before, after) in reconcile(options['names'] or None).items():
+            marker = '' if before == after else ' (исправлено)'
+            self.stdout.write(f'{name}: {before} -> {after}{marker}')
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from main.stats import reconcile_profile_counters
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает счётчики сообщений, тем и записей стены в профилях пользователей.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Сколько профилей пересчитывать за один проход (по умолчанию 500).',
+        )
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size должен быть положительным')
+        checked, fixed = reconcile_profile_counters(options['batch_size'], stdout=self.stdout)
+        self.stdout.write(self.style.SUCCESS(f'Готово: проверено профилей {checked}, исправлено {fixed}'))
@@ -0,0 +1,59 @@
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from main import tasks
+
+
+class Command(BaseCommand):
+    help = 'Выполняет задачи из очереди (main/tasks.py).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4, help='Число потоков выполнения.')
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help='Пауза между опросами пустой очереди, секунд.')
+        parser.add_argument('--once', action='store_true', help='Выполнить готовые задачи и выйти.')
+
+    def handle(self, *args, **options):
+        workers = options['workers']
+        stop = threading.Event()
+        slots = threading.Semaphore(workers)
+
+        def shutdown(signum, frame):
+            self.stdout.write('Завершаем текущие задачи…')
+            stop.set()
+
+        signal.signal(signal.SIGTERM, shutdown)
+        signal.signal(signal.SIGINT, shutdown)
+
+        def run(task_row):
+            close_old_connections()
+            try:
+                tasks.execute(task_row)
+            finally:
+                close_old_connections()
+                slots.release()
+
+        locked_by = tasks.worker_id()
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='tasks') as executor:
+            while not stop.is_set():
+                # Берём задач ровно столько, сколько свободных потоков.
+                if not slots.acquire(timeout=options['poll_interval']):
+                    continue
+                free = 1
+                while free < workers and slots.acquire(blocking=False):
+                    free += 1
+                close_old_connections()
+                claimed = tasks.claim(free, locked_by)
+                for _ in range(free - len(claimed)):
+                    slots.release()
+                for task_row in claimed:
+                    executor.submit(run, task_row)
+                if not claimed:
+                    if options['once']:
+                        break
+                    stop.wait(options['poll_interval'])
+        self.stdout.write(self.style.SUCCESS('Воркер остановлен'))
@@ -0,0 +1,45 @@
+from dataclasses import fields
+
+from django.core.management.base import BaseCommand, CommandError
+
+from main.seeding import SeedVolumes, seed
+
+
+class Command(BaseCommand):
+    help = ('Заполняет базу синтетическими данными: пользователи, разделы, темы с «тяжёлым» '
+            'распределением сообщений, стены, комментарии, диалоги и личные сообщения.')
+
+    def add_arguments(self, parser):
+        defaults = SeedVolumes()
+        for field in fields(SeedVolumes):
+            parser.add_argument(
+                f"--{field.name.replace('_', '-')}",
+                type=int,
+                default=getattr(defaults, field.name),
+                help=f'По умолчанию {getattr(defaults, field.name)}.',
+            )
+        parser.add_argument('--batch-size', type=int, default=5000, help='Сколько строк вставлять одним запросом.')
+        parser.add_argument('--seed', type=int, default=None, help='Зерно генератора — для повторяемых данных.')
+        parser.add_argument('--prefix', default='seed', help='Префикс имён пользователей и разделов.')
+        parser.add_argument('--password', default='password', help='Пароль всех созданных пользователей.')
+        parser.add_argument('--skip-search', action='store_true', help='Не перестраивать поисковый индекс.')
+
+    def handle(self, *args, **options):
+        volumes = SeedVolumes(**{field.name: options[field.name] for field in fields(SeedVolumes)})
+        if options['batch_size'] < 1 or any(getattr(volumes, field.name) < 0 for field in fields(SeedVolumes)):
+            raise CommandError('Объёмы не могут быть отрицательными, --batch-size — не меньше 1')
+        if volumes.users < 2 or volumes.sections < 1 or volumes.subsections < 1:
+            raise CommandError('Нужны хотя бы 2 пользователя, 1 раздел и 1 подраздел')
+        try:
+            seed(
+                volumes,
+                batch_size=options['batch_size'],
+                seed=options['seed'],
+                prefix=options['prefix'],
+                password=options['password'],
+                rebuild_search=not options['skip_search'],
+                stdout=self.stdout,
+            )
+        except ValueError as exc:
+            raise CommandError(str(exc))
+        self.stdout.write(self.style.SUCCESS('Готово'))
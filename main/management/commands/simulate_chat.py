@@ -0,0 +1,72 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from main.chat_load import ChatLoadError, ChatTimings, simulate
+
+
+class Command(BaseCommand):
+    help = ('Моделирует нагрузку личных сообщений: N пользователей пишут, опрашивают диалог и список '
+            'диалогов и шлют «печатает…» через ASGI-приложение в процессе; выводит пропускную '
+            'способность, задержки и частоту SQL-запросов.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=50, help='Число пользователей.')
+        parser.add_argument('--duration', type=float, default=60, help='Длительность прогона, секунды.')
+        parser.add_argument('--speed', type=float, default=1.0,
+                            help='Ускорение времени: все интервалы делятся на это число.')
+        parser.add_argument('--tabs', type=int, default=1, help='Открытых вкладок у каждого пользователя.')
+        defaults = ChatTimings()
+        parser.add_argument('--message-poll', type=float, default=defaults.message_poll,
+                            help='Интервал опроса открытого диалога, секунды.')
+        parser.add_argument('--inbox-poll', type=float, default=defaults.inbox_poll,
+                            help='Интервал опроса списка диалогов, секунды.')
+        parser.add_argument('--typing-ping', type=float, default=defaults.typing_ping,
+                            help='Интервал сигнала «печатает…», секунды.')
+        parser.add_argument('--think', type=float, default=defaults.think,
+                            help='Средняя пауза между сообщениями пользователя, секунды.')
+        parser.add_argument('--seed', type=int, help='Seed генератора случайных чисел.')
+        parser.add_argument('--keep-messages', action='store_true',
+                            help='Не удалять отправленные во время прогона сообщения.')
+        parser.add_argument('--output', help='Куда записать JSON-отчёт.')
+
+    def handle(self, *args, **options):
+        if options['users'] < 1 or options['tabs'] < 1:
+            raise CommandError('--users и --tabs должны быть не меньше 1')
+        if options['duration'] <= 0 or options['speed'] <= 0:
+            raise CommandError('--duration и --speed должны быть положительными')
+        timings = ChatTimings(
+            message_poll=options['message_poll'],
+            inbox_poll=options['inbox_poll'],
+            typing_ping=options['typing_ping'],
+            think=options['think'],
+        )
+        if min(timings.message_poll, timings.inbox_poll, timings.typing_ping, timings.think) <= 0:
+            raise CommandError('Интервалы должны быть положительными')
+
+        from forum.asgi import application
+
+        try:
+            report = simulate(
+                application, options['users'], options['duration'], timings,
+                speed=options['speed'], tabs=options['tabs'], seed=options['seed'],
+                keep_messages=options['keep_messages'],
+            )
+        except ChatLoadError as exc:
+            raise CommandError(str(exc))
+
+        for name, view in report['views'].items():
+            self.stdout.write(
+                f"{name:16} {view['requests']:7} запр.  {view['rps']:8.2f}/с  ошибок {view['errors']:4}  "
+                f"p50 {view['p50_ms']:8.2f}  p95 {view['p95_ms']:8.2f}  p99 {view['p99_ms']:8.2f} мс"
+            )
+        self.stdout.write(
+            f"Пользователей {report['users']}, за {report['elapsed_s']} с: {report['requests']} запросов "
+            f"({report['rps']}/с), SQL-запросов {report['queries']} ({report['queries_per_s']}/с, "
+            f"{report['queries_per_request']} на запрос)"
+        )
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as output:
+                json.dump(report, output, ensure_ascii=False, indent=2, sort_keys=True)
+            self.stdout.write(f"Отчёт записан в {options['output']}")
@@ -0,0 +1,136 @@
+"""Отдача загруженных файлов.
+
+Права доступа проверяет Django, а сами байты отдаёт фронтовой прокси:
+view отвечает пустым ответом с заголовком ``X-Accel-Redirect`` (nginx) или
+``X-Sendfile`` (Apache mod_xsendfile, lighttpd). Range-запросы,
+``If-Modified-Since`` и ``sendfile()`` прокси обрабатывает сам, так что
+воркеры Python файлы не читают. Без настроенного бэкенда (разработка)
+файл отдаёт ``django.views.static.serve``.
+
+С прокси через Django идут только закрытые файлы: префиксы из
+``MEDIA_PRIVATE_PREFIXES`` и зарегистрированных ``register_media_access``.
+Остальное nginx отдаёт сам, без похода в воркер. Пример для nginx
+(``MEDIA_SENDFILE_BACKEND = 'nginx'``, ``MEDIA_PRIVATE_PREFIXES = ['attachments/']``)::
+
+    location /media/ {
+        root /var/www/forum;
+        expires 1d;
+        location ~ "^/media/[a-z]+/../../[0-9a-f]{64}" { expires max; add_header Cache-Control immutable; }
+    }
+    location /media/attachments/ { proxy_pass http://forum; }
+    location /protected-media/ {
+        internal;
+        alias /var/www/forum/media/;
+    }
+
+Файлы контентно-адресуемого хранилища (см. ``storage.py``) неизменяемы:
+их URL содержит хэш содержимого, поэтому им разрешено кэширование навсегда
+(вложенный location в примере выше, а без прокси — заголовки этого view).
+"""
+import mimetypes
+import posixpath
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.storage import default_storage
+from django.http import Http404, HttpResponse
+from django.urls import re_path
+from django.utils._os import safe_join
+from django.utils.cache import patch_cache_control
+from django.views.static import serve
+
+from .storage import is_content_addressed
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+DEFAULT_MAX_AGE = 24 * 60 * 60
+
+MEDIA_ACCESS_RULES = []
+
+
+def register_media_access(prefix, check):
+    """Закрыть файлы с путём, начинающимся на ``prefix``, проверкой доступа.
+
+    ``check(request, path)`` возвращает True, если файл можно отдать.
+    Например, вложения личных сообщений — только участникам беседы.
+    Регистрировать нужно в ``AppConfig.ready()``: маршрут строится при
+    загрузке urls.py.
+    """
+    MEDIA_ACCESS_RULES.append((prefix, check))
+
+
+def access_rule(path):
+    for prefix, check in MEDIA_ACCESS_RULES:
+        if path.startswith(prefix):
+            return check
+    return None
+
+
+def private_prefixes():
+    return [*getattr(settings, 'MEDIA_PRIVATE_PREFIXES', []), *(prefix for prefix, _ in MEDIA_ACCESS_RULES)]
+
+
+def media_urlpatterns():
+    """Маршрут ``MEDIA_URL``: без прокси — все файлы, с прокси — только закрытые."""
+    if not getattr(settings, 'MEDIA_SENDFILE_BACKEND', None):
+        pattern = '.+'
+    else:
+        prefixes = private_prefixes()
+        if not prefixes:
+            return []
+        pattern = '(?:%s).+' % '|'.join(re.escape(prefix) for prefix in prefixes)
+    media_url = re.escape(settings.MEDIA_URL.lstrip('/'))
+    return [re_path(rf'^{media_url}(?P<path>{pattern})$', serve_media, name='media')]
+
+
+def _normalize(path):
+    path = posixpath.normpath(path).lstrip('/')
+    try:
+        safe_join(str(settings.MEDIA_ROOT), path)
+    except SuspiciousFileOperation:
+        raise Http404('Недопустимый путь')
+    if path in ('', '.') or path.startswith('..'):
+        raise Http404('Недопустимый путь')
+    return path
+
+
+def _sendfile_response(path, backend):
+    content_type, encoding = mimetypes.guess_type(path)
+    response = HttpResponse(content_type=content_type or 'application/octet-stream')
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    if backend == 'nginx':
+        prefix = getattr(settings, 'MEDIA_ACCEL_PREFIX', '/protected-media/')
+        response.headers['X-Accel-Redirect'] = quote(prefix.rstrip('/') + '/' + path)
+    else:
+        response.headers['X-Sendfile'] = safe_join(str(settings.MEDIA_ROOT), path)
+    return response
+
+
+def serve_media(request, path):
+    """Проверить доступ к файлу ``path`` и поручить его отдачу прокси."""
+    path = _normalize(path)
+    check = access_rule(path)
+    if check is not None and not check(request, path):
+        # Не раскрываем, существует ли файл.
+        raise Http404('Файл не найден')
+
+    backend = getattr(settings, 'MEDIA_SENDFILE_BACKEND', None)
+    if backend:
+        # Иначе вместо 404 Django ответил бы ошибкой уровня nginx.
+        if not default_storage.exists(path):
+            raise Http404('Файл не найден')
+        response = _sendfile_response(path, backend)
+    else:
+        response = serve(request, path, document_root=settings.MEDIA_ROOT)
+        if response.status_code != 200:
+            return response
+
+    if check is not None:
+        patch_cache_control(response, private=True, max_age=DEFAULT_MAX_AGE)
+    elif is_content_addressed(path):
+        patch_cache_control(response, public=True, max_age=IMMUTABLE_MAX_AGE, immutable=True)
+    else:
+        patch_cache_control(response, public=True, max_age=DEFAULT_MAX_AGE)
+    return response
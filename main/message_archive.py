@@ -0,0 +1,362 @@
+"""Помесячные секции личных сообщений и холодный архив.
+
+На PostgreSQL таблица ``main_message`` секционирована по ``created_at``
+(``PARTITION BY RANGE``): секция на месяц ``main_message_pYYYYMM`` и секция
+по умолчанию ``main_message_pdefault`` для дат без своей секции. Ключ
+секционирования обязан входить в первичный ключ, поэтому в базе он
+``(id, created_at)``; для ORM первичным ключом остаётся ``id`` — значения
+по-прежнему уникальны (одна последовательность на все секции). Опросы
+диалога читают только свежие секции с их небольшими индексами. Схему
+переводит миграция 0017; на других СУБД таблица остаётся обычной.
+
+Команда ``archive_messages`` заранее создаёт секции на
+``MESSAGE_PARTITIONS_AHEAD`` месяцев вперёд, а месяцы старше
+``MESSAGE_ARCHIVE_AFTER_MONTHS`` выгружает в
+``MESSAGE_ARCHIVE_DIR/messages-YYYY-MM.jsonl.gz`` и убирает из базы: на
+PostgreSQL — ``DETACH PARTITION`` и ``DROP TABLE`` (мгновенно и без
+раздувания индексов), на других СУБД — удалением строк.
+
+Сообщения каждого диалога в файле — отдельный gzip-член (склейка членов —
+корректный gzip-файл). ``MessageArchive`` хранит смещение и длину члена,
+поэтому историю диалога за месяц можно прочитать, не распаковывая файл
+целиком, — лениво, когда пользователь откроет архив в диалоге.
+
+При удалении пользователя (main/purge.py) ``erase_conversations``
+вырезает его диалоги из архивных файлов: тексты не остаются на диске после
+того, как строки ``MessageArchive`` удалены.
+
+При шардировании (main/sharding.py) секции и выгрузка ведутся на каждом
+шарде отдельно: функции принимают алиас базы ``using``.
+"""
+import gzip
+import json
+import os
+import tempfile
+from datetime import date, datetime
+from itertools import groupby
+from operator import itemgetter
+from pathlib import Path
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.utils import timezone
+
+from .models import Message, MessageArchive
+
+TABLE = Message._meta.db_table
+DEFAULT_PARTITION = f'{TABLE}_pdefault'
+SEQUENCE = f'{TABLE}_id_seq'
+FIELDS = ('id', 'conversation_id', 'sender_id', 'recipient_id', 'body', 'created_at', 'is_read', 'read_at')
+
+
+def archive_directory():
+    return Path(getattr(settings, 'MESSAGE_ARCHIVE_DIR', settings.BASE_DIR / 'archive' / 'messages'))
+
+
+def archive_after_months():
+    return getattr(settings, 'MESSAGE_ARCHIVE_AFTER_MONTHS', 12)
+
+
+def partitions_ahead():
+    return getattr(settings, 'MESSAGE_PARTITIONS_AHEAD', 3)
+
+
+def partitioning_supported(using=DEFAULT_DB_ALIAS):
+    return connections[using].vendor == 'postgresql'
+
+
+def month_start(value):
+    return date(value.year, value.month, 1)
+
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def month_bounds(month):
+    """Начало месяца и следующего — в часовом поясе проекта."""
+    start = timezone.make_aware(datetime(month.year, month.month, 1))
+    following = add_months(month, 1)
+    return start, timezone.make_aware(datetime(following.year, following.month, 1))
+
+
+def partition_name(month):
+    return f'{TABLE}_p{month:%Y%m}'
+
+
+# --- Секции (только PostgreSQL) -------------------------------------------
+
+def list_partitions(cursor):
+    """Месяцы, для которых есть секции (без секции по умолчанию)."""
+    cursor.execute(
+        'SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid '
+        'WHERE i.inhparent = %s::regclass',
+        [TABLE],
+    )
+    prefix = f'{TABLE}_p'
+    months = []
+    for (name,) in cursor.fetchall():
+        suffix = name[len(prefix):]
+        if name.startswith(prefix) and suffix.isdigit():
+            months.append(date(int(suffix[:4]), int(suffix[4:]), 1))
+    return sorted(months)
+
+
+def is_attached(cursor, name):
+    """Присоединена ли таблица ``name`` секцией к ``main_message``."""
+    cursor.execute(
+        'SELECT EXISTS (SELECT 1 FROM pg_inherits WHERE inhrelid = to_regclass(%s) AND inhparent = %s::regclass)',
+        [name, TABLE],
+    )
+    return cursor.fetchone()[0]
+
+
+def create_partition(cursor, month):
+    """Создать секцию месяца; строки из секции по умолчанию переезжают в неё.
+
+    Создание, перенос строк и присоединение идут одной транзакцией. Таблицу,
+    оставшуюся неприсоединённой (например, созданную вручную), функция
+    присоединяет, а не пропускает.
+    """
+    name = partition_name(month)
+    if is_attached(cursor, name):
+        return False
+    start, end = month_bounds(month)
+    with transaction.atomic(using=cursor.db.alias):
+        cursor.execute(f'CREATE TABLE IF NOT EXISTS {name} (LIKE {TABLE} INCLUDING DEFAULTS)')
+        cursor.execute(
+            f'WITH moved AS (DELETE FROM {DEFAULT_PARTITION} WHERE created_at >= %s AND created_at < %s RETURNING *) '
+            f'INSERT INTO {name} SELECT * FROM moved',
+            [start, end],
+        )
+        # Индексы и первичный ключ секции PostgreSQL создаёт при присоединении.
+        cursor.execute(f'ALTER TABLE {TABLE} ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)', [start, end])
+    return True
+
+
+def ensure_partitions(cursor, first_month=None, ahead=None):
+    """Секции от ``first_month`` (по умолчанию — текущего) на ``ahead`` месяцев вперёд."""
+    current = month_start(timezone.localdate())
+    month = first_month or current
+    last = add_months(current, partitions_ahead() if ahead is None else ahead)
+    created = []
+    while month <= last:
+        if create_partition(cursor, month):
+            created.append(month)
+        month = add_months(month, 1)
+    return created
+
+
+def drop_partition(cursor, month):
+    name = partition_name(month)
+    cursor.execute(f'ALTER TABLE {TABLE} DETACH PARTITION {name}')
+    cursor.execute(f'DROP TABLE {name}')
+
+
+def rebuild_table(cursor, partitioned):
+    """Пересоздать ``main_message`` секционированной (или обычной) с теми же данными.
+
+    Индексы и внешние ключи переносятся с прежними именами, чтобы
+    последующие миграции Django их находили. Identity-колонку Django
+    заменяет обычная последовательность: identity у секционированных
+    таблиц появилась только в PostgreSQL 17.
+    """
+    cursor.execute(
+        'SELECT indexname, indexdef FROM pg_indexes WHERE schemaname = current_schema() AND tablename = %s',
+        [TABLE],
+    )
+    indexes = cursor.fetchall()
+    cursor.execute(
+        'SELECT conname, contype, pg_get_constraintdef(oid) FROM pg_constraint '
+        "WHERE conrelid = %s::regclass AND contype IN ('p', 'f')",
+        [TABLE],
+    )
+    constraints = cursor.fetchall()
+    primary_key = next(name for name, kind, _ in constraints if kind == 'p')
+    cursor.execute(f'SELECT COALESCE(MAX(id), 0), MIN(created_at) FROM {TABLE}')
+    max_id, oldest = cursor.fetchone()
+
+    old = f'{TABLE}_old'
+    cursor.execute(f'ALTER TABLE {TABLE} RENAME TO {old}')
+    cursor.execute(f'ALTER TABLE {old} ALTER COLUMN id DROP IDENTITY IF EXISTS')
+    cursor.execute(f'ALTER TABLE {old} ALTER COLUMN id DROP DEFAULT')
+    cursor.execute(f'CREATE SEQUENCE IF NOT EXISTS {SEQUENCE}')
+    cursor.execute(f'ALTER SEQUENCE {SEQUENCE} OWNED BY NONE')
+    cursor.execute('SELECT setval(%s, %s, %s)', [SEQUENCE, max(max_id, 1), max_id > 0])
+
+    partition_clause = ' PARTITION BY RANGE (created_at)' if partitioned else ''
+    cursor.execute(f'CREATE TABLE {TABLE} (LIKE {old} INCLUDING DEFAULTS){partition_clause}')
+    cursor.execute(f"ALTER TABLE {TABLE} ALTER COLUMN id SET DEFAULT nextval('{SEQUENCE}')")
+    cursor.execute(f'ALTER SEQUENCE {SEQUENCE} OWNED BY {TABLE}.id')
+    if partitioned:
+        cursor.execute(f'CREATE TABLE {DEFAULT_PARTITION} PARTITION OF {TABLE} DEFAULT')
+        ensure_partitions(cursor, month_start(timezone.localtime(oldest)) if oldest else None)
+    cursor.execute(f'INSERT INTO {TABLE} SELECT * FROM {old}')
+    cursor.execute(f'DROP TABLE {old}')
+
+    key_columns = 'id, created_at' if partitioned else 'id'
+    cursor.execute(f'ALTER TABLE {TABLE} ADD CONSTRAINT {primary_key} PRIMARY KEY ({key_columns})')
+    for name, kind, definition in constraints:
+        if kind == 'f':
+            cursor.execute(f'ALTER TABLE {TABLE} ADD CONSTRAINT {name} {definition}')
+    for name, definition in indexes:
+        if name != primary_key:
+            # У секционированной таблицы определение содержит «ON ONLY».
+            cursor.execute(definition.replace(' ON ONLY ', ' ON '))
+
+
+# --- Архив ----------------------------------------------------------------
+
+def _archive_path(month):
+    directory = archive_directory()
+    directory.mkdir(parents=True, exist_ok=True)
+    name = f'messages-{month:%Y-%m}.jsonl.gz'
+    suffix = 1
+    # Повторная выгрузка месяца (например, строки из секции по умолчанию) — в новый файл.
+    while (directory / name).exists():
+        suffix += 1
+        name = f'messages-{month:%Y-%m}-{suffix}.jsonl.gz'
+    return directory / name
+
+
+def write_archive(month, rows):
+    """Записать строки (упорядоченные по диалогу) в файл месяца.
+
+    Возвращает путь (или None, если строк нет) и
+    ``{conversation_id: (смещение, длина, число сообщений)}``.
+    """
+    path = _archive_path(month)
+    chunks = {}
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as output:
+            for conversation_id, group in groupby(rows, key=itemgetter('conversation_id')):
+                lines = [json.dumps(row, cls=DjangoJSONEncoder, ensure_ascii=False) for row in group]
+                data = gzip.compress(('\n'.join(lines) + '\n').encode(), mtime=0)
+                chunks[conversation_id] = (output.tell(), len(data), len(lines))
+                output.write(data)
+            output.flush()
+            os.fsync(output.fileno())
+        if not chunks:
+            os.unlink(tmp_path)
+            return None, chunks
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    return path, chunks
+
+
+def months_to_archive(before, using=DEFAULT_DB_ALIAS):
+    """Месяцы раньше ``before`` (первого дня месяца), где есть сообщения или секции."""
+    start, _ = month_bounds(before)
+    months = {
+        month_start(day)
+        for day in Message.objects.using(using).filter(created_at__lt=start).dates('created_at', 'month')
+    }
+    if partitioning_supported(using):
+        with connections[using].cursor() as cursor:
+            months.update(month for month in list_partitions(cursor) if month < before)
+    return sorted(months)
+
+
+def archive_month(month, using=DEFAULT_DB_ALIAS):
+    """Выгрузить сообщения месяца в архив и убрать их из базы; вернуть их число."""
+    start, end = month_bounds(month)
+    queryset = Message.objects.using(using).filter(created_at__gte=start, created_at__lt=end)
+    rows = queryset.order_by('conversation_id', 'id').values(*FIELDS).iterator(chunk_size=2000)
+    path, chunks = write_archive(month, rows)
+    relative = str(path.relative_to(archive_directory())) if path else ''
+    with transaction.atomic(using=using):
+        MessageArchive.objects.using(using).bulk_create([
+            MessageArchive(
+                conversation_id=conversation_id, month=month, path=relative,
+                offset=offset, length=length, messages_count=count,
+            )
+            for conversation_id, (offset, length, count) in chunks.items()
+        ], batch_size=1000)
+        if partitioning_supported(using):
+            with connections[using].cursor() as cursor:
+                if month in list_partitions(cursor):
+                    drop_partition(cursor, month)
+                cursor.execute(
+                    f'DELETE FROM {DEFAULT_PARTITION} WHERE created_at >= %s AND created_at < %s', [start, end],
+                )
+        else:
+            queryset.delete()
+    return sum(count for _, _, count in chunks.values())
+
+
+def erase_conversations(conversation_ids, using=DEFAULT_DB_ALIAS):
+    """Вырезать историю диалогов из архивных файлов и удалить их ``MessageArchive``.
+
+    Файл не переписывается на месте: gzip-члены остальных диалогов
+    копируются в новый файл месяца, их строки перенаправляются на него в
+    транзакции, а старый файл удаляется после коммита. Если транзакция не
+    прошла, строки по-прежнему указывают на целый старый файл. Возвращает
+    число вырезанных фрагментов.
+    """
+    erased_ids = set(conversation_ids)
+    archives = MessageArchive.objects.using(using)
+    paths = set(archives.filter(conversation_id__in=erased_ids).values_list('path', flat=True))
+    erased = 0
+    for path in sorted(paths):
+        new_path = None
+        try:
+            with transaction.atomic(using=using):
+                rows = list(archives.select_for_update().filter(path=path).order_by('offset'))
+                kept = [row for row in rows if row.conversation_id not in erased_ids]
+                if len(kept) == len(rows):
+                    # Файл уже переписала параллельная очистка.
+                    continue
+                if kept:
+                    new_path = _copy_members(path, kept)
+                    for row in kept:
+                        row.path = str(new_path.relative_to(archive_directory()))
+                    archives.bulk_update(kept, ['path', 'offset'], batch_size=1000)
+                erased += archives.filter(path=path, conversation_id__in=erased_ids).delete()[0]
+                transaction.on_commit(lambda path=path: _unlink(path), using=using)
+        except BaseException:
+            if new_path is not None:
+                new_path.unlink(missing_ok=True)
+            raise
+    return erased
+
+
+def _copy_members(path, rows):
+    """Скопировать gzip-члены ``rows`` из ``path`` в новый файл того же месяца.
+
+    Смещения в ``rows`` заменяются на новые; возвращает путь к файлу.
+    """
+    new_path = _archive_path(rows[0].month)
+    fd, tmp_path = tempfile.mkstemp(dir=new_path.parent, suffix='.tmp')
+    try:
+        with open(archive_directory() / path, 'rb') as source, os.fdopen(fd, 'wb') as output:
+            for row in rows:
+                source.seek(row.offset)
+                data = source.read(row.length)
+                row.offset = output.tell()
+                output.write(data)
+            output.flush()
+            os.fsync(output.fileno())
+        os.replace(tmp_path, new_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    return new_path
+
+
+def _unlink(path):
+    (archive_directory() / path).unlink(missing_ok=True)
+
+
+def read_archive(archive):
+    """Сообщения одного фрагмента архива (список словарей, как при выгрузке)."""
+    with open(archive_directory() / archive.path, 'rb') as source:
+        source.seek(archive.offset)
+        data = source.read(archive.length)
+    return [json.loads(line) for line in gzip.decompress(data).decode().splitlines()]
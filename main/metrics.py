@@ -0,0 +1,362 @@
+"""Метрики запросов в формате Prometheus.
+
+``MetricsMiddleware`` для каждого запроса замеряет время ответа, число и
+суммарное время SQL-запросов (через ``connection.execute_wrapper``), время
+рендеринга шаблонов и размер ответа и складывает их в счётчики процесса
+под именем URL (``post_list``, ``messages_poll``…).
+
+Если задан ``METRICS_SHARED_DIR`` (например, каталог в ``/dev/shm``), каждый
+воркер раз в ``METRICS_FLUSH_INTERVAL`` секунд пишет свой снимок в файл
+``<pid>-<время запуска>.json``, а ``/metrics`` суммирует снимки всех
+воркеров. Время запуска в имени не даёт новому процессу с тем же pid
+затереть снимок умершего. Снимки умерших воркеров (``os.kill(pid, 0)``)
+``/metrics`` переносит в сводный ``retired.json`` и удаляет: каталог не
+растёт с перезапусками воркеров, а счётчики Prometheus только растут.
+"""
+import contextvars
+import fcntl
+import hmac
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed, PermissionDenied
+from django.db import connections
+from django.http import HttpResponse
+
+from . import template_hooks
+from .query_budgets import WRAPPER_FILES
+
+logger = logging.getLogger(__name__)
+WRAPPER_FILES.add(__file__)
+
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+UNRESOLVED_VIEW = 'unresolved'
+
+_lock = threading.Lock()
+_views = {}
+_last_write = 0.0
+_current = contextvars.ContextVar('forum_request_metrics', default=None)
+# (pid, имя файла снимка): имя выбирается в самом воркере, уже после fork.
+_snapshot_file = None
+RETIRED_FILE = 'retired.json'
+LOCK_FILE = '.lock'
+
+
+def latency_buckets():
+    return tuple(getattr(settings, 'METRICS_LATENCY_BUCKETS', DEFAULT_LATENCY_BUCKETS))
+
+
+def _shared_dir():
+    return getattr(settings, 'METRICS_SHARED_DIR', None)
+
+
+def _flush_interval():
+    return getattr(settings, 'METRICS_FLUSH_INTERVAL', 5)
+
+
+def _empty_entry():
+    return {
+        'count': 0,
+        'sum': 0.0,
+        # Число запросов в каждом интервале; последний — выше всех границ.
+        'buckets': [0] * (len(latency_buckets()) + 1),
+        'queries': 0,
+        'query_seconds': 0.0,
+        'template_seconds': 0.0,
+        'response_bytes': 0,
+    }
+
+
+class RequestMetrics:
+    """Замеры одного запроса."""
+
+    def __init__(self):
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.template_seconds = 0.0
+
+    def record_query(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.query_seconds += time.perf_counter() - start
+
+
+def current_request_metrics():
+    """Замеры текущего запроса (или None вне MetricsMiddleware)."""
+    return _current.get()
+
+
+@contextmanager
+def _timed_render(metrics):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.template_seconds += time.perf_counter() - start
+
+
+def _template_hook(template):
+    metrics = _current.get()
+    return _timed_render(metrics) if metrics is not None else None
+
+
+def instrument_templates():
+    """Засекать время верхнеуровневого рендеринга шаблонов (render, render_to_string).
+
+    Подключённые через ``{% include %}`` шаблоны рендерятся внутри и отдельно
+    не считаются.
+    """
+    template_hooks.subscribe(_template_hook)
+
+
+def view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    return match.view_name if match else UNRESOLVED_VIEW
+
+
+def response_size(response):
+    if getattr(response, 'streaming', False):
+        return int(response.get('Content-Length') or 0)
+    return len(response.content)
+
+
+def observe(view, duration, metrics, size):
+    """Учесть завершённый запрос в счётчиках процесса."""
+    with _lock:
+        entry = _views.get(view)
+        if entry is None:
+            entry = _views[view] = _empty_entry()
+        entry['count'] += 1
+        entry['sum'] += duration
+        entry['buckets'][bisect_left(latency_buckets(), duration)] += 1
+        entry['queries'] += metrics.queries
+        entry['query_seconds'] += metrics.query_seconds
+        entry['template_seconds'] += metrics.template_seconds
+        entry['response_bytes'] += size
+        due = _shared_dir() and time.monotonic() - _last_write >= _flush_interval()
+    if due:
+        write_snapshot()
+
+
+def snapshot():
+    """Копия счётчиков этого процесса: {view: {...}}."""
+    with _lock:
+        return {view: {**entry, 'buckets': list(entry['buckets'])} for view, entry in _views.items()}
+
+
+def reset():
+    """Обнулить счётчики процесса (для тестов)."""
+    global _last_write
+    with _lock:
+        _views.clear()
+        _last_write = 0.0
+
+
+def _snapshot_name():
+    global _snapshot_file
+    pid = os.getpid()
+    if _snapshot_file is None or _snapshot_file[0] != pid:
+        _snapshot_file = (pid, f'{pid}-{time.time_ns()}.json')
+    return _snapshot_file[1]
+
+
+def _write_json(directory, name, data):
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'w') as tmp:
+        json.dump(data, tmp)
+    os.replace(tmp_path, os.path.join(directory, name))
+
+
+def _read_json(directory, name):
+    """Содержимое файла или None, если его нет или он повреждён."""
+    try:
+        with open(os.path.join(directory, name)) as source:
+            return json.load(source)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError):
+        logger.warning('Пропущен повреждённый файл метрик %s', name)
+        return None
+
+
+def write_snapshot():
+    """Записать снимок процесса в общий каталог (атомарно, через rename)."""
+    global _last_write
+    directory = _shared_dir()
+    if not directory:
+        return
+    with _lock:
+        _last_write = time.monotonic()
+    data = snapshot()
+    try:
+        os.makedirs(directory, exist_ok=True)
+        _write_json(directory, _snapshot_name(), data)
+    except OSError:
+        logger.exception('Не удалось записать метрики в %s', directory)
+
+
+def _merge(total, data):
+    for view, entry in data.items():
+        target = total.setdefault(view, _empty_entry())
+        if len(entry['buckets']) != len(target['buckets']):
+            # Снимок со старыми границами гистограммы — пропускаем.
+            continue
+        for key in ('count', 'sum', 'queries', 'query_seconds', 'template_seconds', 'response_bytes'):
+            target[key] += entry[key]
+        target['buckets'] = [a + b for a, b in zip(target['buckets'], entry['buckets'])]
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _snapshot_pid(name):
+    """pid из имени файла снимка или None для чужих файлов."""
+    head = name[:-len('.json')].split('-', 1)[0] if name.endswith('.json') else ''
+    return int(head) if head.isdigit() else None
+
+
+def retire_dead_snapshots(directory):
+    """Перенести снимки умерших воркеров в ``retired.json`` и удалить их.
+
+    Сводный файл помнит имена перенесённых снимков, пока они не удалены:
+    если процесс упал между записью сводки и удалением, снимок не будет
+    учтён дважды.
+    """
+    with open(os.path.join(directory, LOCK_FILE), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        names = set(os.listdir(directory))
+        retired = _read_json(directory, RETIRED_FILE) or {'views': {}, 'folded': []}
+        folded = [name for name in retired['folded'] if name in names]
+        dead = [
+            name for name in sorted(names)
+            if name not in folded and (pid := _snapshot_pid(name)) is not None and not _is_alive(pid)
+        ]
+        for name in dead:
+            data = _read_json(directory, name)
+            if data is not None:
+                _merge(retired['views'], data)
+            folded.append(name)
+        if folded != retired['folded']:
+            retired['folded'] = folded
+            _write_json(directory, RETIRED_FILE, retired)
+        for name in folded:
+            try:
+                os.unlink(os.path.join(directory, name))
+            except FileNotFoundError:
+                pass
+    return retired, set(folded)
+
+
+def collect():
+    """Счётчики для экспорта: этого процесса или сумма по всем воркерам."""
+    directory = _shared_dir()
+    if not directory:
+        return snapshot()
+    write_snapshot()
+    try:
+        retired, folded = retire_dead_snapshots(directory)
+    except OSError:
+        logger.exception('Не удалось свести метрики умерших воркеров в %s', directory)
+        retired, folded = {'views': {}}, set()
+    total = {}
+    _merge(total, retired['views'])
+    for filename in sorted(os.listdir(directory)):
+        if _snapshot_pid(filename) is None or filename in folded:
+            continue
+        data = _read_json(directory, filename)
+        if data is not None:
+            _merge(total, data)
+    return total
+
+
+def _label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render_prometheus(data):
+    """Текстовый формат экспозиции Prometheus 0.0.4."""
+    lines = [
+        '# HELP forum_request_duration_seconds Время обработки запроса.',
+        '# TYPE forum_request_duration_seconds histogram',
+    ]
+    bounds = latency_buckets()
+    for view, entry in sorted(data.items()):
+        label = f'view="{_label(view)}"'
+        cumulative = 0
+        for bound, count in zip(bounds, entry['buckets']):
+            cumulative += count
+            lines.append(f'forum_request_duration_seconds_bucket{{{label},le="{bound}"}} {cumulative}')
+        lines.append(f'forum_request_duration_seconds_bucket{{{label},le="+Inf"}} {entry["count"]}')
+        lines.append(f'forum_request_duration_seconds_sum{{{label}}} {_number(entry["sum"])}')
+        lines.append(f'forum_request_duration_seconds_count{{{label}}} {entry["count"]}')
+
+    counters = (
+        ('forum_db_queries_total', 'Число SQL-запросов.', 'queries'),
+        ('forum_db_query_seconds_total', 'Суммарное время SQL-запросов.', 'query_seconds'),
+        ('forum_template_render_seconds_total', 'Суммарное время рендеринга шаблонов.', 'template_seconds'),
+        ('forum_response_size_bytes_total', 'Суммарный размер ответов.', 'response_bytes'),
+    )
+    for name, help_text, key in counters:
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} counter')
+        for view, entry in sorted(data.items()):
+            lines.append(f'{name}{{view="{_label(view)}"}} {_number(entry[key])}')
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsMiddleware:
+    """Собирает метрики запроса; ставится первым в MIDDLEWARE."""
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'METRICS_ENABLED', True):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        instrument_templates()
+
+    def __call__(self, request):
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(metrics.record_query))
+                response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        observe(view_name(request), time.perf_counter() - start, metrics, response_size(response))
+        return response
+
+
+def _has_token(request):
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    header = request.headers.get('Authorization', '')
+    return bool(token) and hmac.compare_digest(header, f'Bearer {token}')
+
+
+def metrics_view(request):
+    """``/metrics``: только для персонала или по ``Authorization: Bearer <METRICS_TOKEN>``."""
+    if not (request.user.is_staff or _has_token(request)):
+        raise PermissionDenied
+    return HttpResponse(render_prometheus(collect()), content_type='text/plain; version=0.0.4; charset=utf-8')
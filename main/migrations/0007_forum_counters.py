@@ -0,0 +1,45 @@
+# Generated by Django 6.0.1 on 2026-10-19 10:12
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def fill_counters(apps, schema_editor):
+    """Начальные значения счётчиков — фактическое число строк."""
+    ForumCounter = apps.get_model('main', 'ForumCounter')
+    sources = {
+        'users': apps.get_model(settings.AUTH_USER_MODEL),
+        'threads': apps.get_model('main', 'Thread'),
+        'posts': apps.get_model('main', 'Post'),
+    }
+    db_alias = schema_editor.connection.alias
+    ForumCounter.objects.using(db_alias).bulk_create([
+        ForumCounter(name=name, shard=0, value=model.objects.using(db_alias).count())
+        for name, model in sources.items()
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('main', '0006_rename_main_wallco_post_id_4b5e29_idx_main_wallco_post_id_7425d7_idx_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ForumCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=32, verbose_name='Счётчик')),
+                ('shard', models.PositiveSmallIntegerField(default=0, verbose_name='Шард')),
+                ('value', models.BigIntegerField(default=0, verbose_name='Значение')),
+            ],
+            options={
+                'verbose_name': 'Счётчик статистики',
+                'verbose_name_plural': 'Счётчики статистики',
+                'unique_together': {('name', 'shard')},
+            },
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 6.0.1 on 2026-10-19 11:40
+
+from django.db import migrations
+
+
+def install_search_index(apps, schema_editor):
+    """Колонки tsvector + GIN (PostgreSQL) или таблица FTS5 (SQLite)."""
+    from main import search
+
+    backend = search.get_backend(schema_editor.connection)
+    if backend is None:
+        return
+    with schema_editor.connection.cursor() as cursor:
+        backend.install(cursor)
+        for table, index in (('main_thread', backend.index_threads), ('main_post', backend.index_posts)):
+            cursor.execute(f'SELECT max(id) FROM {table}')
+            last_id = cursor.fetchone()[0]
+            if last_id:
+                index(cursor, id_range=(1, last_id))
+
+
+def uninstall_search_index(apps, schema_editor):
+    from main import search
+
+    backend = search.get_backend(schema_editor.connection)
+    if backend is None:
+        return
+    with schema_editor.connection.cursor() as cursor:
+        backend.uninstall(cursor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0007_forum_counters'),
+    ]
+
+    operations = [
+        migrations.RunPython(install_search_index, uninstall_search_index),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 6.0.1 on 2026-10-19 13:05
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def fill_last_post_id(apps, schema_editor):
+    Thread = apps.get_model('main', 'Thread')
+    Post = apps.get_model('main', 'Post')
+    db_alias = schema_editor.connection.alias
+    last_post = Post.objects.using(db_alias).filter(thread=OuterRef('pk')).order_by('-created_at', '-id').values('id')[:1]
+    Thread.objects.using(db_alias).update(last_post_id=Subquery(last_post))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0008_search_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='thread',
+            name='last_post_id',
+            field=models.BigIntegerField(blank=True, help_text='id последнего сообщения; нужен для отметок о прочтении', null=True, verbose_name='Последнее сообщение'),
+        ),
+        migrations.RunPython(fill_last_post_id, migrations.RunPython.noop),
+        migrations.CreateModel(
+            name='ThreadReadMarker',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_read_post_id', models.BigIntegerField(verbose_name='Последнее прочитанное сообщение')),
+                ('updated_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Дата обновления')),
+                ('thread', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_markers', to='main.thread', verbose_name='Тема')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='thread_read_markers', to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+            ],
+            options={
+                'verbose_name': 'Отметка о прочтении',
+                'verbose_name_plural': 'Отметки о прочтении',
+                'unique_together': {('user', 'thread')},
+            },
+        ),
+    ]
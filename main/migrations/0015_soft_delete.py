@@ -0,0 +1,51 @@
+# Generated by Django 6.0.1 on 2026-10-19 19:10
+
+import django.db.models.manager
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0014_task_queue'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='thread',
+            options={'base_manager_name': 'all_objects', 'ordering': ['-is_pinned', '-last_reply_at'], 'verbose_name': 'Тема', 'verbose_name_plural': 'Темы'},
+        ),
+        migrations.AlterModelOptions(
+            name='wallpost',
+            options={'base_manager_name': 'all_objects', 'ordering': ['-created_at'], 'verbose_name': 'Запись стены', 'verbose_name_plural': 'Записи стены'},
+        ),
+        migrations.AlterModelManagers(
+            name='thread',
+            managers=[
+                ('objects', django.db.models.manager.Manager()),
+                ('all_objects', django.db.models.manager.Manager()),
+            ],
+        ),
+        migrations.AlterModelManagers(
+            name='wallpost',
+            managers=[
+                ('objects', django.db.models.manager.Manager()),
+                ('all_objects', django.db.models.manager.Manager()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='deleted_at',
+            field=models.DateTimeField(blank=True, editable=False, help_text='Пользователь отключён и ждёт фоновой очистки', null=True, verbose_name='Удалён'),
+        ),
+        migrations.AddField(
+            model_name='thread',
+            name='deleted_at',
+            field=models.DateTimeField(blank=True, editable=False, help_text='Тема скрыта и ждёт фоновой очистки', null=True, verbose_name='Удалена'),
+        ),
+        migrations.AddField(
+            model_name='wallpost',
+            name='deleted_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='Удалена'),
+        ),
+    ]
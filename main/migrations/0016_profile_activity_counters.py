@@ -0,0 +1,48 @@
+# Generated by Django 6.0.1 on 2026-10-19 21:40
+
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def fill_counters(apps, schema_editor):
+    """Начальные значения — фактическое число строк (без мягко удалённых)."""
+    Profile = apps.get_model('main', 'Profile')
+    sources = {
+        'posts_count': (apps.get_model('main', 'Post'), 'author', {}),
+        'threads_count': (apps.get_model('main', 'Thread'), 'author', {'deleted_at__isnull': True}),
+        'wall_posts_count': (apps.get_model('main', 'WallPost'), 'owner', {'deleted_at__isnull': True}),
+    }
+    db_alias = schema_editor.connection.alias
+    updates = {}
+    for field, (model, user_field, filters) in sources.items():
+        counts = model.objects.using(db_alias).filter(**{user_field: OuterRef('user_id')}, **filters)\
+            .order_by().values(user_field).annotate(total=Count('id')).values('total')
+        updates[field] = Coalesce(Subquery(counts, output_field=IntegerField()), Value(0))
+    Profile.objects.using(db_alias).update(**updates)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0015_soft_delete'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='posts_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Сообщений'),
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='threads_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Тем'),
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='wall_posts_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Записей на стене'),
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
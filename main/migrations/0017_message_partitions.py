@@ -0,0 +1,57 @@
+# Generated by Django 6.0.1 on 2026-10-19 22:10
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def partition_messages(apps, schema_editor):
+    """PostgreSQL: main_message становится секционированной по месяцам.
+
+    Данные копируются под блокировкой таблицы — на большой базе миграцию
+    стоит запускать в окно обслуживания.
+    """
+    from main import message_archive
+
+    if not message_archive.partitioning_supported(schema_editor.connection.alias):
+        return
+    with schema_editor.connection.cursor() as cursor:
+        message_archive.rebuild_table(cursor, partitioned=True)
+
+
+def unpartition_messages(apps, schema_editor):
+    from main import message_archive
+
+    if not message_archive.partitioning_supported(schema_editor.connection.alias):
+        return
+    with schema_editor.connection.cursor() as cursor:
+        message_archive.rebuild_table(cursor, partitioned=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0016_profile_activity_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageArchive',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField(verbose_name='Месяц')),
+                ('path', models.CharField(max_length=255, verbose_name='Файл')),
+                ('offset', models.BigIntegerField(verbose_name='Смещение')),
+                ('length', models.PositiveIntegerField(verbose_name='Длина')),
+                ('messages_count', models.PositiveIntegerField(verbose_name='Сообщений')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата выгрузки')),
+                ('conversation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archives', to='main.conversation', verbose_name='Диалог')),
+            ],
+            options={
+                'verbose_name': 'Архив сообщений',
+                'verbose_name_plural': 'Архивы сообщений',
+                'ordering': ['month', 'id'],
+                'indexes': [models.Index(fields=['conversation', 'month'], name='main_messag_convers_3c1346_idx')],
+            },
+        ),
+        migrations.RunPython(partition_messages, unpartition_messages, hints={'model_name': 'message'}),
+    ]
@@ -0,0 +1,66 @@
+# Generated by Django 6.0.1 on 2026-10-19 23:05
+
+import django.db.models.deletion
+from django.conf import settings
+from django.core.management.color import no_style
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def seed_conversation_keys(apps, schema_editor):
+    """Новые id диалогов продолжают уже выданные."""
+    ConversationKey = apps.get_model('main', 'ConversationKey')
+    Conversation = apps.get_model('main', 'Conversation')
+    connection = schema_editor.connection
+    max_id = Conversation.objects.using(connection.alias).aggregate(last=Max('id'))['last']
+    if not max_id:
+        return
+    ConversationKey.objects.using(connection.alias).create(id=max_id)
+    with connection.cursor() as cursor:
+        for sql in connection.ops.sequence_reset_sql(no_style(), [ConversationKey]):
+            cursor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0017_message_partitions'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConversationKey',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата выдачи')),
+            ],
+            options={
+                'verbose_name': 'Ключ диалога',
+                'verbose_name_plural': 'Ключи диалогов',
+            },
+        ),
+        migrations.AlterField(
+            model_name='conversation',
+            name='participants',
+            field=models.ManyToManyField(db_constraint=False, related_name='conversations', to=settings.AUTH_USER_MODEL, verbose_name='Участники'),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='recipient',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='received_messages', to=settings.AUTH_USER_MODEL, verbose_name='Получатель'),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='sender',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='sent_messages', to=settings.AUTH_USER_MODEL, verbose_name='Отправитель'),
+        ),
+        migrations.AlterField(
+            model_name='typingstatus',
+            name='user',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='typing_statuses', to=settings.AUTH_USER_MODEL, verbose_name='Пользователь'),
+        ),
+        migrations.RunPython(
+            seed_conversation_keys, migrations.RunPython.noop, hints={'model_name': 'conversationkey'},
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 6.0.1 on 2026-10-20 09:10
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0018_message_shards'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='profile',
+            index=models.Index(fields=['deleted_at'], name='main_profil_deleted_b3ed3d_idx'),
+        ),
+    ]
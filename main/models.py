@@ -4,14 +4,47 @@ from django.utils import timezone
 from django.templatetags.static import static
 from django.urls import reverse
 from django.core.validators import FileExtensionValidator
-from PIL import Image
+from django.core.files.storage import default_storage
+from PIL import ExifTags, Image
+import hashlib
 import logging
 
+from .storage import get_content_storage
+
 logger = logging.getLogger(__name__)
 
+
+def read_image_header(file):
+    """Ширина, высота и формат изображения — так, как оно будет показано.
+
+    PIL читает только заголовок: пиксели не декодируются, поэтому это
+    дёшево даже для больших файлов. Позиция файла возвращается в начало.
+    Копии строятся после ``ImageOps.exif_transpose`` (main/images.py),
+    поэтому при EXIF-повороте на 90° (Orientation 5–8) ширина и высота
+    меняются местами.
+    """
+    file.seek(0)
+    try:
+        with Image.open(file) as img:
+            width, height = img.size
+            image_format = (img.format or '').lower()
+            if img.getexif().get(ExifTags.Base.Orientation) in (5, 6, 7, 8):
+                width, height = height, width
+    finally:
+        file.seek(0)
+    return width, height, image_format
+
+
 DEFAULT_AVATAR_NAME = 'avatars/default.png'
 
 
+class AliveManager(models.Manager):
+    """Менеджер без строк, помеченных на удаление (см. main/purge.py)."""
+
+    def get_queryset(self):
+        return super().get_queryset().filter(deleted_at__isnull=True)
+
+
 class Section(models.Model):
     """Главный раздел форума."""
     title = models.CharField(
@@ -46,6 +79,7 @@ class Profile(models.Model):
     )
     avatar = models.ImageField(
         upload_to='avatars/',
+        storage=get_content_storage,
         default='avatars/default.png',
         blank=True,
         validators=[FileExtensionValidator(allowed_extensions=['jpg', 'jpeg', 'png', 'gif'])],
@@ -53,14 +87,44 @@ class Profile(models.Model):
         help_text="Максимальный размер: 5MB. Рекомендуемые размеры: 300x300px"
     )
     bio = models.TextField(blank=True, max_length=500, verbose_name="О себе")
+    avatar_hash = models.CharField(max_length=64, blank=True, editable=False, verbose_name="SHA-256 аватара")
+    avatar_width = models.PositiveIntegerField(null=True, blank=True, editable=False, verbose_name="Ширина аватара")
+    avatar_height = models.PositiveIntegerField(null=True, blank=True, editable=False, verbose_name="Высота аватара")
+    avatar_bytes = models.PositiveIntegerField(null=True, blank=True, editable=False, verbose_name="Размер аватара, байт")
+    avatar_format = models.CharField(max_length=10, blank=True, editable=False, verbose_name="Формат аватара")
+    avatar_variants = models.JSONField(
+        default=dict,
+        blank=True,
+        editable=False,
+        verbose_name="Уменьшенные копии аватара",
+        help_text="{размер: имя файла}, заполняется в фоне (main/images.py)"
+    )
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата создания")
     updated_at = models.DateTimeField(auto_now=True, verbose_name="Дата обновления")
+    deleted_at = models.DateTimeField(
+        blank=True,
+        null=True,
+        editable=False,
+        verbose_name="Удалён",
+        help_text="Пользователь отключён и ждёт фоновой очистки"
+    )
+    # Счётчики активности: меняются только F()-обновлениями (см. main/stats.py).
+    posts_count = models.PositiveIntegerField(default=0, editable=False, verbose_name="Сообщений")
+    threads_count = models.PositiveIntegerField(default=0, editable=False, verbose_name="Тем")
+    wall_posts_count = models.PositiveIntegerField(default=0, editable=False, verbose_name="Записей на стене")
+
+    ACTIVITY_COUNTER_FIELDS = ['posts_count', 'threads_count', 'wall_posts_count']
+    AVATAR_METADATA_FIELDS = [
+        'avatar_hash', 'avatar_width', 'avatar_height', 'avatar_bytes', 'avatar_format', 'avatar_variants',
+    ]
 
     class Meta:
         verbose_name = 'Профиль'
         verbose_name_plural = 'Профили'
         indexes = [
             models.Index(fields=['user']),
+            # Есть ли пользователи, ждущие очистки (views.post_page_url).
+            models.Index(fields=['deleted_at']),
         ]
 
     def get_absolute_url(self):
@@ -69,23 +133,99 @@ class Profile(models.Model):
     def __str__(self):
         return f'{self.user.username} Profile'
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Снимок значений из БД — чтобы не сохранять профиль без изменений.
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+    def has_changed(self):
+        """Отличается ли профиль от загруженного из БД."""
+        loaded = getattr(self, '_loaded_values', None)
+        if loaded is None or self._avatar_changed():
+            return True
+        for field in self._meta.concrete_fields:
+            if field.attname in loaded and field.attname != 'avatar':
+                if getattr(self, field.attname) != loaded[field.attname]:
+                    return True
+        return False
+
+    def _has_custom_avatar(self):
+        return bool(self.avatar) and self.avatar.name != DEFAULT_AVATAR_NAME
+
+    def _avatar_changed(self):
+        if self.avatar and not getattr(self.avatar, '_committed', True):
+            return True
+        loaded = getattr(self, '_loaded_values', None)
+        if loaded is None:
+            return self._has_custom_avatar()
+        return (self.avatar.name or '') != (loaded.get('avatar') or '')
+
+    def _variant_url(self, size):
+        name = (self.avatar_variants or {}).get(str(size)) if self._has_custom_avatar() else None
+        if name:
+            return default_storage.url(name)
+        # Пока копии не готовы (или задача упала) — стандартный аватар, а не оригинал до 5 МБ.
+        return static('images/default-avatar.png')
+
     @property
     def avatar_url(self):
-        if not self.avatar or self.avatar.name == DEFAULT_AVATAR_NAME:
-            return static('images/default-avatar.png')
-        return self.avatar.url
+        return self._variant_url(300)
+
+    @property
+    def avatar_small_url(self):
+        return self._variant_url(40)
+
+    @property
+    def avatar_medium_url(self):
+        return self._variant_url(96)
+
+    def refresh_avatar_metadata(self):
+        """Пересчитать хэш и размеры аватара; картинка не декодируется целиком."""
+        self.avatar_hash, self.avatar_width, self.avatar_height = '', None, None
+        self.avatar_bytes, self.avatar_format = None, ''
+        if not self._has_custom_avatar():
+            return
+        try:
+            digest = hashlib.sha256()
+            for chunk in self.avatar.chunks():
+                digest.update(chunk)
+            self.avatar.seek(0)
+            self.avatar_width, self.avatar_height, self.avatar_format = read_image_header(self.avatar)
+            self.avatar_bytes = self.avatar.size
+            self.avatar_hash = digest.hexdigest()
+        except Exception as e:
+            logger.error(f"Ошибка при обработке аватара для {self.user.username}: {e}")
+            self.avatar_width, self.avatar_height = None, None
+            self.avatar_bytes, self.avatar_format = None, ''
 
     def save(self, *args, **kwargs):
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            # Счётчики в памяти могут быть устаревшими — их не перезаписываем.
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.ACTIVITY_COUNTER_FIELDS
+            ]
+        avatar_changed = self._avatar_changed()
+        schedule_variants = False
+        if avatar_changed:
+            old_hash = self.avatar_hash
+            self.refresh_avatar_metadata()
+            if self.avatar_hash != old_hash:
+                self.avatar_variants = {}
+                schedule_variants = bool(self.avatar_hash)
+            if kwargs.get('update_fields') is not None:
+                kwargs['update_fields'] = set(kwargs['update_fields']) | set(self.AVATAR_METADATA_FIELDS)
+
         super().save(*args, **kwargs)
-        if self.avatar and self.avatar.name != 'avatars/default.png':
-            try:
-                img = Image.open(self.avatar.path)
-                if img.height > 300 or img.width > 300:
-                    output_size = (300, 300)
-                    img.thumbnail(output_size)
-                    img.save(self.avatar.path)
-            except Exception as e:
-                logger.error(f"Ошибка при обработке аватара для {self.user.username}: {e}")
+        self._loaded_values = {
+            field.attname: (self.avatar.name if field.attname == 'avatar' else getattr(self, field.attname))
+            for field in self._meta.concrete_fields
+        }
+        if schedule_variants:
+            from .images import schedule_avatar_variants
+            schedule_avatar_variants(self.pk)
 
 
 class Subsection(models.Model):
@@ -149,11 +289,28 @@ class Thread(models.Model):
         db_index=True
     )
     views_count = models.PositiveIntegerField(default=0, verbose_name="Просмотры")
+    last_post_id = models.BigIntegerField(
+        blank=True,
+        null=True,
+        verbose_name="Последнее сообщение",
+        help_text="id последнего сообщения; нужен для отметок о прочтении"
+    )
+    deleted_at = models.DateTimeField(
+        blank=True,
+        null=True,
+        editable=False,
+        verbose_name="Удалена",
+        help_text="Тема скрыта и ждёт фоновой очистки"
+    )
+
+    objects = AliveManager()
+    all_objects = models.Manager()
 
     class Meta:
         ordering = ['-is_pinned', '-last_reply_at']
         verbose_name = 'Тема'
         verbose_name_plural = 'Темы'
+        base_manager_name = 'all_objects'
         indexes = [
             models.Index(fields=['subsection', '-is_pinned', '-last_reply_at']),
             models.Index(fields=['author']),
@@ -173,12 +330,17 @@ class Post(models.Model):
     text = models.TextField(verbose_name="Текст", blank=False)
     image = models.ImageField(
         upload_to='posts/',
+        storage=get_content_storage,
         blank=True,
         null=True,
         validators=[FileExtensionValidator(allowed_extensions=['jpg', 'jpeg', 'png', 'gif'])],
         verbose_name="Изображение",
         help_text="Опционально. Максимальный размер: 10MB"
     )
+    image_width = models.PositiveIntegerField(null=True, blank=True, editable=False, verbose_name="Ширина изображения")
+    image_height = models.PositiveIntegerField(null=True, blank=True, editable=False, verbose_name="Высота изображения")
+    image_bytes = models.PositiveIntegerField(null=True, blank=True, editable=False, verbose_name="Размер изображения, байт")
+    image_format = models.CharField(max_length=10, blank=True, editable=False, verbose_name="Формат изображения")
     author = models.ForeignKey(
         User,
         on_delete=models.CASCADE,
@@ -203,9 +365,95 @@ class Post(models.Model):
             models.Index(fields=['author']),
         ]
 
+    IMAGE_METADATA_FIELDS = ['image_width', 'image_height', 'image_bytes', 'image_format']
+
     def __str__(self):
         return f'Post by {self.author.username} in {self.thread.title}'
 
+    def refresh_image_metadata(self):
+        """Заполнить размеры, вес и формат изображения по заголовку файла."""
+        self.image_width, self.image_height, self.image_bytes, self.image_format = None, None, None, ''
+        if not self.image:
+            return
+        try:
+            self.image_width, self.image_height, self.image_format = read_image_header(self.image)
+            self.image_bytes = self.image.size
+        except Exception as e:
+            logger.error(f"Ошибка при чтении изображения {self.image.name}: {e}")
+
+    def save(self, *args, **kwargs):
+        # Метаданные считаются один раз — при загрузке нового файла.
+        uploaded = bool(self.image) and not getattr(self.image, '_committed', True)
+        if uploaded or (not self.image and self.image_width is not None):
+            self.refresh_image_metadata()
+            if kwargs.get('update_fields') is not None:
+                kwargs['update_fields'] = set(kwargs['update_fields']) | set(self.IMAGE_METADATA_FIELDS)
+        super().save(*args, **kwargs)
+
+
+class PostImageVariant(models.Model):
+    """Уменьшенная копия изображения сообщения (для srcset).
+
+    Создаётся в фоне после сохранения сообщения, см. main/images.py.
+    """
+    FORMAT_WEBP = 'webp'
+    FORMAT_JPEG = 'jpeg'
+    FORMAT_CHOICES = [
+        (FORMAT_WEBP, 'WebP'),
+        (FORMAT_JPEG, 'JPEG'),
+    ]
+
+    post = models.ForeignKey(
+        Post,
+        on_delete=models.CASCADE,
+        related_name='image_variants',
+        verbose_name="Сообщение"
+    )
+    format = models.CharField(max_length=8, choices=FORMAT_CHOICES, verbose_name="Формат")
+    width = models.PositiveIntegerField(verbose_name="Ширина")
+    height = models.PositiveIntegerField(verbose_name="Высота")
+    bytes = models.PositiveIntegerField(default=0, verbose_name="Размер, байт")
+    file = models.FileField(upload_to='posts/variants/', verbose_name="Файл")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата создания")
+
+    class Meta:
+        ordering = ['width']
+        verbose_name = 'Вариант изображения'
+        verbose_name_plural = 'Варианты изображений'
+        unique_together = ('post', 'format', 'width')
+
+    def __str__(self):
+        return f"{self.post_id} {self.format} {self.width}w"
+
+
+class ThreadReadMarker(models.Model):
+    """Последнее прочитанное пользователем сообщение в теме.
+
+    Пишется пачками через буфер в main/read_markers.py.
+    """
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='thread_read_markers',
+        verbose_name="Пользователь"
+    )
+    thread = models.ForeignKey(
+        Thread,
+        on_delete=models.CASCADE,
+        related_name='read_markers',
+        verbose_name="Тема"
+    )
+    last_read_post_id = models.BigIntegerField(verbose_name="Последнее прочитанное сообщение")
+    updated_at = models.DateTimeField(default=timezone.now, verbose_name="Дата обновления")
+
+    class Meta:
+        verbose_name = 'Отметка о прочтении'
+        verbose_name_plural = 'Отметки о прочтении'
+        unique_together = ('user', 'thread')
+
+    def __str__(self):
+        return f"Read {self.thread_id} by {self.user_id} up to {self.last_read_post_id}"
+
 
 class WallPost(models.Model):
     """Запись на стене пользователя."""
@@ -224,11 +472,16 @@ class WallPost(models.Model):
     body = models.TextField(verbose_name="Текст")
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата создания")
     updated_at = models.DateTimeField(auto_now=True, verbose_name="Дата обновления")
+    deleted_at = models.DateTimeField(blank=True, null=True, editable=False, verbose_name="Удалена")
+
+    objects = AliveManager()
+    all_objects = models.Manager()
 
     class Meta:
         ordering = ['-created_at']
         verbose_name = 'Запись стены'
         verbose_name_plural = 'Записи стены'
+        base_manager_name = 'all_objects'
         indexes = [
             models.Index(fields=['owner', '-created_at']),
             models.Index(fields=['author']),
@@ -269,12 +522,35 @@ class WallComment(models.Model):
         return f'Wall comment by {self.author.username}'
 
 
+class ConversationKey(models.Model):
+    """Выдаёт id диалогов.
+
+    Диалоги могут лежать на разных шардах (main/sharding.py), поэтому id
+    берётся из одной последовательности в основной базе, а не из таблицы
+    диалогов шарда.
+    """
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата выдачи")
+
+    class Meta:
+        verbose_name = 'Ключ диалога'
+        verbose_name_plural = 'Ключи диалогов'
+
+    def __str__(self):
+        return f"ConversationKey {self.id}"
+
+
 class Conversation(models.Model):
-    """Диалог 1-на-1 между пользователями."""
+    """Диалог 1-на-1 между пользователями.
+
+    Диалог, его сообщения, статусы набора и архивы живут на шарде
+    ``shard_for(id)``; пользователи — в основной базе, поэтому ссылки на
+    них без ограничений внешнего ключа в БД (db_constraint=False).
+    """
     participants = models.ManyToManyField(
         User,
         related_name='conversations',
-        verbose_name="Участники"
+        verbose_name="Участники",
+        db_constraint=False,
     )
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата создания")
     updated_at = models.DateTimeField(auto_now=True, verbose_name="Дата обновления")
@@ -293,7 +569,11 @@ class Conversation(models.Model):
 
 
 class Message(models.Model):
-    """Личное сообщение в диалоге."""
+    """Личное сообщение в диалоге.
+
+    На PostgreSQL таблица секционирована по месяцам ``created_at``, старые
+    месяцы уходят в архив (см. main/message_archive.py).
+    """
     conversation = models.ForeignKey(
         Conversation,
         on_delete=models.CASCADE,
@@ -304,13 +584,15 @@ class Message(models.Model):
         User,
         on_delete=models.CASCADE,
         related_name='sent_messages',
-        verbose_name="Отправитель"
+        verbose_name="Отправитель",
+        db_constraint=False,
     )
     recipient = models.ForeignKey(
         User,
         on_delete=models.CASCADE,
         related_name='received_messages',
-        verbose_name="Получатель"
+        verbose_name="Получатель",
+        db_constraint=False,
     )
     body = models.TextField(verbose_name="Текст")
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата отправки")
@@ -342,7 +624,8 @@ class TypingStatus(models.Model):
         User,
         on_delete=models.CASCADE,
         related_name='typing_statuses',
-        verbose_name="Пользователь"
+        verbose_name="Пользователь",
+        db_constraint=False,
     )
     updated_at = models.DateTimeField(default=timezone.now, verbose_name="Время набора")
 
@@ -355,4 +638,102 @@ class TypingStatus(models.Model):
         ]
 
     def __str__(self):
-        return f"Typing {self.user_id} in {self.conversation_id}"
\ No newline at end of file
+        return f"Typing {self.user_id} in {self.conversation_id}"
+
+
+class MessageArchive(models.Model):
+    """Сообщения диалога за месяц, выгруженные в архивный файл.
+
+    ``offset`` и ``length`` — положение gzip-члена диалога в файле
+    ``path`` (относительно MESSAGE_ARCHIVE_DIR).
+    """
+    conversation = models.ForeignKey(
+        Conversation,
+        on_delete=models.CASCADE,
+        related_name='archives',
+        verbose_name="Диалог"
+    )
+    month = models.DateField(verbose_name="Месяц")
+    path = models.CharField(max_length=255, verbose_name="Файл")
+    offset = models.BigIntegerField(verbose_name="Смещение")
+    length = models.PositiveIntegerField(verbose_name="Длина")
+    messages_count = models.PositiveIntegerField(verbose_name="Сообщений")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата выгрузки")
+
+    class Meta:
+        ordering = ['month', 'id']
+        verbose_name = 'Архив сообщений'
+        verbose_name_plural = 'Архивы сообщений'
+        indexes = [
+            models.Index(fields=['conversation', 'month']),
+        ]
+
+    def __str__(self):
+        return f"Archive {self.conversation_id} {self.month:%Y-%m}"
+
+
+class ForumCounter(models.Model):
+    """Шард счётчика глобальной статистики форума.
+
+    Каждый счётчик разбит на несколько строк, чтобы параллельные
+    инкременты не блокировали одну и ту же строку.
+    """
+    name = models.CharField(max_length=32, verbose_name="Счётчик")
+    shard = models.PositiveSmallIntegerField(default=0, verbose_name="Шард")
+    value = models.BigIntegerField(default=0, verbose_name="Значение")
+
+    class Meta:
+        verbose_name = 'Счётчик статистики'
+        verbose_name_plural = 'Счётчики статистики'
+        unique_together = ('name', 'shard')
+
+    def __str__(self):
+        return f"{self.name}[{self.shard}] = {self.value}"
+
+
+class MediaBlob(models.Model):
+    """Файл контентно-адресуемого хранилища и число ссылок на него."""
+    name = models.CharField(max_length=255, unique=True, verbose_name="Имя файла")
+    refcount = models.PositiveIntegerField(default=0, verbose_name="Ссылок")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата создания")
+
+    class Meta:
+        verbose_name = 'Медиафайл'
+        verbose_name_plural = 'Медиафайлы'
+
+    def __str__(self):
+        return f"{self.name} ({self.refcount})"
+
+
+class Task(models.Model):
+    """Отложенная задача для воркера (см. main/tasks.py)."""
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, 'В очереди'),
+        (STATUS_RUNNING, 'Выполняется'),
+        (STATUS_FAILED, 'Ошибка'),
+    ]
+
+    name = models.CharField(max_length=200, verbose_name="Задача")
+    args = models.JSONField(default=list, blank=True, verbose_name="Аргументы")
+    kwargs = models.JSONField(default=dict, blank=True, verbose_name="Именованные аргументы")
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_QUEUED, verbose_name="Статус")
+    attempts = models.PositiveIntegerField(default=0, verbose_name="Попыток")
+    max_attempts = models.PositiveIntegerField(default=5, verbose_name="Максимум попыток")
+    run_at = models.DateTimeField(default=timezone.now, verbose_name="Выполнить после")
+    locked_at = models.DateTimeField(null=True, blank=True, verbose_name="Взята в работу")
+    locked_by = models.CharField(max_length=200, blank=True, verbose_name="Воркер")
+    last_error = models.TextField(blank=True, verbose_name="Последняя ошибка")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата создания")
+
+    class Meta:
+        verbose_name = 'Задача'
+        verbose_name_plural = 'Задачи'
+        indexes = [
+            models.Index(fields=['status', 'run_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.name} [{self.status}]"
@@ -0,0 +1,217 @@
+"""Мягкое удаление и фоновая очистка тем, записей стены и пользователей.
+
+Обычный ``.delete()`` собирает в памяти все связанные объекты и удаляет их
+в транзакции запроса — для темы со 100 тыс. сообщений это минуты
+блокировок. Поэтому удаление идёт в два шага:
+
+1. ``soft_delete_*`` ставит отметку ``deleted_at`` (пользователь ещё и
+   отключается) — объект сразу пропадает с сайта: менеджер ``objects``
+   таких строк не видит, сообщения и комментарии на стенах удалённого
+   пользователя не показываются, диалоги с ним скрыты у собеседников,
+   а из поиска темы и сообщения убираются сразу;
+2. задача очереди ``purge_*`` удаляет дочерние строки пачками по
+   ``PURGE_BATCH_SIZE`` прямыми ``DELETE … WHERE id IN (…)``, каждая пачка —
+   в своей короткой транзакции, а файлы изображений освобождаются после
+   коммита. Очистку можно прервать и запустить снова: каждая пачка
+   удаляет только то, что ещё осталось.
+"""
+import logging
+from collections import Counter
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import DEFAULT_DB_ALIAS, connection, connections, transaction
+from django.db.models import Q, Subquery
+from django.utils import timezone
+
+from . import message_archive, search, sharding, stats, storage
+from .caching import bump_home_version
+from .models import (
+    Conversation, Message, Post, PostImageVariant, Profile, Thread, ThreadReadMarker,
+    TypingStatus, WallComment, WallPost,
+)
+from .tasks import task
+
+logger = logging.getLogger(__name__)
+
+
+def batch_size():
+    return getattr(settings, 'PURGE_BATCH_SIZE', 1000)
+
+
+def _raw_delete(model, ids, using=DEFAULT_DB_ALIAS):
+    if not ids:
+        return 0
+    placeholders = ', '.join(['%s'] * len(ids))
+    with connections[using].cursor() as cursor:
+        cursor.execute(f'DELETE FROM {model._meta.db_table} WHERE id IN ({placeholders})', list(ids))
+        return cursor.rowcount
+
+
+def _delete_in_batches(queryset):
+    """Удалять строки ``queryset`` пачками (без дочерних — они удалены раньше)."""
+    total = 0
+    while True:
+        with transaction.atomic(using=queryset.db):
+            ids = list(queryset.order_by().values_list('id', flat=True)[:batch_size()])
+            total += _raw_delete(queryset.model, ids, queryset.db)
+        if len(ids) < batch_size():
+            return total
+
+
+def _delete_posts(queryset):
+    """Удалить сообщения пачками вместе с копиями изображений и индексом поиска."""
+    total = 0
+    backend = search.get_backend()
+    while True:
+        with transaction.atomic():
+            rows = list(queryset.order_by().values_list('id', 'image', 'author_id')[:batch_size()])
+            ids = [post_id for post_id, _, _ in rows]
+            variants = list(PostImageVariant.objects.filter(post_id__in=ids).values_list('id', 'file'))
+            _raw_delete(PostImageVariant, [variant_id for variant_id, _ in variants])
+            deleted = _raw_delete(Post, ids)
+            if backend and ids:
+                with connection.cursor() as cursor:
+                    backend.remove(cursor, search.KIND_POST, ids)
+            for name, count in Counter(image for _, image, _ in rows if image).items():
+                for _ in range(count):
+                    storage.release(name)
+            variant_files = [name for _, name in variants if name]
+            if variant_files:
+                transaction.on_commit(lambda files=variant_files: _delete_files(files))
+            if deleted:
+                stats.increment('posts', -deleted)
+                for author_id, count in Counter(author_id for _, _, author_id in rows).items():
+                    stats.adjust_profile_counters(author_id, posts_count=-count)
+        total += deleted
+        if len(rows) < batch_size():
+            return total
+
+
+def _delete_files(names):
+    from django.core.files.storage import default_storage
+
+    for name in names:
+        try:
+            default_storage.delete(name)
+        except OSError:
+            logger.exception('Не удалось удалить файл %s', name)
+
+
+def _refresh_last_post(thread_ids):
+    for thread_id in thread_ids:
+        Thread.all_objects.filter(id=thread_id).update(
+            last_post_id=Subquery(
+                Post.objects.filter(thread_id=thread_id).order_by('-created_at', '-id').values('id')[:1]
+            )
+        )
+
+
+# ------------------------------------------------------------------------------
+# Темы
+
+def soft_delete_thread(thread):
+    """Скрыть тему сразу и поставить её очистку в очередь."""
+    if Thread.all_objects.filter(pk=thread.pk, deleted_at__isnull=True).update(deleted_at=timezone.now()):
+        stats.increment('threads', -1)
+        stats.adjust_profile_counters(thread.author_id, threads_count=-1)
+        search.hide_threads([thread.pk])
+        bump_home_version()
+        purge_thread.delay(thread.pk)
+
+
+@task(max_attempts=10)
+def purge_thread(thread_id):
+    """Удалить помеченную тему: сообщения пачками, затем саму тему."""
+    if not Thread.all_objects.filter(pk=thread_id, deleted_at__isnull=False).exists():
+        return
+    _delete_posts(Post.objects.filter(thread_id=thread_id))
+    _delete_in_batches(ThreadReadMarker.objects.filter(thread_id=thread_id))
+    with transaction.atomic():
+        _raw_delete(Thread, [thread_id])
+        search.remove_thread(thread_id)
+
+
+# ------------------------------------------------------------------------------
+# Записи стены
+
+def soft_delete_wall_post(wall_post):
+    if WallPost.all_objects.filter(pk=wall_post.pk, deleted_at__isnull=True).update(deleted_at=timezone.now()):
+        stats.adjust_profile_counters(wall_post.owner_id, wall_posts_count=-1)
+        purge_wall_post.delay(wall_post.pk)
+
+
+@task(max_attempts=10)
+def purge_wall_post(wall_post_id):
+    if not WallPost.all_objects.filter(pk=wall_post_id, deleted_at__isnull=False).exists():
+        return
+    _delete_in_batches(WallComment.objects.filter(post_id=wall_post_id))
+    _raw_delete(WallPost, [wall_post_id])
+
+
+# ------------------------------------------------------------------------------
+# Пользователи
+
+def soft_delete_user(user):
+    """Отключить пользователя, скрыть его темы, сообщения и записи стены, очистить в фоне."""
+    now = timezone.now()
+    with transaction.atomic():
+        User.objects.filter(pk=user.pk).update(is_active=False)
+        Profile.objects.filter(user_id=user.pk).update(deleted_at=now)
+        threads = Thread.all_objects.filter(author_id=user.pk, deleted_at__isnull=True)
+        thread_ids = list(threads.values_list('id', flat=True))
+        hidden = Thread.all_objects.filter(id__in=thread_ids).update(deleted_at=now)
+        search.hide_threads(thread_ids)
+        search.hide_author_posts(user.pk)
+        if hidden:
+            stats.increment('threads', -hidden)
+            stats.adjust_profile_counters(user.pk, threads_count=-hidden)
+        wall_posts = WallPost.all_objects.filter(
+            Q(owner_id=user.pk) | Q(author_id=user.pk), deleted_at__isnull=True
+        )
+        owners = Counter(wall_posts.values_list('owner_id', flat=True))
+        wall_posts.update(deleted_at=now)
+        for owner_id, count in owners.items():
+            stats.adjust_profile_counters(owner_id, wall_posts_count=-count)
+    bump_home_version()
+    purge_user.delay(user.pk)
+
+
+@task(max_attempts=10)
+def purge_user(user_id):
+    """Удалить пользователя: всё его содержимое пачками, в конце — саму запись."""
+    if not Profile.objects.filter(user_id=user_id, deleted_at__isnull=False).exists():
+        return
+
+    for thread_id in Thread.all_objects.filter(author_id=user_id).values_list('id', flat=True):
+        Thread.all_objects.filter(pk=thread_id, deleted_at__isnull=True).update(deleted_at=timezone.now())
+        purge_thread(thread_id)
+
+    # Сообщения в чужих темах: после удаления пересчитываем последнее сообщение темы.
+    thread_ids = set(Post.objects.filter(author_id=user_id).values_list('thread_id', flat=True).distinct())
+    _delete_posts(Post.objects.filter(author_id=user_id))
+    _refresh_last_post(thread_ids)
+
+    for wall_post_id in WallPost.all_objects.filter(Q(owner_id=user_id) | Q(author_id=user_id))\
+            .values_list('id', flat=True):
+        purge_wall_post(wall_post_id)
+    _delete_in_batches(WallComment.objects.filter(author_id=user_id))
+
+    # Личные диалоги один на один: без собеседника они не нужны и второму участнику.
+    for alias in sharding.shards():
+        conversations = Conversation.objects.using(alias)
+        conversation_ids = list(conversations.filter(participants__id=user_id).values_list('id', flat=True))
+        # Архив — файлы на диске: каскад по MessageArchive их не тронул бы.
+        message_archive.erase_conversations(conversation_ids, using=alias)
+        messages = Message.objects.using(alias)
+        _delete_in_batches(messages.filter(conversation_id__in=conversation_ids))
+        _delete_in_batches(messages.filter(Q(sender_id=user_id) | Q(recipient_id=user_id)))
+        _delete_in_batches(TypingStatus.objects.using(alias).filter(
+            Q(conversation_id__in=conversation_ids) | Q(user_id=user_id)
+        ))
+        for conversation_id in conversation_ids:
+            conversations.filter(pk=conversation_id).delete()
+    _delete_in_batches(ThreadReadMarker.objects.filter(user_id=user_id))
+
+    # Остались только мелкие связанные строки (профиль, счётчики) — обычное удаление.
+    User.objects.filter(pk=user_id).delete()
@@ -0,0 +1,142 @@
+"""Бюджеты SQL-запросов для представлений и поиск N+1.
+
+Бюджет — максимальное число запросов за один запрос к представлению.
+Задаётся декоратором ``@query_budget(n)`` рядом с кодом представления или
+в настройке ``QUERY_BUDGETS`` по имени URL (настройка важнее декоратора).
+Личные сообщения обходят все шарды ``MESSAGE_SHARDS``, поэтому бюджет из
+декоратора растёт на ``per_shard`` запросов за каждый шард сверх первого.
+``QueryBudgetMiddleware`` считает запросы и при превышении пишет
+предупреждение в лог, а при ``QUERY_BUDGETS_STRICT`` бросает
+``QueryBudgetExceeded`` — так тесты падают на регрессиях.
+
+Если включён ``QUERY_INSPECTION`` (по умолчанию — при ``DEBUG``), запросы
+ещё и группируются по «форме» SQL: один и тот же запрос, повторённый
+``NPLUSONE_THRESHOLD`` раз за запрос, — типичный N+1. В лог пишется место
+в коде проекта, откуда он выполняется.
+"""
+import logging
+import re
+import traceback
+from collections import Counter
+from contextlib import ExitStack
+from pathlib import Path
+
+import django
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+# Списки IN (%s, %s, …) разной длины — одна и та же форма запроса.
+IN_LIST_PATTERN = re.compile(r'IN \((?:%s, )*%s\)')
+DJANGO_ROOT = str(Path(django.__file__).parent)
+# Модули с обёртками execute_wrapper: их кадры — не место вызова.
+WRAPPER_FILES = {__file__}
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+def query_budget(max_queries, per_shard=1):
+    """Декоратор: представление укладывается в ``max_queries`` SQL-запросов.
+
+    ``per_shard`` — запросы на каждый дополнительный шард (по умолчанию —
+    счётчик непрочитанных сообщений в шапке страницы).
+    """
+    def decorator(view):
+        view.query_budget = max_queries
+        view.query_budget_per_shard = per_shard
+        return view
+    return decorator
+
+
+def extra_shards():
+    return max(len(getattr(settings, 'MESSAGE_SHARDS', ())) - 1, 0)
+
+
+def budget_for(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return None
+    budgets = getattr(settings, 'QUERY_BUDGETS', {})
+    if match.view_name in budgets:
+        return budgets[match.view_name]
+    budget = getattr(match.func, 'query_budget', None)
+    if budget is None:
+        return None
+    return budget + getattr(match.func, 'query_budget_per_shard', 0) * extra_shards()
+
+
+def inspection_enabled():
+    enabled = getattr(settings, 'QUERY_INSPECTION', None)
+    return settings.DEBUG if enabled is None else enabled
+
+
+def nplusone_threshold():
+    return getattr(settings, 'NPLUSONE_THRESHOLD', 5)
+
+
+def sql_shape(sql):
+    return IN_LIST_PATTERN.sub('IN (…)', sql)
+
+
+def call_site():
+    """Ближайший кадр стека из кода проекта: «main/views.py:42 in func»."""
+    base_dir = str(settings.BASE_DIR)
+    for frame in reversed(traceback.extract_stack()[:-1]):
+        filename = frame.filename
+        if filename in WRAPPER_FILES or filename.startswith(DJANGO_ROOT) or 'site-packages' in filename:
+            continue
+        if filename.startswith(base_dir):
+            return f'{Path(filename).relative_to(base_dir)}:{frame.lineno} in {frame.name}'
+    return 'неизвестно'
+
+
+class QueryInspector:
+    """Счётчик запросов одного HTTP-запроса; с ``track_shapes`` ищет N+1."""
+
+    def __init__(self, track_shapes=False):
+        self.count = 0
+        self.track_shapes = track_shapes
+        self.shapes = Counter()
+        self.repeated = {}
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        if self.track_shapes:
+            shape = sql_shape(sql)
+            self.shapes[shape] += 1
+            if self.shapes[shape] == nplusone_threshold():
+                self.repeated[shape] = call_site()
+        return execute(sql, params, many, context)
+
+    def report(self, view):
+        for shape, site in self.repeated.items():
+            logger.warning(
+                'Возможный N+1 в %s: запрос повторён %s раз, вызов из %s: %s',
+                view, self.shapes[shape], site, shape,
+            )
+
+
+class QueryBudgetMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        inspector = QueryInspector(track_shapes=inspection_enabled())
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(inspector))
+            response = self.get_response(request)
+
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match else request.path
+        inspector.report(view)
+        budget = budget_for(request)
+        if budget is not None and inspector.count > budget:
+            message = f'{view}: {inspector.count} SQL-запросов при бюджете {budget}'
+            if getattr(settings, 'QUERY_BUDGETS_STRICT', False):
+                raise QueryBudgetExceeded(message)
+            logger.warning(message)
+        return response
@@ -0,0 +1,128 @@
+"""Отметки о прочтении тем.
+
+Просмотр страницы темы не пишет в БД сразу: отметка попадает в буфер
+процесса, а буфер сбрасывается одним upsert-запросом, когда набирается
+``READ_MARKERS_BATCH_SIZE`` отметок или проходит ``READ_MARKERS_FLUSH_INTERVAL``
+секунд. Отметка только растёт: при конфликте берётся максимум из старого
+и нового значения.
+
+Буфер у каждого процесса свой, поэтому состояние «прочитано» согласуется
+с задержкой: пока отметка не записана, другие воркеры gunicorn показывают
+тему непрочитанной. Если запись не удалась, пачка возвращается в буфер и
+уйдёт со следующим сбросом. Отметки процесса, убитого без atexit (SIGKILL,
+OOM), теряются — тема снова станет прочитанной при следующем просмотре.
+"""
+import atexit
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import Thread, ThreadReadMarker
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_pending = {}
+_last_flush = time.monotonic()
+
+
+def _batch_size():
+    return getattr(settings, 'READ_MARKERS_BATCH_SIZE', 200)
+
+
+def _flush_interval():
+    return getattr(settings, 'READ_MARKERS_FLUSH_INTERVAL', 10)
+
+
+def mark_read(user_id, thread_id, post_id):
+    """Запомнить, что пользователь дочитал тему до сообщения ``post_id``."""
+    key = (user_id, thread_id)
+    with _lock:
+        if post_id > _pending.get(key, 0):
+            _pending[key] = post_id
+        due = len(_pending) >= _batch_size() or time.monotonic() - _last_flush >= _flush_interval()
+    if due:
+        # Пишем после коммита запроса, чтобы откат не потерял чужие отметки.
+        transaction.on_commit(flush)
+
+
+def pending_markers(user_id):
+    """Ещё не записанные отметки пользователя: {thread_id: post_id}."""
+    with _lock:
+        return {thread_id: post_id for (uid, thread_id), post_id in _pending.items() if uid == user_id}
+
+
+def get_last_read(user_id, thread_id):
+    """Последнее прочитанное сообщение с учётом буфера (или None)."""
+    stored = ThreadReadMarker.objects.filter(user_id=user_id, thread_id=thread_id)\
+        .values_list('last_read_post_id', flat=True).first()
+    pending = pending_markers(user_id).get(thread_id)
+    values = [value for value in (stored, pending) if value is not None]
+    return max(values) if values else None
+
+
+def _upsert_sql(rows):
+    table = ThreadReadMarker._meta.db_table
+    greatest = 'MAX' if connection.vendor == 'sqlite' else 'GREATEST'
+    placeholders = ', '.join(['(%s, %s, %s, %s)'] * len(rows))
+    return (
+        f'INSERT INTO {table} (user_id, thread_id, last_read_post_id, updated_at) VALUES {placeholders} '
+        f'ON CONFLICT (user_id, thread_id) DO UPDATE SET '
+        f'last_read_post_id = {greatest}({table}.last_read_post_id, EXCLUDED.last_read_post_id), '
+        f'updated_at = EXCLUDED.updated_at'
+    )
+
+
+def _requeue(batch):
+    """Вернуть незаписанную пачку в буфер, не уменьшая более новые отметки."""
+    with _lock:
+        for key, post_id in batch.items():
+            if post_id > _pending.get(key, 0):
+                _pending[key] = post_id
+
+
+def flush():
+    """Записать буфер отметок одним запросом. Возвращает число отметок."""
+    global _pending, _last_flush
+    with _lock:
+        batch, _pending = _pending, {}
+        _last_flush = time.monotonic()
+    if not batch:
+        return 0
+
+    # flush() вызывается и из atexit, поэтому ошибки базы только логируются.
+    try:
+        # Темы могли удалить, пока отметки лежали в буфере.
+        alive = set(Thread.objects.filter(id__in={thread_id for _, thread_id in batch})
+                    .values_list('id', flat=True))
+        now = timezone.now()
+        rows = [
+            (user_id, thread_id, post_id, now)
+            for (user_id, thread_id), post_id in batch.items()
+            if thread_id in alive
+        ]
+        if not rows:
+            return 0
+        params = [value for row in rows for value in row]
+        with connection.cursor() as cursor:
+            cursor.execute(_upsert_sql(rows), params)
+    except Exception:
+        logger.exception('Не удалось записать отметки о прочтении (%d шт.)', len(batch))
+        _requeue(batch)
+        return 0
+    return len(rows)
+
+
+def reset():
+    """Забыть буфер без записи (для тестов)."""
+    global _pending, _last_flush
+    with _lock:
+        _pending = {}
+        _last_flush = time.monotonic()
+
+
+atexit.register(flush)
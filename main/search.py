@@ -0,0 +1,336 @@
+"""Полнотекстовый поиск по темам и сообщениям.
+
+На PostgreSQL у таблиц ``main_thread`` и ``main_post`` есть колонка
+``search_vector`` (tsvector с русской и английской конфигурациями) и GIN-индекс.
+На SQLite используется виртуальная таблица FTS5 ``main_search_fts``.
+Обе схемы создаются миграцией 0008 и обновляются сигналами при создании
+и редактировании; полная перестройка — команда ``rebuild_search_index``.
+"""
+import re
+
+from django.db import connection
+
+from .models import Thread, Post
+
+KIND_THREAD = 'thread'
+KIND_POST = 'post'
+
+WORD_PATTERN = re.compile(r'\w+', re.UNICODE)
+
+
+class SearchHit:
+    """Найденный объект: тема или сообщение с рангом."""
+
+    def __init__(self, kind, object_id, rank):
+        self.kind = kind
+        self.object_id = object_id
+        self.rank = rank
+        self.object = None
+
+    @property
+    def is_thread(self):
+        return self.kind == KIND_THREAD
+
+
+class PostgresSearchBackend:
+    """tsvector + GIN, ранжирование через ts_rank."""
+
+    CONFIGS = ('russian', 'english')
+
+    def _vector_sql(self, column, weight):
+        parts = [
+            f"setweight(to_tsvector('{config}', coalesce({column}, '')), '{weight}')"
+            for config in self.CONFIGS
+        ]
+        return ' || '.join(parts)
+
+    def _query_cte(self):
+        tsqueries = ' || '.join(f"websearch_to_tsquery('{config}', %s)" for config in self.CONFIGS)
+        return f'WITH q AS (SELECT ({tsqueries}) AS query)'
+
+    def _query_params(self, query):
+        return [query] * len(self.CONFIGS)
+
+    def install(self, cursor):
+        for table in (Thread._meta.db_table, Post._meta.db_table):
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS search_vector tsvector')
+            cursor.execute(
+                f'CREATE INDEX IF NOT EXISTS {table}_search_gin ON {table} USING gin (search_vector)'
+            )
+
+    def uninstall(self, cursor):
+        for table in (Thread._meta.db_table, Post._meta.db_table):
+            cursor.execute(f'DROP INDEX IF EXISTS {table}_search_gin')
+            cursor.execute(f'ALTER TABLE {table} DROP COLUMN IF EXISTS search_vector')
+
+    def index_threads(self, cursor, ids=None, id_range=None):
+        self._update(cursor, Thread._meta.db_table, self._vector_sql('title', 'A'), ids, id_range)
+
+    def index_posts(self, cursor, ids=None, id_range=None):
+        self._update(cursor, Post._meta.db_table, self._vector_sql('text', 'B'), ids, id_range)
+
+    def _update(self, cursor, table, vector_sql, ids, id_range):
+        sql = f'UPDATE {table} SET search_vector = {vector_sql}'
+        if ids is not None:
+            cursor.execute(f'{sql} WHERE id = ANY(%s)', [list(ids)])
+        else:
+            cursor.execute(f'{sql} WHERE id BETWEEN %s AND %s', list(id_range))
+
+    def remove(self, cursor, kind, ids):
+        # Колонка удаляется вместе со строкой.
+        pass
+
+    def remove_matching(self, cursor, kind, where, params):
+        """Убрать из поиска ещё не удалённые строки (тема или автор скрыты)."""
+        table = (Thread if kind == KIND_THREAD else Post)._meta.db_table
+        cursor.execute(f'UPDATE {table} SET search_vector = NULL WHERE {where}', params)
+
+    def search(self, cursor, query, limit, offset):
+        cursor.execute(
+            f"""
+            {self._query_cte()}
+            SELECT kind, id, rank FROM (
+                SELECT '{KIND_THREAD}' AS kind, t.id, ts_rank(t.search_vector, q.query) AS rank, t.created_at
+                FROM {Thread._meta.db_table} t, q
+                WHERE t.search_vector @@ q.query
+                UNION ALL
+                SELECT '{KIND_POST}' AS kind, p.id, ts_rank(p.search_vector, q.query) AS rank, p.created_at
+                FROM {Post._meta.db_table} p, q
+                WHERE p.search_vector @@ q.query
+            ) hits
+            ORDER BY rank DESC, created_at DESC
+            LIMIT %s OFFSET %s
+            """,
+            [*self._query_params(query), limit, offset],
+        )
+        return [SearchHit(kind, object_id, rank) for kind, object_id, rank in cursor.fetchall()]
+
+    def count(self, cursor, query):
+        cursor.execute(
+            f"""
+            {self._query_cte()}
+            SELECT
+                (SELECT count(*) FROM {Thread._meta.db_table} t, q WHERE t.search_vector @@ q.query)
+              + (SELECT count(*) FROM {Post._meta.db_table} p, q WHERE p.search_vector @@ q.query)
+            """,
+            self._query_params(query),
+        )
+        return cursor.fetchone()[0]
+
+
+class SqliteSearchBackend:
+    """FTS5 с ранжированием bm25; ключ документа закодирован в rowid."""
+
+    TABLE = 'main_search_fts'
+
+    @staticmethod
+    def _rowid(kind, object_id):
+        return object_id * 2 + (1 if kind == KIND_THREAD else 0)
+
+    @staticmethod
+    def _decode(rowid):
+        return (KIND_THREAD if rowid % 2 else KIND_POST), rowid // 2
+
+    def install(self, cursor):
+        cursor.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {self.TABLE} "
+            "USING fts5(body, tokenize='unicode61 remove_diacritics 2')"
+        )
+
+    def uninstall(self, cursor):
+        cursor.execute(f'DROP TABLE IF EXISTS {self.TABLE}')
+
+    def index_threads(self, cursor, ids=None, id_range=None):
+        self._reindex(cursor, KIND_THREAD, Thread._meta.db_table, 'title', ids, id_range)
+
+    def index_posts(self, cursor, ids=None, id_range=None):
+        self._reindex(cursor, KIND_POST, Post._meta.db_table, 'text', ids, id_range)
+
+    def _reindex(self, cursor, kind, table, column, ids, id_range):
+        parity = 1 if kind == KIND_THREAD else 0
+        if ids is not None:
+            ids = list(ids)
+            self.remove(cursor, kind, ids)
+            where, params = f"id IN ({', '.join(['%s'] * len(ids))})", ids
+        else:
+            # Заодно убираем документы удалённых объектов из диапазона.
+            cursor.execute(
+                f'DELETE FROM {self.TABLE} WHERE rowid BETWEEN %s AND %s AND rowid %% 2 = %s',
+                [self._rowid(kind, id_range[0]), self._rowid(kind, id_range[1]), parity],
+            )
+            where, params = 'id BETWEEN %s AND %s', list(id_range)
+        cursor.execute(
+            f'INSERT INTO {self.TABLE} (rowid, body) '
+            f"SELECT id * 2 + {parity}, coalesce({column}, '') FROM {table} WHERE {where}",
+            params,
+        )
+
+    def remove(self, cursor, kind, ids):
+        rowids = [self._rowid(kind, object_id) for object_id in ids]
+        if rowids:
+            placeholders = ', '.join(['%s'] * len(rowids))
+            cursor.execute(f'DELETE FROM {self.TABLE} WHERE rowid IN ({placeholders})', rowids)
+
+    def remove_matching(self, cursor, kind, where, params):
+        """Убрать из поиска документы строк, подходящих под условие ``where``."""
+        parity = 1 if kind == KIND_THREAD else 0
+        table = (Thread if kind == KIND_THREAD else Post)._meta.db_table
+        cursor.execute(
+            f'DELETE FROM {self.TABLE} WHERE rowid IN (SELECT id * 2 + {parity} FROM {table} WHERE {where})',
+            params,
+        )
+
+    def _match_expression(self, query):
+        # Каждое слово — отдельная префиксная фраза; операторы FTS5 из
+        # пользовательского ввода не пропускаются.
+        words = WORD_PATTERN.findall(query)
+        return ' '.join(f'"{word}"*' for word in words)
+
+    def search(self, cursor, query, limit, offset):
+        expression = self._match_expression(query)
+        if not expression:
+            return []
+        cursor.execute(
+            f'SELECT rowid, bm25({self.TABLE}) AS rank FROM {self.TABLE} '
+            f'WHERE {self.TABLE} MATCH %s ORDER BY rank, rowid DESC LIMIT %s OFFSET %s',
+            [expression, limit, offset],
+        )
+        hits = []
+        for rowid, rank in cursor.fetchall():
+            kind, object_id = self._decode(rowid)
+            # bm25 тем лучше, чем меньше; приводим к «больше — лучше».
+            hits.append(SearchHit(kind, object_id, -rank))
+        return hits
+
+    def count(self, cursor, query):
+        expression = self._match_expression(query)
+        if not expression:
+            return 0
+        cursor.execute(f'SELECT count(*) FROM {self.TABLE} WHERE {self.TABLE} MATCH %s', [expression])
+        return cursor.fetchone()[0]
+
+
+BACKENDS = {
+    'postgresql': PostgresSearchBackend,
+    'sqlite': SqliteSearchBackend,
+}
+
+
+def get_backend(using=None):
+    """Поисковый бэкенд для текущей БД или None, если поиск не поддерживается."""
+    vendor = (using or connection).vendor
+    backend_class = BACKENDS.get(vendor)
+    return backend_class() if backend_class else None
+
+
+def index_thread(thread_id):
+    backend = get_backend()
+    if backend:
+        with connection.cursor() as cursor:
+            backend.index_threads(cursor, ids=[thread_id])
+
+
+def index_post(post_id):
+    backend = get_backend()
+    if backend:
+        with connection.cursor() as cursor:
+            backend.index_posts(cursor, ids=[post_id])
+
+
+def remove_thread(thread_id):
+    backend = get_backend()
+    if backend:
+        with connection.cursor() as cursor:
+            backend.remove(cursor, KIND_THREAD, [thread_id])
+
+
+def remove_post(post_id):
+    backend = get_backend()
+    if backend:
+        with connection.cursor() as cursor:
+            backend.remove(cursor, KIND_POST, [post_id])
+
+
+def hide_threads(thread_ids):
+    """Убрать из поиска скрытые темы вместе с их сообщениями (до фоновой очистки)."""
+    backend = get_backend()
+    thread_ids = list(thread_ids)
+    if backend and thread_ids:
+        placeholders = ', '.join(['%s'] * len(thread_ids))
+        with connection.cursor() as cursor:
+            backend.remove_matching(cursor, KIND_THREAD, f'id IN ({placeholders})', thread_ids)
+            backend.remove_matching(cursor, KIND_POST, f'thread_id IN ({placeholders})', thread_ids)
+
+
+def hide_author_posts(user_id):
+    """Убрать из поиска все сообщения автора."""
+    backend = get_backend()
+    if backend:
+        with connection.cursor() as cursor:
+            backend.remove_matching(cursor, KIND_POST, 'author_id = %s', [user_id])
+
+
+def rebuild(batch_size=5000, stdout=None):
+    """Перестроить индекс целиком, диапазонами id по ``batch_size``."""
+    backend = get_backend()
+    if backend is None:
+        return 0
+    total = 0
+    for model, index in ((Thread, backend.index_threads), (Post, backend.index_posts)):
+        last_id = model.objects.order_by('-id').values_list('id', flat=True).first() or 0
+        for start in range(1, last_id + 1, batch_size):
+            with connection.cursor() as cursor:
+                index(cursor, id_range=(start, start + batch_size - 1))
+        total += model.objects.count()
+        if stdout:
+            stdout.write(f'{model._meta.verbose_name_plural}: проиндексировано до id {last_id}')
+    return total
+
+
+class SearchResults:
+    """Ленивая выборка результатов поиска для Paginator.
+
+    Paginator вызывает ``count()`` и срез ``[offset:offset + limit]``;
+    на срез выполняется один поисковый запрос и по одному запросу
+    на загрузку тем и сообщений.
+    """
+
+    def __init__(self, query):
+        self.query = query
+        self.backend = get_backend()
+        self._count = None
+
+    def count(self):
+        if self._count is None:
+            if self.backend is None or not self.query:
+                self._count = 0
+            else:
+                with connection.cursor() as cursor:
+                    self._count = self.backend.count(cursor, self.query)
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice):
+            raise TypeError('SearchResults поддерживает только срезы')
+        offset = item.start or 0
+        limit = (item.stop if item.stop is not None else self.count()) - offset
+        if self.backend is None or not self.query or limit <= 0:
+            return []
+        with connection.cursor() as cursor:
+            hits = self.backend.search(cursor, self.query, limit, offset)
+        self._attach_objects(hits)
+        return [hit for hit in hits if hit.object is not None]
+
+    @staticmethod
+    def _attach_objects(hits):
+        thread_ids = [hit.object_id for hit in hits if hit.kind == KIND_THREAD]
+        post_ids = [hit.object_id for hit in hits if hit.kind == KIND_POST]
+        threads = Thread.objects.select_related('author', 'subsection__section').in_bulk(thread_ids)
+        posts = Post.objects.select_related('author', 'thread')\
+            .filter(thread__deleted_at__isnull=True).in_bulk(post_ids)
+        for hit in hits:
+            source = threads if hit.kind == KIND_THREAD else posts
+            hit.object = source.get(hit.object_id)
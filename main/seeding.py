@@ -0,0 +1,341 @@
+"""Генерация синтетических данных для нагрузочных проверок.
+
+Объёмы задаются ``SeedVolumes``; строки создаются генераторами и пишутся
+``bulk_create`` пачками по ``batch_size``, поэтому память не растёт с
+объёмом: в памяти держатся только id пользователей, записей стены и
+число сообщений на тему/диалог (массивы ``array``). Распределения
+«тяжёлые»: несколько тем и пользователей дают большую часть сообщений.
+
+Сигналы при ``bulk_create`` не срабатывают, поэтому в конце пересчитываются
+счётчики форума и профилей, последние сообщения тем и диалогов и (по
+желанию) поисковый индекс.
+"""
+import random
+import time
+from array import array
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone as dt_timezone
+from itertools import islice
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import OuterRef, Subquery
+from django.utils import timezone
+
+from . import search, sharding, stats
+from .caching import bump_home_version
+from .emoji import EMOJI_MAP
+from .models import (
+    Conversation, Message, Post, Profile, Section, Subsection, Thread, WallComment, WallPost,
+)
+
+WORDS = (
+    'форум тема сообщение ответ вопрос вариант решение проблема код настройка сервер запрос '
+    'база данных индекс страница профиль аватар картинка ссылка модератор правила раздел '
+    'спасибо привет кстати например думаю кажется работает ошибка обновление версия быстро '
+    'медленно нагрузка кэш память диск сеть пользователь читать писать смотреть пробовать '
+    'очень просто сложно можно нужно сегодня вчера завтра всегда иногда никогда почему'
+).split()
+EMOJI_CODES = tuple(EMOJI_MAP)
+
+
+@dataclass
+class SeedVolumes:
+    users: int = 1000
+    sections: int = 5
+    subsections: int = 4  # на раздел
+    threads: int = 2000
+    posts: int = 50_000
+    wall_posts: int = 5000
+    comments: int = 10_000
+    conversations: int = 2000
+    messages: int = 50_000
+    days: int = 365
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def skewed_counts(total, buckets, rng, minimum=0, alpha=1.2):
+    """Разбить ``total`` на ``buckets`` частей по распределению Парето."""
+    if not buckets:
+        return array('q')
+    minimum = min(minimum, total // buckets)
+    weights = [rng.paretovariate(alpha) for _ in range(buckets)]
+    scale = (total - minimum * buckets) / sum(weights)
+    counts = array('q', (minimum + int(weight * scale) for weight in weights))
+    for index in rng.choices(range(buckets), weights=weights, k=total - sum(counts)):
+        counts[index] += 1
+    return counts
+
+
+@contextmanager
+def explicit_timestamps(*models):
+    """Временно отключить auto_now/auto_now_add, чтобы задавать даты в прошлом."""
+    saved = []
+    for model in models:
+        for field in model._meta.concrete_fields:
+            if getattr(field, 'auto_now', False) or getattr(field, 'auto_now_add', False):
+                saved.append((field, field.auto_now, field.auto_now_add))
+                field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, auto_now, auto_now_add in saved:
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
+
+
+class Seeder:
+    def __init__(self, volumes, batch_size=5000, seed=None, prefix='seed', password='password', stdout=None):
+        self.volumes = volumes
+        self.batch_size = batch_size
+        self.rng = random.Random(seed)
+        self.prefix = prefix
+        self.password = password
+        self.stdout = stdout
+        self.now = timezone.now()
+        self.period = timedelta(days=volumes.days).total_seconds()
+
+    # --------------------------------------------------------------------------
+    # Вспомогательное
+
+    def log(self, message):
+        if self.stdout:
+            self.stdout.write(message)
+
+    def text(self, min_words=3, max_words=60):
+        length = min(max_words, min_words + int(self.rng.paretovariate(1.5) * min_words))
+        words = self.rng.choices(WORDS, k=length)
+        words[0] = words[0].capitalize()
+        for _ in range(self.rng.randrange(3)):
+            if self.rng.random() < 0.3:
+                words.insert(self.rng.randrange(len(words) + 1), f':{self.rng.choice(EMOJI_CODES)}:')
+        if length > 25 and self.rng.random() < 0.5:
+            words.insert(length // 2, '.\n')
+        return ' '.join(words) + '.'
+
+    def moment(self, after=None):
+        """Случайный момент за период (или между ``after`` и сейчас)."""
+        start = after or self.now - timedelta(seconds=self.period)
+        return start + (self.now - start) * self.rng.random()
+
+    def insert(self, model, rows, label, collect_ids=False):
+        """Вставить строки пачками; вернуть их id (если нужно) и число строк."""
+        ids = array('q')
+        total = 0
+        started = time.monotonic()
+        for batch in chunked(rows, self.batch_size):
+            created = model.objects.bulk_create(batch)
+            if collect_ids:
+                ids.extend(obj.pk for obj in created)
+            total += len(batch)
+        self.log(f'{label}: {total} за {time.monotonic() - started:.1f} с')
+        return ids, total
+
+    def pick_user(self):
+        return self.rng.choices(self.user_ids, cum_weights=self.user_weights, k=1)[0]
+
+    # --------------------------------------------------------------------------
+    # Этапы
+
+    def seed_users(self):
+        if User.objects.filter(username__startswith=f'{self.prefix}_').exists():
+            raise ValueError(f'Пользователи с префиксом «{self.prefix}_» уже есть')
+        password = make_password(self.password)
+        users = (
+            User(username=f'{self.prefix}_{i}', password=password, email=f'{self.prefix}_{i}@example.com',
+                 date_joined=self.moment())
+            for i in range(self.volumes.users)
+        )
+        self.user_ids, _ = self.insert(User, users, 'Пользователи', collect_ids=True)
+        profiles = (
+            Profile(user_id=user_id, bio=self.text(2, 20) if self.rng.random() < 0.3 else '',
+                    created_at=self.now, updated_at=self.now)
+            for user_id in self.user_ids
+        )
+        self.insert(Profile, profiles, 'Профили')
+        # Активность пользователей тоже «тяжёлая»: накопленные веса для choices().
+        weights = skewed_counts(self.volumes.users * 100, self.volumes.users, self.rng, minimum=1)
+        total = 0
+        self.user_weights = array('q')
+        for weight in weights:
+            total += weight
+            self.user_weights.append(total)
+
+    def seed_sections(self):
+        existing = Section.objects.count()
+        sections = [
+            Section(title=f'{self.prefix} раздел {existing + i}', description=self.text(3, 12),
+                    order=existing + i, created_at=self.now)
+            for i in range(self.volumes.sections)
+        ]
+        Section.objects.bulk_create(sections)
+        subsections = [
+            Subsection(section=section, title=f'Подраздел {j}', description=self.text(3, 12),
+                       order=j, created_at=self.now)
+            for section in sections for j in range(self.volumes.subsections)
+        ]
+        Subsection.objects.bulk_create(subsections)
+        self.subsection_ids = [subsection.pk for subsection in subsections]
+        self.log(f'Разделы: {len(sections)}, подразделы: {len(subsections)}')
+
+    def seed_threads(self):
+        volumes = self.volumes
+        post_counts = skewed_counts(volumes.posts, volumes.threads, self.rng, minimum=1)
+        subsection_weights = [self.rng.paretovariate(1.5) for _ in self.subsection_ids]
+        thread_total = post_total = 0
+        started = time.monotonic()
+        for offset in range(0, volumes.threads, self.batch_size):
+            counts = post_counts[offset:offset + self.batch_size]
+            threads = [
+                Thread(
+                    title=self.text(2, 10)[:200],
+                    author_id=self.pick_user(),
+                    subsection_id=self.rng.choices(self.subsection_ids, weights=subsection_weights, k=1)[0],
+                    created_at=self.moment(),
+                    is_pinned=self.rng.random() < 0.01,
+                    views_count=count * self.rng.randint(3, 30),
+                )
+                for count in counts
+            ]
+            for thread in threads:
+                thread.last_reply_at = thread.created_at
+            Thread.objects.bulk_create(threads)
+            for batch in chunked(self._posts(threads, counts), self.batch_size):
+                Post.objects.bulk_create(batch)
+                post_total += len(batch)
+            self._refresh_threads([thread.pk for thread in threads])
+            thread_total += len(threads)
+        self.log(f'Темы: {thread_total}, сообщения: {post_total} за {time.monotonic() - started:.1f} с')
+
+    def _posts(self, threads, counts):
+        for thread, count in zip(threads, counts):
+            moment = thread.created_at
+            step = (self.now - moment) / (count + 1)
+            for i in range(count):
+                author_id = thread.author_id if i == 0 else self.pick_user()
+                yield Post(thread_id=thread.pk, author_id=author_id, text=self.text(),
+                           created_at=moment, updated_at=moment)
+                moment = min(self.now, moment + step * self.rng.expovariate(1))
+
+    def _refresh_threads(self, thread_ids):
+        last_post = Post.objects.filter(thread_id=OuterRef('pk')).order_by('-created_at', '-id')
+        Thread.all_objects.filter(id__in=thread_ids).update(
+            last_post_id=Subquery(last_post.values('id')[:1]),
+            last_reply_at=Subquery(last_post.values('created_at')[:1]),
+        )
+
+    def seed_wall(self):
+        wall_times = array('d')
+
+        def wall_posts():
+            for _ in range(self.volumes.wall_posts):
+                moment = self.moment()
+                wall_times.append(moment.timestamp())
+                yield WallPost(owner_id=self.pick_user(), author_id=self.pick_user(), body=self.text(),
+                               created_at=moment, updated_at=moment)
+
+        wall_ids, _ = self.insert(WallPost, wall_posts(), 'Записи стены', collect_ids=True)
+        if not wall_ids:
+            return
+        comment_counts = skewed_counts(self.volumes.comments, len(wall_ids), self.rng)
+
+        def comments():
+            for wall_id, posted, count in zip(wall_ids, wall_times, comment_counts):
+                after = datetime.fromtimestamp(posted, dt_timezone.utc)
+                for _ in range(count):
+                    moment = self.moment(after)
+                    yield WallComment(post_id=wall_id, author_id=self.pick_user(), body=self.text(1, 30),
+                                      created_at=moment, updated_at=moment)
+
+        self.insert(WallComment, comments(), 'Комментарии')
+
+    def seed_conversations(self):
+        volumes = self.volumes
+        pairs = set()
+        limit = len(self.user_ids) * (len(self.user_ids) - 1) // 2
+        while len(pairs) < min(volumes.conversations, limit):
+            first, second = self.pick_user(), self.pick_user()
+            if first != second:
+                pairs.add((min(first, second), max(first, second)))
+        pairs = list(pairs)
+        message_counts = skewed_counts(volumes.messages, len(pairs), self.rng, minimum=1)
+        through = Conversation.participants.through
+        message_total = 0
+        started = time.monotonic()
+        if sharding.enabled():
+            sharding.sync_conversation_keys()
+        for offset in range(0, len(pairs), self.batch_size):
+            batch_pairs = pairs[offset:offset + self.batch_size]
+            counts = message_counts[offset:offset + self.batch_size]
+            # При шардировании id выдаёт основная база, по id диалог попадает на свой шард.
+            if sharding.enabled():
+                conversation_ids = sharding.allocate_conversation_ids(len(batch_pairs))
+            else:
+                conversation_ids = [None] * len(batch_pairs)
+            by_shard = {}
+            for conversation_id, pair, count in zip(conversation_ids, batch_pairs, counts):
+                moment = self.moment()
+                conversation = Conversation(id=conversation_id, created_at=moment, updated_at=moment)
+                alias = sharding.shard_for(conversation_id) if conversation_id else DEFAULT_DB_ALIAS
+                by_shard.setdefault(alias, []).append((conversation, pair, count))
+            for alias, items in by_shard.items():
+                conversations, shard_pairs, shard_counts = (list(column) for column in zip(*items))
+                Conversation.objects.using(alias).bulk_create(conversations)
+                through.objects.using(alias).bulk_create([
+                    through(conversation_id=conversation.pk, user_id=user_id)
+                    for conversation, pair in zip(conversations, shard_pairs) for user_id in pair
+                ])
+                for batch in chunked(self._messages(conversations, shard_pairs, shard_counts), self.batch_size):
+                    Message.objects.using(alias).bulk_create(batch)
+                    message_total += len(batch)
+                last_message = Message.objects.using(alias).filter(conversation_id=OuterRef('pk'))\
+                    .order_by('-created_at')
+                Conversation.objects.using(alias).filter(id__in=[c.pk for c in conversations]).update(
+                    last_message_at=Subquery(last_message.values('created_at')[:1]),
+                )
+        self.log(f'Диалоги: {len(pairs)}, сообщения: {message_total} за {time.monotonic() - started:.1f} с')
+
+    def _messages(self, conversations, pairs, counts):
+        for conversation, pair, count in zip(conversations, pairs, counts):
+            moment = conversation.created_at
+            step = (self.now - moment) / (count + 1)
+            # Последние несколько сообщений диалога — непрочитанные.
+            unread_from = count - self.rng.choice((0, 0, 0, 1, 2, 5))
+            for i in range(count):
+                sender, recipient = pair if self.rng.random() < 0.5 else pair[::-1]
+                is_read = i < unread_from
+                yield Message(conversation_id=conversation.pk, sender_id=sender, recipient_id=recipient,
+                              body=self.text(1, 25), created_at=moment, is_read=is_read,
+                              read_at=moment + timedelta(minutes=5) if is_read else None)
+                moment = min(self.now, moment + step * self.rng.expovariate(1))
+
+    def finish(self, rebuild_search=True):
+        stats.reconcile()
+        stats.reconcile_profile_counters(self.batch_size)
+        self.log('Счётчики пересчитаны')
+        if rebuild_search:
+            search.rebuild(self.batch_size, stdout=self.stdout)
+        bump_home_version()
+
+    def run(self, rebuild_search=True):
+        with explicit_timestamps(Profile, Section, Subsection, Thread, Post, WallPost, WallComment,
+                                 Conversation, Message):
+            self.seed_users()
+            self.seed_sections()
+            self.seed_threads()
+            self.seed_wall()
+            self.seed_conversations()
+        self.finish(rebuild_search)
+
+
+def seed(volumes, batch_size=5000, seed=None, prefix='seed', password='password', rebuild_search=True, stdout=None):
+    """Заполнить базу синтетическими данными объёмом ``volumes``."""
+    seeder = Seeder(volumes, batch_size=batch_size, seed=seed, prefix=prefix, password=password, stdout=stdout)
+    seeder.run(rebuild_search=rebuild_search)
+    return seeder
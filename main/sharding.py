@@ -0,0 +1,291 @@
+"""Шардирование личных сообщений по id диалога.
+
+``Conversation`` и всё, что к нему относится (участники, ``Message``,
+``TypingStatus``, ``MessageArchive``), лежит на одном шарде — алиасе из
+``MESSAGE_SHARDS``, который выбирает ``shard_for(conversation_id)``.
+Выбор — rendezvous hashing: у каждого шарда свой хеш от id, побеждает
+наибольший. Хеш стабилен между процессами и версиями, а при добавлении
+шарда переезжает только ~1/N диалогов (команда ``rebalance_message_shards``).
+
+Пользователи остаются в основной базе, поэтому запросы не соединяют
+таблицы диалогов с ``auth_user``: отправители подгружаются через
+``prefetch_related('sender')``, участники — ``attach_participants()``.
+Id диалогов выдаёт ``ConversationKey`` в основной базе, чтобы они были
+уникальны на всех шардах. Пока шардирование выключено, id по-прежнему
+выдаёт таблица диалогов; при включении ``sync_conversation_keys()``
+продвигает ключи за уже выданные id.
+
+``ShardRouter`` направляет запросы по подсказке ``instance`` (объект диалога
+или объект с ``conversation_id``): связанные менеджеры
+(``conversation.messages``) и ``save()`` попадают на нужный шард сами.
+Запросы без подсказки явно выбирают шард (``.using(shard_for(id))``,
+``conversations()``), а «по всем диалогам пользователя» — обходят все
+шарды (``fan_out()``).
+
+Без ``MESSAGE_SHARDS`` единственный шард — ``default``, маршрутизатор
+ничего не меняет. Админка показывает только ``default``. Проверено на
+шардах SQLite (local.py); на PostgreSQL шарды пока не разворачивались,
+и production.py их не включает.
+"""
+import hashlib
+from itertools import chain
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.color import no_style
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, connections, transaction
+from django.db.models import Count, Max
+from django.http import Http404
+
+from .models import Conversation, ConversationKey, Message, MessageArchive, TypingStatus
+
+SHARDED_MODELS = frozenset({
+    'conversation', 'conversation_participants', 'message', 'typingstatus', 'messagearchive',
+})
+# Таблицы пользователей на шардах остаются пустыми: на ``auth_user`` ссылаются
+# внешние ключи ранних миграций (0002, 0003), и без неё PostgreSQL не создаст
+# таблицы диалогов. Миграция 0018 эти ограничения снимает.
+SHARD_SUPPORT_APPS = frozenset({'auth', 'contenttypes'})
+Participant = Conversation.participants.through
+
+
+def enabled():
+    return bool(getattr(settings, 'MESSAGE_SHARDS', ()))
+
+
+def shards():
+    return list(getattr(settings, 'MESSAGE_SHARDS', ())) or [DEFAULT_DB_ALIAS]
+
+
+def _weight(alias, conversation_id):
+    return hashlib.blake2b(f'{alias}:{conversation_id}'.encode(), digest_size=8).digest()
+
+
+def shard_for(conversation_id, aliases=None):
+    """Шард диалога (rendezvous hashing)."""
+    aliases = aliases or shards()
+    if len(aliases) == 1:
+        return aliases[0]
+    return max(aliases, key=lambda alias: _weight(alias, conversation_id))
+
+
+def is_sharded(model):
+    return model._meta.app_label == 'main' and model._meta.model_name in SHARDED_MODELS
+
+
+def _conversation_id(instance):
+    if isinstance(instance, Conversation):
+        return instance.pk
+    return getattr(instance, 'conversation_id', None)
+
+
+class ShardRouter:
+    """Ставится перед ReplicaRouter: несшардированные модели пропускает дальше."""
+
+    def _shard(self, model, hints):
+        if not enabled() or not is_sharded(model):
+            return None
+        instance = hints.get('instance')
+        if instance is not None and is_sharded(instance):
+            # Уже загруженный объект остаётся там, где лежит (важно на время ребалансировки).
+            if instance._state.db:
+                return instance._state.db
+            conversation_id = _conversation_id(instance)
+            if conversation_id is not None:
+                return shard_for(conversation_id)
+        return DEFAULT_DB_ALIAS
+
+    def db_for_read(self, model, **hints):
+        return self._shard(model, hints)
+
+    def db_for_write(self, model, **hints):
+        return self._shard(model, hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Ссылки на пользователей из шардов — нормальная межбазовая связь.
+        if enabled() and (is_sharded(obj1) or is_sharded(obj2)):
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if not enabled() or db == DEFAULT_DB_ALIAS or db not in shards():
+            return None
+        # На отдельных шардах — только таблицы личных сообщений (и пустые таблицы пользователей).
+        if app_label in SHARD_SUPPORT_APPS:
+            return True
+        return app_label == 'main' and model_name in SHARDED_MODELS
+
+
+# --- Запросы к шардам -----------------------------------------------------
+
+def conversations(conversation_id):
+    return Conversation.objects.using(shard_for(conversation_id))
+
+
+def fan_out(build):
+    """``build(alias)`` для каждого шарда: [(alias, результат)]."""
+    return [(alias, build(alias)) for alias in shards()]
+
+
+def get_conversation(conversation_id, user):
+    """Диалог пользователя или None.
+
+    Сначала ищется на своём шарде, затем — на остальных: во время
+    ребалансировки диалог ещё может лежать на прежнем месте.
+    """
+    primary = shard_for(conversation_id)
+    for alias in [primary, *(alias for alias in shards() if alias != primary)]:
+        conversation = Conversation.objects.using(alias).filter(id=conversation_id, participants=user).first()
+        if conversation is not None:
+            return conversation
+    return None
+
+
+def get_conversation_or_404(conversation_id, user):
+    conversation = get_conversation(conversation_id, user)
+    if conversation is None:
+        raise Http404('Диалог не найден')
+    return conversation
+
+
+def find_conversation_between(user, other_user):
+    """Диалог 1-на-1 двух пользователей на любом шарде."""
+    for alias in shards():
+        # Счётчик — до фильтров по участникам, иначе он считает по их JOIN (всегда 1).
+        conversation = Conversation.objects.using(alias).annotate(participant_count=Count('participants'))\
+            .filter(participant_count=2).filter(participants=user).filter(participants=other_user).first()
+        if conversation is not None:
+            return conversation
+    return None
+
+
+def allocate_conversation_ids(count):
+    keys = ConversationKey.objects.using(DEFAULT_DB_ALIAS).bulk_create([ConversationKey() for _ in range(count)])
+    return [key.pk for key in keys]
+
+
+def sync_conversation_keys():
+    """Продвинуть выдачу ключей за наибольший id диалога на всех шардах."""
+    last = max(count or 0 for _, count in fan_out(
+        lambda alias: Conversation.objects.using(alias).aggregate(last=Max('id'))['last']
+    ))
+    keys = ConversationKey.objects.using(DEFAULT_DB_ALIAS)
+    if not last or keys.filter(id__gte=last).exists():
+        return False
+    keys.create(id=last)
+    connection = connections[DEFAULT_DB_ALIAS]
+    with connection.cursor() as cursor:
+        for sql in connection.ops.sequence_reset_sql(no_style(), [ConversationKey]):
+            cursor.execute(sql)
+    return True
+
+
+def create_conversation(*users):
+    if not enabled():
+        conversation = Conversation.objects.create()
+    else:
+        conversation = Conversation(id=allocate_conversation_ids(1)[0])
+        alias = shard_for(conversation.pk)
+        try:
+            with transaction.atomic(using=alias):
+                conversation.save(using=alias, force_insert=True)
+        except IntegrityError:
+            # Id уже занят диалогом, созданным до включения шардирования.
+            sync_conversation_keys()
+            conversation = Conversation(id=allocate_conversation_ids(1)[0])
+            conversation.save(using=shard_for(conversation.pk), force_insert=True)
+    conversation.participants.add(*users)
+    return conversation
+
+
+def participant_ids(conversation_list):
+    """{conversation_id: [user_id, ...]} по таблицам участников их шардов."""
+    by_alias = {}
+    for conversation in conversation_list:
+        by_alias.setdefault(conversation._state.db or DEFAULT_DB_ALIAS, []).append(conversation.pk)
+    result = {}
+    for alias, ids in by_alias.items():
+        for conversation_id, user_id in Participant.objects.using(alias).filter(conversation_id__in=ids)\
+                .order_by('id').values_list('conversation_id', 'user_id'):
+            result.setdefault(conversation_id, []).append(user_id)
+    return result
+
+
+def attach_participants(conversation_list, select_related=('profile',)):
+    """Заполнить ``conversation.participant_list`` пользователями из основной базы."""
+    ids = participant_ids(conversation_list)
+    users = User.objects.select_related(*select_related).in_bulk(set(chain.from_iterable(ids.values())))
+    for conversation in conversation_list:
+        conversation.participant_list = [users[user_id] for user_id in ids.get(conversation.pk, []) if user_id in users]
+    return conversation_list
+
+
+def other_participant(conversation, user):
+    """Собеседник или None (в том числе если он удалён и ждёт очистки)."""
+    ids = participant_ids([conversation]).get(conversation.pk, [])
+    other_id = next((user_id for user_id in ids if user_id != user.id), None)
+    if not other_id:
+        return None
+    return User.objects.filter(id=other_id, profile__deleted_at__isnull=True).first()
+
+
+def unread_count(user):
+    return sum(count for _, count in fan_out(
+        lambda alias: Message.objects.using(alias).filter(recipient=user, is_read=False).count()
+    ))
+
+
+# --- Ребалансировка -------------------------------------------------------
+
+def misplaced(alias):
+    """(id диалога, целевой шард) для диалогов ``alias``, которым место на другом шарде."""
+    ids = Conversation.objects.using(alias).order_by('id').values_list('id', flat=True)
+    for conversation_id in ids.iterator(chunk_size=2000):
+        target = shard_for(conversation_id)
+        if target != alias:
+            yield conversation_id, target
+
+
+def move_conversation(conversation_id, source, target):
+    """Перенести диалог со всеми строками с ``source`` на ``target``.
+
+    Строка диалога на источнике блокируется (``select_for_update``) до
+    конца: новые сообщения в него ждут переноса. Копия коммитится на
+    ``target`` раньше, чем удаляется источник, поэтому прерванный перенос
+    безопасно повторить — уже скопированный диалог только удаляется с
+    источника. Сообщения получают на новом шарде новые id: открытые
+    вкладки диалога подхватят новые сообщения после перезагрузки.
+    """
+    with transaction.atomic(using=source):
+        conversation = Conversation.objects.using(source).select_for_update().filter(id=conversation_id).first()
+        if conversation is None:
+            return False
+        with transaction.atomic(using=target):
+            if not Conversation.objects.using(target).filter(id=conversation_id).exists():
+                conversation.save(using=target, force_insert=True)
+                for model in (Participant, Message, TypingStatus, MessageArchive):
+                    rows = list(model.objects.using(source).filter(conversation_id=conversation_id).order_by('id'))
+                    for row in rows:
+                        row.pk = None
+                        row._state.adding = True
+                    model.objects.using(target).bulk_create(rows, batch_size=1000)
+        Conversation.objects.using(source).filter(id=conversation_id).delete()
+    return True
+
+
+def rebalance(dry_run=False, limit=None, stdout=None):
+    """Перенести диалоги на шарды по текущему ``MESSAGE_SHARDS``; вернуть {(source, target): n}."""
+    if not dry_run:
+        sync_conversation_keys()
+    moved = {}
+    total = 0
+    for source in shards():
+        for conversation_id, target in misplaced(source):
+            if limit is not None and total >= limit:
+                return moved
+            if dry_run or move_conversation(conversation_id, source, target):
+                moved[(source, target)] = moved.get((source, target), 0) + 1
+                total += 1
+                if stdout and not dry_run and total % 1000 == 0:
+                    stdout.write(f'Перенесено диалогов: {total}')
+    return moved
@@ -1,8 +1,11 @@
 # main/signals.py
-from django.db.models.signals import post_save
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_init, post_save, post_delete
 from django.contrib.auth.models import User
 from django.dispatch import receiver
-from .models import Profile
+from .models import Profile, Section, Subsection, Thread, Post, WallPost
+from .caching import bump_home_version
+from . import stats, search, storage, slow_queries
 
 @receiver(post_save, sender=User)
 def create_user_profile(sender, instance, created, **kwargs):
@@ -11,6 +14,143 @@ def create_user_profile(sender, instance, created, **kwargs):
 
 @receiver(post_save, sender=User)
 def save_user_profile(sender, instance, **kwargs):
-    """Сохраняет профиль при сохранении пользователя."""
-    if hasattr(instance, 'profile'):
-        instance.profile.save()
\ No newline at end of file
+    """Сохраняет профиль при сохранении пользователя, если он изменён.
+
+    Профиль не подгружается из БД: если он не был загружен, то и меняться
+    в нём нечему (например, при обновлении last_login).
+    """
+    if User.profile.related.is_cached(instance) and instance.profile.has_changed():
+        instance.profile.save()
+
+
+# Поля, изменение которых не влияет на главную страницу.
+HOME_IRRELEVANT_FIELDS = {
+    Thread: {'views_count'},
+}
+
+
+@receiver(post_save, sender=Section)
+@receiver(post_save, sender=Subsection)
+@receiver(post_save, sender=Thread)
+def invalidate_home_on_save(sender, instance, update_fields=None, **kwargs):
+    """Сбрасывает кэш главной страницы при изменении разделов и тем."""
+    if update_fields and set(update_fields) <= HOME_IRRELEVANT_FIELDS.get(sender, set()):
+        return
+    bump_home_version()
+
+
+@receiver(post_save, sender=Post)
+@receiver(post_save, sender=User)
+def invalidate_home_on_create(sender, instance, created, **kwargs):
+    """Посты и пользователи видны на главной только в статистике."""
+    if created:
+        bump_home_version()
+
+
+@receiver(post_delete, sender=Section)
+@receiver(post_delete, sender=Subsection)
+@receiver(post_delete, sender=Thread)
+@receiver(post_delete, sender=Post)
+@receiver(post_delete, sender=User)
+def invalidate_home_on_delete(sender, instance, **kwargs):
+    bump_home_version()
+
+
+STAT_NAMES = {
+    User: 'users',
+    Thread: 'threads',
+    Post: 'posts',
+}
+
+
+@receiver(post_save, sender=User)
+@receiver(post_save, sender=Thread)
+@receiver(post_save, sender=Post)
+def increment_forum_stats(sender, instance, created, **kwargs):
+    if created:
+        stats.increment(STAT_NAMES[sender])
+
+
+@receiver(post_delete, sender=User)
+@receiver(post_delete, sender=Thread)
+@receiver(post_delete, sender=Post)
+def decrement_forum_stats(sender, instance, **kwargs):
+    stats.increment(STAT_NAMES[sender], -1)
+
+
+# Счётчик профиля и поле модели с владельцем профиля.
+PROFILE_COUNTER_FIELDS = {
+    Post: ('posts_count', 'author_id'),
+    Thread: ('threads_count', 'author_id'),
+    WallPost: ('wall_posts_count', 'owner_id'),
+}
+
+
+@receiver(post_save, sender=Post)
+@receiver(post_save, sender=Thread)
+@receiver(post_save, sender=WallPost)
+def increment_profile_counters(sender, instance, created, **kwargs):
+    if created:
+        field, user_field = PROFILE_COUNTER_FIELDS[sender]
+        stats.adjust_profile_counters(getattr(instance, user_field), **{field: 1})
+
+
+@receiver(post_delete, sender=Post)
+@receiver(post_delete, sender=Thread)
+@receiver(post_delete, sender=WallPost)
+def decrement_profile_counters(sender, instance, **kwargs):
+    if getattr(instance, 'deleted_at', None):
+        return  # Уже вычтено при мягком удалении.
+    field, user_field = PROFILE_COUNTER_FIELDS[sender]
+    stats.adjust_profile_counters(getattr(instance, user_field), **{field: -1})
+
+
+@receiver(post_save, sender=Thread)
+def index_thread_for_search(sender, instance, update_fields=None, **kwargs):
+    if update_fields and 'title' not in update_fields:
+        return
+    search.index_thread(instance.pk)
+
+
+@receiver(post_save, sender=Post)
+def index_post_for_search(sender, instance, update_fields=None, **kwargs):
+    if update_fields and 'text' not in update_fields:
+        return
+    search.index_post(instance.pk)
+
+
+@receiver(post_delete, sender=Thread)
+def remove_thread_from_search(sender, instance, **kwargs):
+    search.remove_thread(instance.pk)
+
+
+@receiver(post_delete, sender=Post)
+def remove_post_from_search(sender, instance, **kwargs):
+    search.remove_post(instance.pk)
+
+
+storage.register_refcounted(Profile, 'avatar')
+storage.register_refcounted(Post, 'image')
+
+
+@receiver(post_init, sender=Profile)
+@receiver(post_init, sender=Post)
+def remember_media_names(sender, instance, **kwargs):
+    storage.snapshot_names(instance)
+
+
+@receiver(post_save, sender=Profile)
+@receiver(post_save, sender=Post)
+def count_media_references(sender, instance, **kwargs):
+    storage.sync_references(instance)
+
+
+@receiver(post_delete, sender=Profile)
+@receiver(post_delete, sender=Post)
+def release_media_references(sender, instance, **kwargs):
+    storage.drop_references(instance)
+
+
+@receiver(connection_created)
+def install_slow_query_log(sender, connection, **kwargs):
+    slow_queries.install(connection)
@@ -0,0 +1,163 @@
+"""Журнал медленных SQL-запросов с планами выполнения.
+
+Обёртка ``execute_wrapper`` ставится на каждое новое соединение (сигнал
+``connection_created`` в signals.py), поэтому видит запросы и представлений,
+и воркеров, и команд. Ставится она первой в список: соединение может
+открыться внутри запроса, когда в списке уже лежат временные обёртки
+middleware, а те при выходе снимают последний элемент. Запрос дольше
+``SLOW_QUERY_THRESHOLD_MS`` пишется в логгер ``main.slow_queries`` вместе
+с параметрами, именем представления (его запоминает ``SlowQueryMiddleware``)
+и местом вызова в коде проекта.
+
+Если запрос той же формы оказался медленным ``SLOW_QUERY_EXPLAIN_AFTER``
+раз, с вероятностью ``SLOW_QUERY_EXPLAIN_RATE`` (и не чаще раза в
+``SLOW_QUERY_EXPLAIN_INTERVAL`` секунд на форму) для него снимается план:
+``EXPLAIN (ANALYZE, BUFFERS)`` на PostgreSQL, ``EXPLAIN QUERY PLAN`` на SQLite.
+План пишется в логгер ``main.slow_queries.explain``. ANALYZE выполняет
+запрос повторно, поэтому планы снимаются только для чтения (SELECT и WITH
+без изменения данных и без блокировок ``FOR UPDATE``/``FOR SHARE``) и в
+точке сохранения — ошибка не испортит транзакцию запроса.
+"""
+import contextvars
+import logging
+import random
+import re
+import threading
+import time
+
+from django.conf import settings
+from django.db import DatabaseError, transaction
+
+from .query_budgets import WRAPPER_FILES, call_site, sql_shape
+
+logger = logging.getLogger(__name__)
+explain_logger = logging.getLogger(__name__ + '.explain')
+WRAPPER_FILES.add(__file__)
+
+# Сколько форм запросов помнить для подсчёта повторов.
+MAX_TRACKED_SHAPES = 1000
+# WITH … DELETE/INSERT … изменяет данные — EXPLAIN ANALYZE выполнил бы его ещё раз.
+DML_PATTERN = re.compile(r'\b(INSERT|UPDATE|DELETE|MERGE)\b', re.IGNORECASE)
+# SELECT … FOR UPDATE повторно взял бы блокировки строк в транзакции вызывающего.
+LOCKING_PATTERN = re.compile(r'\bFOR\s+(UPDATE|SHARE|NO\s+KEY\s+UPDATE|KEY\s+SHARE)\b', re.IGNORECASE)
+
+_current_view = contextvars.ContextVar('forum_current_view', default=None)
+_explaining = contextvars.ContextVar('forum_explaining', default=False)
+_lock = threading.Lock()
+_slow_counts = {}
+_last_explained = {}
+
+
+def threshold():
+    """Порог в секундах или None, если журнал выключен."""
+    value = getattr(settings, 'SLOW_QUERY_THRESHOLD_MS', 200)
+    return None if value is None else value / 1000
+
+
+def _params_repr(params):
+    limit = getattr(settings, 'SLOW_QUERY_PARAMS_MAX_LENGTH', 500)
+    text = repr(params)
+    return text if len(text) <= limit else text[:limit] + '…'
+
+
+def reset():
+    with _lock:
+        _slow_counts.clear()
+        _last_explained.clear()
+
+
+def _should_explain(shape):
+    now = time.monotonic()
+    with _lock:
+        if len(_slow_counts) >= MAX_TRACKED_SHAPES and shape not in _slow_counts:
+            _slow_counts.clear()
+            _last_explained.clear()
+        _slow_counts[shape] = _slow_counts.get(shape, 0) + 1
+        if _slow_counts[shape] < getattr(settings, 'SLOW_QUERY_EXPLAIN_AFTER', 3):
+            return False
+        if now - _last_explained.get(shape, float('-inf')) < getattr(settings, 'SLOW_QUERY_EXPLAIN_INTERVAL', 600):
+            return False
+        if random.random() >= getattr(settings, 'SLOW_QUERY_EXPLAIN_RATE', 0.1):
+            return False
+        _last_explained[shape] = now
+        return True
+
+
+def explain(connection, sql, params):
+    """План запроса строками или None для неподдерживаемой БД."""
+    if connection.vendor == 'postgresql':
+        prefix = 'EXPLAIN (ANALYZE, BUFFERS) '
+    elif connection.vendor == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN '
+    else:
+        return None
+    token = _explaining.set(True)
+    try:
+        with transaction.atomic(using=connection.alias):
+            with connection.cursor() as cursor:
+                cursor.execute(prefix + sql, params)
+                rows = cursor.fetchall()
+    finally:
+        _explaining.reset(token)
+    return [' '.join(str(value) for value in row) for row in rows]
+
+
+def is_read_only(sql):
+    head = sql.lstrip()[:6].upper()
+    if LOCKING_PATTERN.search(sql):
+        return False
+    if head == 'SELECT':
+        return True
+    return head[:4] == 'WITH' and not DML_PATTERN.search(sql)
+
+
+def log_slow_queries(execute, sql, params, many, context):
+    """execute_wrapper: засечь время и записать медленный запрос."""
+    limit = threshold()
+    if limit is None or _explaining.get():
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    result = execute(sql, params, many, context)
+    duration = time.perf_counter() - start
+    if duration < limit:
+        return result
+
+    view = _current_view.get() or '-'
+    logger.warning(
+        'Медленный запрос %.1f мс в %s, вызов из %s: %s; параметры: %s',
+        duration * 1000, view, call_site(), sql, _params_repr(params),
+    )
+    shape = sql_shape(sql)
+    if not many and is_read_only(sql) and _should_explain(shape):
+        try:
+            plan = explain(context['connection'], sql, params)
+        except DatabaseError:
+            logger.exception('Не удалось получить план запроса')
+        else:
+            if plan:
+                explain_logger.warning('План запроса из %s (%.1f мс): %s\n%s',
+                                       view, duration * 1000, sql, '\n'.join(plan))
+    return result
+
+
+def install(connection):
+    """Подключить журнал к соединению (один раз), самой внешней обёрткой."""
+    if log_slow_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, log_slow_queries)
+
+
+class SlowQueryMiddleware:
+    """Запоминает имя представления для записей журнала."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = _current_view.set(None)
+        try:
+            return self.get_response(request)
+        finally:
+            _current_view.reset(token)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        _current_view.set(request.resolver_match.view_name)
@@ -0,0 +1,164 @@
+"""Глобальная статистика форума без COUNT(*) на каждый запрос.
+
+Количество пользователей, тем и сообщений хранится в шардированных
+счётчиках (``ForumCounter``), которые обновляются сигналами при создании
+и удалении объектов и периодически сверяются командой
+``reconcile_forum_stats``. Для очень больших таблиц на PostgreSQL можно
+включить режим оценки по ``pg_class.reltuples``.
+"""
+import logging
+import random
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Count, F, Sum, Value
+from django.db.models.functions import Greatest
+
+from .models import ForumCounter, Profile, Thread, Post, WallPost
+
+logger = logging.getLogger(__name__)
+
+STAT_MODELS = {
+    'users': User,
+    'threads': Thread,
+    'posts': Post,
+}
+
+
+def _shard_count():
+    return max(1, getattr(settings, 'FORUM_STATS_SHARDS', 8))
+
+
+def increment(name, delta=1):
+    """Изменить счётчик ``name`` на ``delta`` в случайном шарде."""
+    shard = random.randrange(_shard_count())
+    counters = ForumCounter.objects.filter(name=name, shard=shard)
+    if counters.update(value=F('value') + delta):
+        return
+    try:
+        with transaction.atomic():
+            ForumCounter.objects.create(name=name, shard=shard, value=delta)
+    except IntegrityError:
+        # Строку шарда параллельно создал другой запрос.
+        counters.update(value=F('value') + delta)
+
+
+def _counter_totals():
+    rows = ForumCounter.objects.values('name').annotate(total=Sum('value'))
+    return {row['name']: max(row['total'] or 0, 0) for row in rows}
+
+
+def _reltuples_estimates():
+    """Оценки числа строк из статистики планировщика PostgreSQL."""
+    tables = {name: model._meta.db_table for name, model in STAT_MODELS.items()}
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT relname, reltuples FROM pg_class WHERE relname = ANY(%s) AND relkind IN (%s, %s)',
+            [list(tables.values()), 'r', 'p'],
+        )
+        reltuples = dict(cursor.fetchall())
+    estimates = {}
+    for name, table in tables.items():
+        value = reltuples.get(table)
+        # -1 означает, что таблица ещё ни разу не анализировалась.
+        if value is not None and value >= 0:
+            estimates[name] = int(value)
+    return estimates
+
+
+def get_forum_stats():
+    """Статистика для главной страницы: {'users': ..., 'threads': ..., 'posts': ...}."""
+    stats = {name: 0 for name in STAT_MODELS}
+    stats.update(_counter_totals())
+
+    if getattr(settings, 'FORUM_STATS_MODE', 'counters') == 'estimate' and connection.vendor == 'postgresql':
+        threshold = getattr(settings, 'FORUM_STATS_ESTIMATE_THRESHOLD', 1_000_000)
+        try:
+            estimates = _reltuples_estimates()
+        except Exception:
+            logger.exception('Не удалось получить оценки pg_class.reltuples')
+            estimates = {}
+        for name, estimate in estimates.items():
+            if estimate >= threshold:
+                stats[name] = estimate
+    return stats
+
+
+def reconcile(names=None):
+    """Пересчитать счётчики по фактическому числу строк.
+
+    Возвращает словарь {имя: (было, стало)}.
+    """
+    result = {}
+    for name in names or STAT_MODELS:
+        model = STAT_MODELS[name]
+        with transaction.atomic():
+            shards = list(ForumCounter.objects.select_for_update().filter(name=name))
+            before = sum(counter.value for counter in shards)
+            actual = model.objects.count()
+            ForumCounter.objects.filter(name=name).exclude(shard=0).update(value=0)
+            ForumCounter.objects.update_or_create(name=name, shard=0, defaults={'value': actual})
+        result[name] = (before, actual)
+    return result
+
+
+# ------------------------------------------------------------------------------
+# Счётчики активности пользователя (Profile.posts_count и др.)
+
+PROFILE_COUNTERS = {
+    'posts_count': (Post, 'author_id'),
+    'threads_count': (Thread, 'author_id'),
+    'wall_posts_count': (WallPost, 'owner_id'),
+}
+
+
+def adjust_profile_counters(user_id, **deltas):
+    """Изменить счётчики профиля, например ``adjust_profile_counters(1, posts_count=-3)``.
+
+    Одно UPDATE с F(); значение не опускается ниже нуля.
+    """
+    updates = {
+        field: Greatest(F(field) + delta, Value(0))
+        for field, delta in deltas.items() if delta
+    }
+    if updates:
+        Profile.objects.filter(user_id=user_id).update(**updates)
+
+
+def reconcile_profile_counters(batch_size=500, stdout=None):
+    """Пересчитать счётчики активности пачками профилей.
+
+    Для каждой пачки выполняется по одному GROUP BY-запросу на счётчик.
+    Возвращает (проверено, исправлено).
+    """
+    checked = fixed = 0
+    last_pk = 0
+    while True:
+        profiles = list(
+            Profile.objects.filter(pk__gt=last_pk).order_by('pk')
+            .only('pk', 'user_id', *PROFILE_COUNTERS)[:batch_size]
+        )
+        if not profiles:
+            break
+        last_pk = profiles[-1].pk
+        user_ids = [profile.user_id for profile in profiles]
+        actual = {}
+        for field, (model, user_field) in PROFILE_COUNTERS.items():
+            rows = model.objects.filter(**{f'{user_field}__in': user_ids})\
+                .values(user_field).annotate(total=Count('id')).values_list(user_field, 'total')
+            actual[field] = dict(rows)
+
+        changed = []
+        for profile in profiles:
+            values = {field: actual[field].get(profile.user_id, 0) for field in PROFILE_COUNTERS}
+            if any(getattr(profile, field) != value for field, value in values.items()):
+                for field, value in values.items():
+                    setattr(profile, field, value)
+                changed.append(profile)
+        Profile.objects.bulk_update(changed, list(PROFILE_COUNTERS))
+        checked += len(profiles)
+        fixed += len(changed)
+        if stdout:
+            stdout.write(f'Проверено {checked}, исправлено {fixed}')
+    return checked, fixed
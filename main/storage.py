@@ -0,0 +1,183 @@
+"""Контентно-адресуемое хранилище медиафайлов.
+
+Файл сохраняется под именем, полученным из SHA-256 содержимого:
+``avatars/ab/cd/abcd….png``. Одинаковые загрузки занимают место один раз,
+а URL никогда не меняет содержимое, поэтому его можно кэшировать навсегда.
+
+Сколько строк ``Profile.avatar`` и ``Post.image`` ссылается на файл, хранит
+``MediaBlob``; когда ссылок не остаётся, файл удаляется после коммита.
+Строка ``MediaBlob`` служит и блокировкой: загрузка держит её до коммита
+(вместе с новой ссылкой), а удаление перепроверяет счётчик под ней же,
+поэтому файл, который только что снова загрузили, не удаляется. Загрузка
+вне транзакции такой защиты не получает — запросы выполняются атомарно.
+"""
+import hashlib
+import logging
+import os
+import re
+
+from django.core.files.storage import FileSystemStorage
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils.deconstruct import deconstructible
+from django.utils.functional import LazyObject
+
+logger = logging.getLogger(__name__)
+
+CONTENT_NAME_PATTERN = re.compile(r'^[\w-]+/[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}(\.\w+)?$')
+
+
+def content_hash(content):
+    """SHA-256 файла (file-like или Django File), позиция возвращается в начало."""
+    digest = hashlib.sha256()
+    if hasattr(content, 'seek'):
+        content.seek(0)
+    chunks = content.chunks() if hasattr(content, 'chunks') else iter(lambda: content.read(64 * 1024), b'')
+    for chunk in chunks:
+        digest.update(chunk)
+    if hasattr(content, 'seek'):
+        content.seek(0)
+    return digest.hexdigest()
+
+
+def content_name(prefix, digest, extension):
+    extension = extension.lower().lstrip('.')
+    suffix = f'.{extension}' if extension else ''
+    return f'{prefix}/{digest[:2]}/{digest[2:4]}/{digest}{suffix}'
+
+
+def is_content_addressed(name):
+    return bool(name) and bool(CONTENT_NAME_PATTERN.match(name))
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """FileSystemStorage, именующий файлы по хэшу содержимого.
+
+    Первый каталог исходного имени (``avatars/``, ``posts/``) сохраняется
+    как префикс, остальная часть имени заменяется хэшем.
+    """
+
+    def __init__(self, **kwargs):
+        # Перезапись файла тем же содержимым безопасна.
+        kwargs.setdefault('allow_overwrite', True)
+        super().__init__(**kwargs)
+
+    def get_available_name(self, name, max_length=None):
+        return name
+
+    def _save(self, name, content):
+        from .models import MediaBlob
+
+        prefix = name.split('/', 1)[0] if '/' in name else 'files'
+        name = content_name(prefix, content_hash(content), os.path.splitext(name)[1])
+        with transaction.atomic():
+            # Строка (пока без ссылок) заблокирована до коммита загрузки: release()
+            # не удалит файл, пока новая ссылка на него не учтена.
+            MediaBlob.objects.get_or_create(name=name)
+            MediaBlob.objects.select_for_update().filter(name=name).first()
+            if self.exists(name):
+                return name
+            return super()._save(name, content)
+
+
+class _DefaultContentStorage(LazyObject):
+    def _setup(self):
+        self._wrapped = ContentAddressedStorage()
+
+
+content_storage = _DefaultContentStorage()
+
+
+def get_content_storage():
+    """Хранилище для полей модели (вызываемый объект — для миграций)."""
+    return content_storage
+
+
+# ------------------------------------------------------------------------------
+# Подсчёт ссылок
+
+def acquire(name):
+    """Увеличить счётчик ссылок на файл ``name``."""
+    from .models import MediaBlob
+
+    if not is_content_addressed(name):
+        return
+    blobs = MediaBlob.objects.filter(name=name)
+    if blobs.update(refcount=F('refcount') + 1):
+        return
+    try:
+        with transaction.atomic():
+            MediaBlob.objects.create(name=name, refcount=1)
+    except IntegrityError:
+        blobs.update(refcount=F('refcount') + 1)
+
+
+def release(name, storage=None):
+    """Уменьшить счётчик ссылок; файл без ссылок удаляется после коммита."""
+    from .models import MediaBlob
+
+    if not is_content_addressed(name):
+        return
+    with transaction.atomic():
+        blob = MediaBlob.objects.select_for_update().filter(name=name).first()
+        if blob is None:
+            return
+        if blob.refcount > 1:
+            MediaBlob.objects.filter(pk=blob.pk).update(refcount=F('refcount') - 1)
+            return
+        # Строка остаётся до удаления файла: под её блокировкой оно и перепроверяется.
+        MediaBlob.objects.filter(pk=blob.pk).update(refcount=0)
+
+    storage = storage or content_storage
+
+    def delete_file():
+        try:
+            with transaction.atomic():
+                blob = MediaBlob.objects.select_for_update().filter(name=name).first()
+                # Пока ждали коммита, файл могли загрузить снова.
+                if blob is None or blob.refcount > 0:
+                    return
+                storage.delete(name)
+                blob.delete()
+        except OSError:
+            logger.exception('Не удалось удалить файл %s', name)
+
+    transaction.on_commit(delete_file)
+
+
+REFCOUNTED_FIELDS = {}
+
+
+def register_refcounted(model, *field_names):
+    """Подключить подсчёт ссылок для файловых полей модели (см. signals.py)."""
+    REFCOUNTED_FIELDS[model] = field_names
+
+
+def snapshot_names(instance):
+    instance._media_names = {
+        field_name: getattr(instance, field_name).name or ''
+        for field_name in REFCOUNTED_FIELDS.get(type(instance), ())
+        if field_name not in instance.get_deferred_fields()
+    }
+
+
+def sync_references(instance):
+    """После сохранения: учесть новые файлы и отпустить заменённые."""
+    old_names = getattr(instance, '_media_names', {})
+    for field_name in REFCOUNTED_FIELDS.get(type(instance), ()):
+        if field_name not in old_names:
+            # Поле не загружалось (defer/only) — значит, и не менялось.
+            continue
+        new_name = getattr(instance, field_name).name or ''
+        old_name = old_names.get(field_name, '')
+        if new_name != old_name:
+            acquire(new_name)
+            release(old_name, getattr(instance, field_name).storage)
+    snapshot_names(instance)
+
+
+def drop_references(instance):
+    for field_name in REFCOUNTED_FIELDS.get(type(instance), ()):
+        field_file = getattr(instance, field_name)
+        release(field_file.name or '', field_file.storage)
@@ -0,0 +1,217 @@
+"""Очередь отложенных задач в базе данных.
+
+Задача — строка ``Task`` с именем функции и аргументами (JSON). Строка
+пишется в той же транзакции, что и данные запроса, поэтому воркер увидит
+задачу только после коммита, а при откате она исчезнет вместе с данными.
+
+Воркер (``manage.py run_worker``) забирает пачку готовых задач. На
+PostgreSQL это делается через ``SELECT … FOR UPDATE SKIP LOCKED``, так что
+несколько воркеров не мешают друг другу. Задачи выполняются пулом потоков;
+упавшая задача перезапускается с экспоненциальной задержкой, пока не
+исчерпает ``max_attempts``.
+
+В режиме ``TASKS_EAGER`` (тесты, SQLite без воркера) задача выполняется
+в том же процессе сразу после коммита.
+
+Объявление и постановка задачи::
+
+    @task(max_attempts=3)
+    def process_avatar(profile_id):
+        ...
+
+    process_avatar.delay(profile.pk)
+"""
+import logging
+import os
+import random
+import socket
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_ATTEMPTS = 5
+BACKOFF_BASE = 10      # секунд до первого повтора
+BACKOFF_MAX = 60 * 60  # не реже раза в час
+
+TASKS = {}
+
+
+class TaskFunction:
+    """Обёртка функции-задачи: вызов напрямую или ``delay()`` через очередь."""
+
+    def __init__(self, func, name, max_attempts):
+        self.func = func
+        self.name = name
+        self.max_attempts = max_attempts
+        self.__doc__ = func.__doc__
+        self.__name__ = func.__name__
+        self.__module__ = func.__module__
+
+    def __call__(self, *args, **kwargs):
+        return self.func(*args, **kwargs)
+
+    def delay(self, *args, **kwargs):
+        return enqueue(self.name, *args, **kwargs)
+
+    def delay_at(self, run_at, *args, **kwargs):
+        return enqueue(self.name, *args, _run_at=run_at, **kwargs)
+
+
+def task(max_attempts=DEFAULT_MAX_ATTEMPTS, name=None):
+    """Зарегистрировать функцию как задачу очереди."""
+    def decorator(func):
+        task_name = name or f'{func.__module__}.{func.__qualname__}'
+        wrapper = TaskFunction(func, task_name, max_attempts)
+        TASKS[task_name] = wrapper
+        return wrapper
+    return decorator
+
+
+def get_task(name):
+    if name not in TASKS:
+        # Модуль с задачей мог ещё не импортироваться в этом процессе.
+        import_string(name)
+    return TASKS[name]
+
+
+def is_eager():
+    eager = getattr(settings, 'TASKS_EAGER', None)
+    if eager is None:
+        return connection.vendor == 'sqlite'
+    return eager
+
+
+def backoff(attempts):
+    """Задержка перед повтором: 10 с, 20 с, 40 с… с разбросом ±25%."""
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** max(0, attempts - 1))
+    return timedelta(seconds=delay * random.uniform(0.75, 1.25))
+
+
+def enqueue(name, *args, _run_at=None, **kwargs):
+    """Поставить задачу ``name`` в очередь (или выполнить после коммита в eager-режиме)."""
+    from .models import Task
+
+    task_function = get_task(name)
+    if is_eager():
+        transaction.on_commit(lambda: _run_eager(task_function, args, kwargs))
+        return None
+    return Task.objects.create(
+        name=name,
+        args=list(args),
+        kwargs=kwargs,
+        max_attempts=task_function.max_attempts,
+        run_at=_run_at or timezone.now(),
+    )
+
+
+def _run_eager(task_function, args, kwargs):
+    try:
+        task_function(*args, **kwargs)
+    except Exception:
+        logger.exception('Задача %s завершилась ошибкой', task_function.name)
+
+
+# ------------------------------------------------------------------------------
+# Воркер
+
+def worker_id():
+    return f'{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}'
+
+
+def lock_timeout():
+    return timedelta(seconds=getattr(settings, 'TASKS_LOCK_TIMEOUT', 15 * 60))
+
+
+def claim(limit, locked_by):
+    """Забрать до ``limit`` готовых задач; возвращает список ``Task``.
+
+    Зависшие задачи (воркер умер посреди выполнения) возвращаются в работу
+    по истечении ``TASKS_LOCK_TIMEOUT``. Такой запуск считается попыткой:
+    задача, которая роняет воркер, не перезапускается бесконечно.
+    """
+    from .models import Task
+
+    now = timezone.now()
+    with transaction.atomic():
+        stale = Task.objects.filter(status=Task.STATUS_RUNNING, locked_at__lt=now - lock_timeout())
+        error = 'Воркер не завершил задачу за TASKS_LOCK_TIMEOUT'
+        stale.filter(attempts__gte=F('max_attempts') - 1).update(
+            status=Task.STATUS_FAILED, attempts=F('attempts') + 1, last_error=error, locked_at=None,
+        )
+        stale.update(
+            status=Task.STATUS_QUEUED, attempts=F('attempts') + 1, last_error=error, locked_at=None, locked_by='',
+        )
+        # На SQLite select_for_update игнорируется — запись и так одна на всю БД.
+        ids = list(
+            Task.objects.select_for_update(skip_locked=True)
+            .filter(status=Task.STATUS_QUEUED, run_at__lte=now)
+            .order_by('run_at', 'id')
+            .values_list('id', flat=True)[:limit]
+        )
+        if not ids:
+            return []
+        Task.objects.filter(id__in=ids).update(
+            status=Task.STATUS_RUNNING, locked_at=now, locked_by=locked_by,
+        )
+        return list(Task.objects.filter(id__in=ids).order_by('run_at', 'id'))
+
+
+def execute(task_row):
+    """Выполнить задачу, забранную ``claim``; успешные задачи удаляются.
+
+    Итог пишется только пока аренда за этим воркером (те же ``locked_by`` и
+    ``locked_at``): задачу, которую ``claim`` уже вернул в работу как
+    зависшую, медленный воркер не удаляет и не перезаписывает.
+    """
+    from .models import Task
+
+    lease = Task.objects.filter(
+        pk=task_row.pk, status=Task.STATUS_RUNNING, locked_by=task_row.locked_by, locked_at=task_row.locked_at,
+    )
+    attempts = task_row.attempts + 1
+    try:
+        get_task(task_row.name)(*task_row.args, **task_row.kwargs)
+    except Exception as exc:
+        logger.exception('Задача %s (#%s) завершилась ошибкой', task_row.name, task_row.pk)
+        error = f'{type(exc).__name__}: {exc}'
+        if attempts >= task_row.max_attempts:
+            updated = lease.update(
+                status=Task.STATUS_FAILED, attempts=attempts, last_error=error, locked_at=None,
+            )
+        else:
+            updated = lease.update(
+                status=Task.STATUS_QUEUED,
+                attempts=attempts,
+                last_error=error,
+                run_at=timezone.now() + backoff(attempts),
+                locked_at=None,
+                locked_by='',
+            )
+        if not updated:
+            _lost_lease(task_row)
+        return False
+    deleted, _ = lease.delete()
+    if not deleted:
+        _lost_lease(task_row)
+    return True
+
+
+def _lost_lease(task_row):
+    logger.warning('Задача %s (#%s) выполнялась дольше TASKS_LOCK_TIMEOUT и уже передана другому воркеру',
+                   task_row.name, task_row.pk)
+
+
+def run_pending(limit=100):
+    """Выполнить готовые задачи в текущем потоке (для тестов и ``run_worker --once``)."""
+    done = 0
+    for task_row in claim(limit, worker_id()):
+        execute(task_row)
+        done += 1
+    return done
@@ -0,0 +1,43 @@
+"""Общий перехват рендеринга шаблонов для метрик и трассировки.
+
+``Template.render`` бэкенда Django подменяется один раз, а метрики и
+трассировка подписываются на него через ``subscribe``. Подписчик получает
+шаблон и возвращает контекстный менеджер, внутри которого идёт рендеринг,
+или None, если этот рендеринг его не интересует. Перехватывается только
+верхнеуровневый рендеринг (render, render_to_string): подключённые через
+``{% include %}`` шаблоны рендерятся внутри него.
+"""
+import threading
+from contextlib import ExitStack
+
+from .query_budgets import WRAPPER_FILES
+
+WRAPPER_FILES.add(__file__)
+
+_hooks = []
+_lock = threading.Lock()
+_installed = False
+
+
+def subscribe(hook):
+    """Подписать ``hook(template)`` на рендеринг; повторная подписка ничего не меняет."""
+    global _installed
+    with _lock:
+        if hook not in _hooks:
+            _hooks.append(hook)
+        if _installed:
+            return
+        from django.template.backends.django import Template
+
+        original_render = Template.render
+
+        def render(self, context=None, request=None):
+            with ExitStack() as stack:
+                for subscriber in _hooks:
+                    manager = subscriber(self)
+                    if manager is not None:
+                        stack.enter_context(manager)
+                return original_render(self, context, request)
+
+        Template.render = render
+        _installed = True
@@ -0,0 +1,56 @@
+from django import template
+from django.utils.html import format_html, format_html_join
+
+from main.models import PostImageVariant
+
+register = template.Library()
+
+POST_IMAGE_SIZES = '(max-width: 768px) 100vw, 720px'
+
+
+def _srcset(variants, image_format, original=None):
+    """``original`` — (url, ширина) оригинала, если он шире всех вариантов."""
+    candidates = [(v.file.url, v.width) for v in variants if v.format == image_format]
+    if candidates and original:
+        candidates.append(original)
+    return ', '.join(f'{url} {width}w' for url, width in candidates)
+
+
+@register.simple_tag
+def post_image(post, css_class='img-fluid rounded border'):
+    """<picture> с WebP/JPEG-вариантами и ленивой загрузкой.
+
+    Варианты должны быть подгружены через prefetch_related('image_variants').
+    """
+    variants = list(post.image_variants.all())
+    # Собственные размеры картинки резервируют место до загрузки — без сдвига вёрстки.
+    dimensions = ''
+    if post.image_width and post.image_height:
+        dimensions = format_html(' width="{}" height="{}"', post.image_width, post.image_height)
+    if not variants:
+        return format_html(
+            '<img src="{}"{} alt="Изображение к посту" class="{}" '
+            'style="max-height: 600px; object-fit: contain; height: auto;" loading="lazy" decoding="async">',
+            post.image.url, dimensions, css_class,
+        )
+
+    if not dimensions:
+        largest = max(variants, key=lambda v: v.width)
+        dimensions = format_html(' width="{}" height="{}"', largest.width, largest.height)
+    # Варианты не шире оригинала: для широких и retina-экранов предлагаем и его самого.
+    original = None
+    if post.image_width and post.image_width > max(v.width for v in variants):
+        original = (post.image.url, post.image_width)
+    webp_srcset = _srcset(variants, PostImageVariant.FORMAT_WEBP, original)
+    jpeg_srcset = _srcset(variants, PostImageVariant.FORMAT_JPEG, original)
+    sources = format_html_join(
+        '', '<source type="{}" srcset="{}" sizes="{}">',
+        [('image/webp', webp_srcset, POST_IMAGE_SIZES)] if webp_srcset else [],
+    )
+    return format_html(
+        '<picture>{}<img src="{}" srcset="{}" sizes="{}"{} '
+        'alt="Изображение к посту" class="{}" style="max-height: 600px; object-fit: contain; height: auto;" '
+        'loading="lazy" decoding="async"></picture>',
+        sources, post.image.url, jpeg_srcset or webp_srcset, POST_IMAGE_SIZES,
+        dimensions, css_class,
+    )
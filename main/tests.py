@@ -1,7 +1,34 @@
-from django.test import TestCase
+import gzip
+import io
+import json
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.cache import cache
 from django.contrib.auth.models import User
+from django.db import connection, connections
+from django.templatetags.static import static
 from django.urls import reverse
-from .models import Section, Subsection, Thread, Post
+from django.utils import timezone
+from .models import Section, Subsection, Thread, Post, ThreadReadMarker, PostImageVariant, Profile, MediaBlob, Task, WallPost, WallComment, Conversation, Message, MessageArchive, TypingStatus
+from .images import generate_post_variants, generate_avatar_variants
+from . import benchmark, chat_load, db_routing, message_archive, metrics, purge, read_markers, sharding, slow_queries, tasks, tracing
+from PIL import Image
+from .query_budgets import QueryBudgetExceeded, QueryInspector
+from .stats import get_forum_stats, reconcile, reconcile_profile_counters
+from .views import post_page_url
+
+
+def tearDownModule():
+    # Просмотры тем в других тестах оставляют отметки в буфере; atexit-сброс
+    # после удаления тестовой базы писал бы их в никуда.
+    read_markers.reset()
+
 
 class ForumTestCase(TestCase):
     def setUp(self):
@@ -39,4 +66,1424 @@ class ForumTestCase(TestCase):
 
         self.assertEqual(response.status_code, 302)
         self.assertTrue(response.url.startswith('/accounts/login/'))
-        self.assertEqual(Post.objects.count(), 0)
\ No newline at end of file
+        self.assertEqual(Post.objects.count(), 0)
+
+
+class HomeCacheTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        self.section = Section.objects.create(title='Тестовый раздел')
+        self.subsection = Subsection.objects.create(title='Тестовый подраздел', section=self.section)
+
+    def test_cached_fragments_skip_queries(self):
+        """Повторный запрос главной берёт блоки из кэша"""
+        self.client.get(reverse('section_list'))
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('section_list'))
+        self.assertContains(response, 'Тестовый подраздел')
+
+    def test_new_thread_invalidates_home(self):
+        """Новая тема сбрасывает кэш главной страницы"""
+        self.client.get(reverse('section_list'))
+        Thread.objects.create(title='Свежая тема', author=self.user, subsection=self.subsection)
+        response = self.client.get(reverse('section_list'))
+        self.assertContains(response, 'Свежая тема')
+
+    def test_thread_view_does_not_invalidate_home(self):
+        """Счётчик просмотров не влияет на кэш главной"""
+        thread = Thread.objects.create(title='Тема', author=self.user, subsection=self.subsection)
+        self.client.get(reverse('section_list'))
+        thread.increment_views()
+        with self.assertNumQueries(0):
+            self.client.get(reverse('section_list'))
+
+
+class ForumStatsTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        section = Section.objects.create(title='Тестовый раздел')
+        self.subsection = Subsection.objects.create(title='Тестовый подраздел', section=section)
+
+    def test_counters_follow_create_and_delete(self):
+        """Счётчики обновляются при создании и удалении объектов"""
+        thread = Thread.objects.create(title='Тема', author=self.user, subsection=self.subsection)
+        Post.objects.create(text='Первый', author=self.user, thread=thread)
+        Post.objects.create(text='Второй', author=self.user, thread=thread)
+        self.assertEqual(get_forum_stats(), {'users': 1, 'threads': 1, 'posts': 2})
+
+        thread.delete()
+        self.assertEqual(get_forum_stats(), {'users': 1, 'threads': 0, 'posts': 0})
+
+    def test_reconcile_fixes_drift(self):
+        """Сверка восстанавливает счётчики после обхода сигналов"""
+        Thread.objects.bulk_create([
+            Thread(title=f'Тема {i}', author=self.user, subsection=self.subsection) for i in range(3)
+        ])
+        self.assertEqual(get_forum_stats()['threads'], 0)
+        self.assertEqual(reconcile(['threads']), {'threads': (0, 3)})
+        self.assertEqual(get_forum_stats()['threads'], 3)
+
+
+class SearchTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        section = Section.objects.create(title='Тестовый раздел')
+        subsection = Subsection.objects.create(title='Тестовый подраздел', section=section)
+        self.thread = Thread.objects.create(title='Ремонт велосипеда', author=self.user, subsection=subsection)
+        self.post = Post.objects.create(text='Как заменить цепь на горном велосипеде?', author=self.user, thread=self.thread)
+
+    def test_finds_threads_and_posts(self):
+        """Поиск находит тему по заголовку и сообщение по тексту"""
+        response = self.client.get(reverse('search'), {'q': 'велосипед'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['results'].paginator.count, 2)
+        self.assertContains(response, 'Ремонт велосипеда')
+        self.assertContains(response, 'заменить цепь')
+
+    def test_index_follows_edit_and_delete(self):
+        """Индекс обновляется при редактировании и удалении"""
+        self.post.text = 'Теперь про тормоза'
+        self.post.save(update_fields=['text', 'updated_at'])
+        self.assertEqual(self.client.get(reverse('search'), {'q': 'цепь'}).context['results'].paginator.count, 0)
+        self.assertEqual(self.client.get(reverse('search'), {'q': 'тормоза'}).context['results'].paginator.count, 1)
+
+        self.post.delete()
+        self.assertEqual(self.client.get(reverse('search'), {'q': 'тормоза'}).context['results'].paginator.count, 0)
+
+    def test_operators_in_query_are_ignored(self):
+        """Спецсимволы FTS в запросе не приводят к ошибке"""
+        response = self.client.get(reverse('search'), {'q': '"цепь" OR NEAR(*'})
+        self.assertEqual(response.status_code, 200)
+
+
+class PostPermalinkTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        section = Section.objects.create(title='Тестовый раздел')
+        subsection = Subsection.objects.create(title='Тестовый подраздел', section=section)
+        self.thread = Thread.objects.create(title='Длинная тема', author=self.user, subsection=subsection)
+        self.posts = [
+            Post.objects.create(text=f'Сообщение {i}', author=self.user, thread=self.thread)
+            for i in range(25)
+        ]
+
+    def test_redirects_to_containing_page(self):
+        """Ссылка ведёт на страницу, где находится сообщение"""
+        post = self.posts[12]
+        response = self.client.get(reverse('post_permalink', args=[post.id]))
+        expected = reverse('post_list', args=[self.thread.id]) + f'?page=2#post-{post.id}'
+        self.assertRedirects(response, expected, fetch_redirect_response=False)
+
+    def test_page_follows_deletions(self):
+        """После удаления предыдущих сообщений страница пересчитывается"""
+        post = self.posts[12]
+        for earlier in self.posts[:5]:
+            earlier.delete()
+        response = self.client.get(reverse('post_permalink', args=[post.id]))
+        self.assertEqual(response.url, reverse('post_list', args=[self.thread.id]) + f'#post-{post.id}')
+
+
+class ReadMarkerTestCase(TestCase):
+    def setUp(self):
+        read_markers.reset()
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        self.reader = User.objects.create_user(username='reader', password='12345')
+        section = Section.objects.create(title='Тестовый раздел')
+        self.subsection = Subsection.objects.create(title='Тестовый подраздел', section=section)
+        self.client.login(username='testuser', password='12345')
+        self.client.post(reverse('new_thread', args=[self.subsection.id]), {
+            'title': 'Тема с отметками',
+            'text': 'Первое сообщение темы',
+        })
+        self.thread = Thread.objects.get()
+        for i in range(14):
+            self.client.post(reverse('new_post', args=[self.thread.id]), {'text': f'Ответ {i}'})
+        self.posts = list(Post.objects.order_by('created_at', 'id'))
+        read_markers.flush()
+        self.client.login(username='reader', password='12345')
+
+    def tearDown(self):
+        read_markers.flush()
+
+    def test_markers_are_batched_and_monotonic(self):
+        """Отметка пишется при сбросе буфера и не уменьшается"""
+        self.client.get(reverse('post_list', args=[self.thread.id]), {'page': 2})
+        self.assertFalse(ThreadReadMarker.objects.exists())
+        read_markers.flush()
+        self.client.get(reverse('post_list', args=[self.thread.id]), {'page': 1})
+        read_markers.flush()
+        marker = ThreadReadMarker.objects.get(user=self.reader, thread=self.thread)
+        self.assertEqual(marker.last_read_post_id, self.posts[-1].id)
+
+    def test_thread_list_unread_state(self):
+        """Список тем показывает непрочитанные темы"""
+        response = self.client.get(reverse('thread_list', args=[self.subsection.id]))
+        self.assertTrue(response.context['threads'][0].is_unread)
+        self.client.get(reverse('post_list', args=[self.thread.id]), {'page': 2})
+        response = self.client.get(reverse('thread_list', args=[self.subsection.id]))
+        self.assertFalse(response.context['threads'][0].is_unread)
+
+    def test_flush_survives_database_errors(self):
+        """Ошибка базы при сбросе логируется, а пачка остаётся в буфере до следующего сброса"""
+        self.client.get(reverse('post_list', args=[self.thread.id]), {'page': 1})
+        with mock.patch.object(Thread.objects, 'filter', side_effect=RuntimeError('no such table')), \
+                self.assertLogs('main.read_markers', 'ERROR'):
+            self.assertEqual(read_markers.flush(), 0)
+        self.assertEqual(read_markers.pending_markers(self.reader.id), {self.thread.id: self.posts[9].id})
+        read_markers.mark_read(self.reader.id, self.thread.id, self.posts[3].id)
+        self.assertEqual(read_markers.flush(), 1)
+        marker = ThreadReadMarker.objects.get(user=self.reader, thread=self.thread)
+        self.assertEqual(marker.last_read_post_id, self.posts[9].id)
+
+    def test_first_unread_lands_on_right_page(self):
+        """Ссылка на первое непрочитанное ведёт на нужную страницу"""
+        self.client.get(reverse('post_list', args=[self.thread.id]), {'page': 1})
+        read_markers.flush()
+        response = self.client.get(reverse('first_unread', args=[self.thread.id]))
+        target = self.posts[10]
+        expected = reverse('post_list', args=[self.thread.id]) + f'?page=2#post-{target.id}'
+        self.assertRedirects(response, expected, fetch_redirect_response=False)
+
+
+def make_image_file(name='photo.png', size=(1600, 900), image_format='PNG'):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, (200, 80, 40)).save(buffer, format=image_format)
+    return SimpleUploadedFile(name, buffer.getvalue(), content_type=f'image/{image_format.lower()}')
+
+
+class PostImageVariantTestCase(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        section = Section.objects.create(title='Тестовый раздел')
+        subsection = Subsection.objects.create(title='Тестовый подраздел', section=section)
+        self.thread = Thread.objects.create(title='Фототема', author=self.user, subsection=subsection)
+        self.post = Post.objects.create(text='Фото', image=make_image_file(), author=self.user, thread=self.thread)
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def test_generates_smaller_variants_only(self):
+        """Создаются WebP и JPEG для ширин меньше оригинала"""
+        generate_post_variants(self.post)
+        widths = set(self.post.image_variants.values_list('format', 'width'))
+        self.assertEqual(widths, {
+            (fmt, width) for fmt in ('webp', 'jpeg') for width in (320, 640, 1280)
+        })
+        variant = self.post.image_variants.get(format='jpeg', width=640)
+        self.assertEqual(variant.height, 360)
+
+    def test_post_list_emits_srcset(self):
+        """Страница темы отдаёт srcset и ленивую загрузку"""
+        generate_post_variants(self.post)
+        response = self.client.get(reverse('post_list', args=[self.thread.id]))
+        self.assertContains(response, 'type="image/webp"')
+        self.assertContains(response, '640w')
+        self.assertContains(response, f'{self.post.image.url} 1600w', count=2)
+        self.assertContains(response, 'loading="lazy"')
+
+    def test_regeneration_replaces_variants(self):
+        """Повторная генерация не плодит дубликаты"""
+        generate_post_variants(self.post)
+        generate_post_variants(self.post)
+        self.assertEqual(PostImageVariant.objects.count(), 6)
+
+
+class AvatarProcessingTestCase(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+        self.user = User.objects.create_user(username='testuser', password='12345')
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def test_login_does_not_touch_profile(self):
+        """Вход не сохраняет профиль и не открывает аватар"""
+        with mock.patch.object(Profile, 'save') as profile_save:
+            self.client.login(username='testuser', password='12345')
+        profile_save.assert_not_called()
+
+    def test_upload_records_hash_and_schedules_variants_once(self):
+        """Новый аватар обрабатывается один раз"""
+        profile = self.user.profile
+        profile.avatar = make_image_file('me.png', size=(640, 480))
+        with mock.patch('main.images.schedule_avatar_variants') as schedule:
+            profile.save()
+            self.assertEqual((profile.avatar_width, profile.avatar_height), (640, 480))
+            self.assertEqual(len(profile.avatar_hash), 64)
+            schedule.assert_called_once_with(profile.pk)
+
+            profile.bio = 'Обо мне'
+            profile.save()
+            self.user.save()
+            schedule.assert_called_once()
+
+    def test_variants_are_used_for_urls(self):
+        """До фоновой обработки — стандартный аватар, после — уменьшенные копии"""
+        profile = self.user.profile
+        profile.avatar = make_image_file('me.png', size=(640, 480))
+        with mock.patch('main.images.schedule_avatar_variants'):
+            profile.save()
+        self.assertEqual(profile.avatar_small_url, static('images/default-avatar.png'))
+        generate_avatar_variants(profile)
+        profile.refresh_from_db()
+        self.assertEqual(set(profile.avatar_variants), {'40', '96', '300'})
+        self.assertIn('_96.webp', profile.avatar_medium_url)
+        with Image.open(profile.avatar.storage.path(profile.avatar_variants['40'])) as thumb:
+            self.assertEqual(thumb.size, (40, 40))
+
+
+class ContentAddressedMediaTestCase(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        section = Section.objects.create(title='Тестовый раздел')
+        subsection = Subsection.objects.create(title='Тестовый подраздел', section=section)
+        self.thread = Thread.objects.create(title='Фототема', author=self.user, subsection=subsection)
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def make_post(self):
+        return Post.objects.create(text='Фото', image=make_image_file(), author=self.user, thread=self.thread)
+
+    def test_same_upload_is_stored_once(self):
+        """Одинаковые изображения хранятся одним файлом со счётчиком ссылок"""
+        first, second = self.make_post(), self.make_post()
+        self.assertEqual(first.image.name, second.image.name)
+        self.assertRegex(first.image.name, r'^posts/[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}\.png$')
+        self.assertEqual(MediaBlob.objects.get(name=first.image.name).refcount, 2)
+
+    def test_file_removed_with_last_reference(self):
+        """Файл удаляется только вместе с последней ссылкой"""
+        first, second = self.make_post(), self.make_post()
+        path = first.image.path
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertTrue(os.path.exists(path))
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(MediaBlob.objects.exists())
+
+    def test_reupload_before_deletion_keeps_file(self):
+        """Повторная загрузка, пока удаление файла ждёт коммита, сохраняет файл"""
+        first = self.make_post()
+        path = first.image.path
+        with self.captureOnCommitCallbacks() as callbacks:
+            first.delete()
+        self.assertEqual(MediaBlob.objects.get(name=first.image.name).refcount, 0)
+        second = self.make_post()
+        for callback in callbacks:
+            callback()
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(MediaBlob.objects.get(name=second.image.name).refcount, 1)
+
+    def test_replacing_image_releases_old_file(self):
+        """Замена изображения отпускает старый файл"""
+        post = Post.objects.get(pk=self.make_post().pk)
+        old_name = post.image.name
+        post.image = make_image_file('other.jpg', image_format='JPEG')
+        with self.captureOnCommitCallbacks(execute=True):
+            post.save()
+        self.assertFalse(MediaBlob.objects.filter(name=old_name).exists())
+        self.assertEqual(MediaBlob.objects.get(name=post.image.name).refcount, 1)
+
+    def test_dedupe_media_moves_legacy_files(self):
+        """dedupe_media переносит старые файлы и пересчитывает ссылки"""
+        from django.core.files.storage import default_storage
+        from django.core.management import call_command
+
+        legacy = [default_storage.save('posts/legacy.png', make_image_file()) for _ in range(2)]
+        posts = [self.make_post() for _ in range(2)]
+        for post, name in zip(posts, legacy):
+            Post.objects.filter(pk=post.pk).update(image=name)
+        call_command('dedupe_media', stdout=io.StringIO())
+        names = set(Post.objects.values_list('image', flat=True))
+        self.assertEqual(len(names), 1)
+        self.assertEqual(MediaBlob.objects.get(name=names.pop()).refcount, 2)
+        self.assertFalse(any(default_storage.exists(name) for name in legacy))
+
+
+class ImageMetadataTestCase(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        section = Section.objects.create(title='Тестовый раздел')
+        subsection = Subsection.objects.create(title='Тестовый подраздел', section=section)
+        self.thread = Thread.objects.create(title='Фототема', author=self.user, subsection=subsection)
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def test_metadata_recorded_on_upload(self):
+        """При загрузке сохраняются размеры, вес и формат"""
+        upload = make_image_file('photo.jpg', size=(800, 600), image_format='JPEG')
+        post = Post.objects.create(text='Фото', image=upload, author=self.user, thread=self.thread)
+        post.refresh_from_db()
+        self.assertEqual((post.image_width, post.image_height, post.image_format), (800, 600, 'jpeg'))
+        self.assertEqual(post.image_bytes, upload.size)
+
+    def test_exif_rotation_swaps_dimensions(self):
+        """Для снимка, повёрнутого по EXIF, сохраняются размеры после поворота"""
+        buffer = io.BytesIO()
+        exif = Image.Exif()
+        exif[0x0112] = 6  # Orientation: повернуть на 90°
+        Image.new('RGB', (800, 600), (200, 80, 40)).save(buffer, format='JPEG', exif=exif)
+        upload = SimpleUploadedFile('phone.jpg', buffer.getvalue(), content_type='image/jpeg')
+        post = Post.objects.create(text='Фото', image=upload, author=self.user, thread=self.thread)
+        self.assertEqual((post.image_width, post.image_height), (600, 800))
+
+    def test_template_emits_dimensions(self):
+        """Картинка в теме выводится с width и height"""
+        Post.objects.create(text='Фото', image=make_image_file(size=(800, 600)), author=self.user, thread=self.thread)
+        response = self.client.get(reverse('post_list', args=[self.thread.id]))
+        self.assertContains(response, 'width="800" height="600"')
+
+    def test_backfill_fills_missing_metadata(self):
+        """backfill_image_metadata заполняет поля у старых записей"""
+        from django.core.management import call_command
+
+        post = Post.objects.create(text='Фото', image=make_image_file(size=(320, 200)), author=self.user, thread=self.thread)
+        Post.objects.filter(pk=post.pk).update(image_width=None, image_height=None, image_bytes=None, image_format='')
+        call_command('backfill_image_metadata', stdout=io.StringIO())
+        post.refresh_from_db()
+        self.assertEqual((post.image_width, post.image_height, post.image_format), (320, 200, 'png'))
+        self.assertEqual(post.image_bytes, post.image.size)
+
+
+def make_png_header(width, height):
+    """Валидный заголовок PNG с заданными размерами (без пиксельных данных)."""
+    import struct
+    import zlib
+
+    ihdr = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    chunk = b'IHDR' + ihdr
+    return b'\x89PNG\r\n\x1a\n' + struct.pack('>I', len(ihdr)) + chunk + struct.pack('>I', zlib.crc32(chunk))
+
+
+class UploadValidationTestCase(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        section = Section.objects.create(title='Тестовый раздел')
+        subsection = Subsection.objects.create(title='Тестовый подраздел', section=section)
+        self.thread = Thread.objects.create(title='Фототема', author=self.user, subsection=subsection)
+        self.client.login(username='testuser', password='12345')
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def post_image(self, upload):
+        return self.client.post(reverse('new_post', args=[self.thread.id]), {'text': 'Фото', 'image': upload})
+
+    def test_pixel_bomb_rejected_by_header(self):
+        """PNG с огромными заявленными размерами отклоняется по заголовку"""
+        bomb = SimpleUploadedFile('bomb.png', make_png_header(30000, 30000) + b'\0' * 1024, content_type='image/png')
+        with mock.patch('main.models.read_image_header') as read_header:
+            self.post_image(bomb)
+        read_header.assert_not_called()
+        self.assertFalse(Post.objects.exists())
+
+    def test_fake_image_rejected_by_signature(self):
+        """Файл с расширением .png, но без сигнатуры PNG, отклоняется"""
+        self.post_image(SimpleUploadedFile('fake.png', b'<?php echo 1; ?>' * 10, content_type='image/png'))
+        self.assertFalse(Post.objects.exists())
+
+    @override_settings(UPLOAD_IMAGE_FIELDS={'image': {'max_bytes': 1024, 'max_pixels': 10_000_000}})
+    def test_oversized_upload_aborted(self):
+        """Превышение лимита по байтам обрывает приём файла"""
+        response = self.post_image(make_image_file(size=(400, 400)))
+        self.assertFalse(Post.objects.exists())
+        self.assertIn('image', response.wsgi_request.upload_errors)
+
+    def test_valid_image_accepted(self):
+        """Обычное изображение проходит проверку"""
+        self.post_image(make_image_file('photo.jpg', size=(800, 600), image_format='JPEG'))
+        self.assertEqual(Post.objects.get().image_width, 800)
+
+    def test_avatar_bomb_shows_form_error(self):
+        """Отклонённый аватар показывает ошибку в форме"""
+        bomb = SimpleUploadedFile('bomb.png', make_png_header(20000, 20000), content_type='image/png')
+        response = self.client.post(reverse('update_avatar'), {'avatar': bomb})
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Слишком большое изображение')
+
+
+class MediaServingTestCase(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+        os.makedirs(os.path.join(self.media_root, 'posts'))
+        with open(os.path.join(self.media_root, 'posts', 'photo.png'), 'wb') as f:
+            f.write(make_image_file().read())
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def write_file(self, name):
+        os.makedirs(os.path.dirname(os.path.join(self.media_root, name)), exist_ok=True)
+        with open(os.path.join(self.media_root, name), 'wb') as f:
+            f.write(b'data')
+
+    @override_settings(MEDIA_SENDFILE_BACKEND='nginx')
+    def test_nginx_gets_accel_redirect(self):
+        """С nginx view отдаёт только заголовок X-Accel-Redirect, а для отсутствующего файла — 404"""
+        name = 'posts/ab/cd/' + 'abcd' * 16 + '.png'
+        self.assertEqual(self.client.get('/media/' + name).status_code, 404)
+        self.write_file(name)
+        response = self.client.get('/media/' + name)
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-media/' + name)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertEqual(response.content, b'')
+        self.assertIn('immutable', response['Cache-Control'])
+
+    @override_settings(MEDIA_SENDFILE_BACKEND='sendfile')
+    def test_private_files_checked_before_sendfile(self):
+        """Закрытые файлы отдаются только при успешной проверке доступа"""
+        from .media import MEDIA_ACCESS_RULES, register_media_access
+
+        register_media_access('attachments/', lambda request, path: request.user.is_authenticated)
+        self.addCleanup(MEDIA_ACCESS_RULES.clear)
+        self.assertEqual(self.client.get('/media/attachments/1/file.pdf').status_code, 404)
+
+        User.objects.create_user(username='testuser', password='12345')
+        self.client.login(username='testuser', password='12345')
+        self.write_file('attachments/1/file.pdf')
+        response = self.client.get('/media/attachments/1/file.pdf')
+        self.assertTrue(response['X-Sendfile'].endswith('attachments/1/file.pdf'))
+        self.assertIn('private', response['Cache-Control'])
+
+    def test_proxy_serves_public_files_itself(self):
+        """С прокси через Django идут только закрытые префиксы"""
+        from .media import MEDIA_ACCESS_RULES, media_urlpatterns, register_media_access
+
+        self.assertEqual(len(media_urlpatterns()), 1)
+        with override_settings(MEDIA_SENDFILE_BACKEND='nginx'):
+            self.assertEqual(media_urlpatterns(), [])
+            with override_settings(MEDIA_PRIVATE_PREFIXES=['attachments/']):
+                pattern = media_urlpatterns()[0].pattern
+                self.assertTrue(pattern.match('media/attachments/1/file.pdf'))
+                self.assertIsNone(pattern.match('media/posts/photo.png'))
+            register_media_access('dm/', lambda request, path: True)
+            self.addCleanup(MEDIA_ACCESS_RULES.clear)
+            self.assertTrue(media_urlpatterns()[0].pattern.match('media/dm/1.png'))
+
+    def test_traversal_and_fallback(self):
+        """Выход за MEDIA_ROOT запрещён; без прокси файл отдаёт Django"""
+        self.assertEqual(self.client.get('/media/../settings.py').status_code, 404)
+        response = self.client.get('/media/posts/photo.png')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('max-age=86400', response['Cache-Control'])
+
+
+@tasks.task(max_attempts=2)
+def flaky_task(log):
+    """Тестовая задача: падает, пока не получит 'ok'."""
+    if log != 'ok':
+        raise ValueError(log)
+
+
+class TaskQueueTestCase(TestCase):
+    @override_settings(TASKS_EAGER=False)
+    def test_enqueued_in_transaction_and_run_by_worker(self):
+        """Задача пишется в очередь и выполняется воркером"""
+        flaky_task.delay('ok')
+        self.assertEqual(Task.objects.count(), 1)
+        self.assertEqual(tasks.run_pending(), 1)
+        self.assertFalse(Task.objects.exists())
+
+    @override_settings(TASKS_EAGER=False)
+    def test_failure_retried_with_backoff_then_failed(self):
+        """Упавшая задача откладывается, затем помечается ошибочной"""
+        flaky_task.delay('boom')
+        with self.assertLogs('main.tasks', 'ERROR'):
+            tasks.run_pending()
+        task_row = Task.objects.get()
+        self.assertEqual((task_row.status, task_row.attempts), (Task.STATUS_QUEUED, 1))
+        self.assertGreater(task_row.run_at, timezone.now())
+        self.assertEqual(tasks.run_pending(), 0)
+
+        Task.objects.update(run_at=timezone.now())
+        with self.assertLogs('main.tasks', 'ERROR'):
+            tasks.run_pending()
+        task_row.refresh_from_db()
+        self.assertEqual(task_row.status, Task.STATUS_FAILED)
+        self.assertIn('ValueError: boom', task_row.last_error)
+
+    @override_settings(TASKS_EAGER=False)
+    def test_stuck_task_counts_attempts(self):
+        """Зависшая задача возвращается в очередь как новая попытка, а затем помечается ошибочной"""
+        task_row = flaky_task.delay('ok')
+        stuck_at = timezone.now() - tasks.lock_timeout() - timezone.timedelta(seconds=1)
+        Task.objects.update(status=Task.STATUS_RUNNING, locked_at=stuck_at, locked_by='dead')
+        claimed = tasks.claim(10, 'worker')
+        self.assertEqual([(row.pk, row.attempts) for row in claimed], [(task_row.pk, 1)])
+
+        Task.objects.update(locked_at=stuck_at)
+        self.assertEqual(tasks.claim(10, 'worker'), [])
+        task_row.refresh_from_db()
+        self.assertEqual((task_row.status, task_row.attempts), (Task.STATUS_FAILED, 2))
+        self.assertIn('TASKS_LOCK_TIMEOUT', task_row.last_error)
+
+    @override_settings(TASKS_EAGER=False)
+    def test_slow_worker_does_not_touch_reclaimed_task(self):
+        """Воркер, потерявший аренду, не удаляет и не перезаписывает задачу"""
+        flaky_task.delay('ok')
+        slow, = tasks.claim(10, 'slow')
+        Task.objects.update(locked_at=timezone.now() - tasks.lock_timeout() - timezone.timedelta(seconds=1))
+        fresh, = tasks.claim(10, 'fresh')
+        with self.assertLogs('main.tasks', 'WARNING'):
+            self.assertTrue(tasks.execute(slow))
+        self.assertEqual(Task.objects.get().locked_by, 'fresh')
+        slow.args = ['boom']
+        with self.assertLogs('main.tasks', 'WARNING') as logs:
+            self.assertFalse(tasks.execute(slow))
+        self.assertTrue(any('другому воркеру' in line for line in logs.output))
+        self.assertEqual((Task.objects.get().status, Task.objects.get().locked_by), (Task.STATUS_RUNNING, 'fresh'))
+        self.assertTrue(tasks.execute(fresh))
+        self.assertFalse(Task.objects.exists())
+
+    @override_settings(TASKS_EAGER=True)
+    def test_eager_mode_runs_after_commit(self):
+        """В eager-режиме задача выполняется после коммита, без строки в очереди"""
+        with mock.patch.object(flaky_task, 'func') as func:
+            with self.captureOnCommitCallbacks(execute=True):
+                flaky_task.delay('ok')
+                func.assert_not_called()
+        func.assert_called_once_with('ok')
+        self.assertFalse(Task.objects.exists())
+
+
+@override_settings(PURGE_BATCH_SIZE=2, TASKS_EAGER=True)
+class SoftDeleteTestCase(TestCase):
+    def setUp(self):
+        self.staff = User.objects.create_user(username='moder', password='12345', is_staff=True)
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        section = Section.objects.create(title='Тестовый раздел')
+        self.subsection = Subsection.objects.create(title='Тестовый подраздел', section=section)
+        self.thread = Thread.objects.create(title='Большая тема', author=self.user, subsection=self.subsection)
+        for i in range(5):
+            Post.objects.create(text=f'Сообщение {i}', author=self.user, thread=self.thread)
+
+    def search_count(self, query):
+        return self.client.get(reverse('search'), {'q': query}).context['results'].paginator.count
+
+    def test_thread_hidden_then_purged_in_batches(self):
+        """Тема скрывается сразу, а сообщения удаляются в фоне пачками"""
+        self.client.login(username='moder', password='12345')
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.client.post(reverse('delete_thread', args=[self.thread.id]))
+        self.assertEqual(self.client.get(reverse('post_list', args=[self.thread.id])).status_code, 404)
+        self.assertEqual(Post.objects.count(), 5)
+        self.assertEqual(self.search_count('Сообщение'), 0)
+        self.assertEqual(self.search_count('Большая'), 0)
+
+        for callback in callbacks:
+            callback()
+        self.assertFalse(Thread.all_objects.exists())
+        self.assertFalse(Post.objects.exists())
+        self.assertEqual(get_forum_stats()['posts'], 0)
+
+    def test_user_purge_removes_content(self):
+        """Удаление пользователя: отключение сразу, содержимое — в фоне"""
+        other_thread = Thread.objects.create(title='Чужая тема', author=self.staff, subsection=self.subsection)
+        Post.objects.create(text='Ответ', author=self.user, thread=other_thread)
+        WallPost.objects.create(owner=self.staff, author=self.user, body='Привет')
+        with self.captureOnCommitCallbacks(execute=True):
+            purge.soft_delete_user(self.user)
+        self.assertFalse(User.objects.filter(username='testuser').exists())
+        self.assertFalse(Post.objects.filter(author_id=self.user.id).exists())
+        self.assertFalse(WallPost.all_objects.exists())
+        self.assertEqual(Thread.objects.get().title, 'Чужая тема')
+
+    def test_user_posts_hidden_before_purge(self):
+        """Сообщения удалённого пользователя в чужих темах скрыты до фоновой очистки"""
+        other_thread = Thread.objects.create(title='Чужая тема', author=self.staff, subsection=self.subsection)
+        Post.objects.create(text='Вопрос модератора', author=self.staff, thread=other_thread)
+        Post.objects.create(text='Ответ пользователя', author=self.user, thread=other_thread)
+        self.assertEqual(self.search_count('Ответ'), 1)
+        with self.captureOnCommitCallbacks():
+            purge.soft_delete_user(self.user)
+        response = self.client.get(reverse('post_list', args=[other_thread.id]))
+        self.assertContains(response, 'Вопрос модератора')
+        self.assertNotContains(response, 'Ответ пользователя')
+        self.assertEqual(self.search_count('Ответ'), 0)
+        self.assertEqual(self.search_count('Сообщение'), 0)
+
+    def test_user_comments_and_dialogs_hidden_before_purge(self):
+        """Комментарии удалённого пользователя на чужих стенах и диалоги с ним скрыты до очистки"""
+        wall_post = WallPost.objects.create(owner=self.staff, author=self.staff, body='Запись')
+        WallComment.objects.create(post=wall_post, author=self.user, body='Комментарий пользователя')
+        conversation = sharding.create_conversation(self.staff, self.user)
+        conversation.messages.create(sender=self.user, recipient=self.staff, body='Личное')
+        with self.captureOnCommitCallbacks():
+            purge.soft_delete_user(self.user)
+        response = self.client.get(reverse('user_profile', args=[self.staff.id]))
+        self.assertContains(response, 'Запись')
+        self.assertNotContains(response, 'Комментарий пользователя')
+        self.client.login(username='moder', password='12345')
+        self.assertEqual(self.client.get(reverse('messages_list')).context['conversation_items'], [])
+        self.assertRedirects(self.client.get(reverse('message_detail', args=[conversation.id])),
+                             reverse('messages_list'))
+        self.assertEqual(self.client.get(reverse('message_poll', args=[conversation.id])).status_code, 404)
+
+    def test_admin_user_delete_is_soft(self):
+        """Удаление пользователя в админке отключает его сразу, а содержимое чистит в фоне"""
+        User.objects.filter(pk=self.staff.pk).update(is_superuser=True)
+        self.client.login(username='moder', password='12345')
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.post(reverse('admin:auth_user_delete', args=[self.user.id]), {'post': 'yes'})
+        self.assertEqual(response.status_code, 302)
+        self.user.refresh_from_db()
+        self.assertFalse(self.user.is_active)
+        self.assertIsNotNone(self.user.profile.deleted_at)
+        self.assertEqual(Post.objects.count(), 5)
+        for callback in callbacks:
+            callback()
+        self.assertFalse(User.objects.filter(pk=self.user.pk).exists())
+
+    def test_post_page_url_skips_hidden_posts(self):
+        """Номер страницы не считает скрытые сообщения, а без удалённых пользователей — только таблицу сообщений"""
+        other_thread = Thread.objects.create(title='Чужая тема', author=self.staff, subsection=self.subsection)
+        for i in range(10):
+            Post.objects.create(text=f'Ответ {i}', author=self.user, thread=other_thread)
+        target = Post.objects.create(text='Итог', author=self.staff, thread=other_thread)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertIn('?page=2#', post_page_url(target))
+        counts = [query['sql'] for query in queries if 'COUNT(' in query['sql']]
+        self.assertEqual(len(counts), 1)
+        self.assertNotIn('JOIN', counts[0])
+        with self.captureOnCommitCallbacks():
+            purge.soft_delete_user(self.user)
+        self.assertEqual(post_page_url(target), reverse('post_list', args=[other_thread.id]) + f'#post-{target.id}')
+
+    def test_wall_post_soft_delete(self):
+        """Запись стены пропадает из профиля и удаляется вместе с комментариями"""
+        wall_post = WallPost.objects.create(owner=self.user, author=self.user, body='Запись')
+        WallComment.objects.create(post=wall_post, author=self.staff, body='Комментарий')
+        with self.captureOnCommitCallbacks() as callbacks:
+            purge.soft_delete_wall_post(wall_post)
+        self.assertFalse(self.user.wall_posts.exists())
+        for callback in callbacks:
+            callback()
+        self.assertFalse(WallComment.objects.exists())
+
+
+class ProfileWallTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        self.guest = User.objects.create_user(username='guest', password='12345')
+
+    def test_wall_keyset_pagination(self):
+        """Стена листается курсором без пропусков и повторов"""
+        WallPost.objects.bulk_create([
+            WallPost(owner=self.user, author=self.guest, body=f'Запись {i}') for i in range(25)
+        ])
+        url = reverse('user_profile', args=[self.user.id])
+        first = self.client.get(url)
+        self.assertEqual(len(first.context['wall_posts']), 20)
+        second = self.client.get(url, {'wall_before': first.context['wall_next_cursor']})
+        ids = [p.id for p in first.context['wall_posts']] + [p.id for p in second.context['wall_posts']]
+        self.assertEqual(sorted(ids), sorted(WallPost.objects.values_list('id', flat=True)))
+        self.assertEqual(second.context['wall_next_cursor'], '')
+
+    def test_latest_comments_inline_and_load_more(self):
+        """К записи выводятся последние комментарии, остальные — по запросу"""
+        wall_post = WallPost.objects.create(owner=self.user, author=self.guest, body='Запись')
+        comments = [WallComment.objects.create(post=wall_post, author=self.guest, body=f'Комментарий {i}')
+                    for i in range(5)]
+        response = self.client.get(reverse('user_profile', args=[self.user.id]))
+        item = response.context['wall_posts'][0]
+        self.assertEqual([c.id for c in item.latest_comments], [c.id for c in comments[-3:]])
+        self.assertEqual(item.hidden_comments, 2)
+
+        more = self.client.get(reverse('wall_comments', args=[self.user.id, wall_post.id]),
+                               {'before': item.comments_cursor}).json()
+        self.assertIn('Комментарий 0', more['html'])
+        self.assertNotIn('Комментарий 2', more['html'])
+        self.assertIsNone(more['next'])
+
+
+class ProfileCountersTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        self.guest = User.objects.create_user(username='guest', password='12345')
+        section = Section.objects.create(title='Тестовый раздел')
+        self.subsection = Subsection.objects.create(title='Тестовый подраздел', section=section)
+
+    def counters(self, user):
+        profile = Profile.objects.get(user=user)
+        return profile.posts_count, profile.threads_count, profile.wall_posts_count
+
+    def test_counters_follow_create_and_delete(self):
+        """Счётчики профиля меняются при создании и удалении"""
+        thread = Thread.objects.create(title='Тема', author=self.user, subsection=self.subsection)
+        post = Post.objects.create(text='Первый', author=self.user, thread=thread)
+        Post.objects.create(text='Второй', author=self.guest, thread=thread)
+        WallPost.objects.create(owner=self.user, author=self.guest, body='Привет')
+        self.assertEqual(self.counters(self.user), (1, 1, 1))
+        self.assertEqual(self.counters(self.guest), (1, 0, 0))
+
+        post.delete()
+        self.assertEqual(self.counters(self.user), (0, 1, 1))
+
+    def test_stale_profile_save_keeps_counters(self):
+        """Сохранение устаревшего объекта профиля не затирает счётчики"""
+        profile = Profile.objects.get(user=self.user)
+        thread = Thread.objects.create(title='Тема', author=self.user, subsection=self.subsection)
+        Post.objects.create(text='Первый', author=self.user, thread=thread)
+        profile.save()
+        self.assertEqual(self.counters(self.user), (1, 1, 0))
+
+    @override_settings(PURGE_BATCH_SIZE=2, TASKS_EAGER=True)
+    def test_soft_delete_and_purge(self):
+        """Мягкое удаление и очистка вычитают счётчики ровно один раз"""
+        thread = Thread.objects.create(title='Тема', author=self.user, subsection=self.subsection)
+        for i in range(3):
+            Post.objects.create(text=f'Сообщение {i}', author=self.guest, thread=thread)
+        with self.captureOnCommitCallbacks(execute=True):
+            purge.soft_delete_thread(thread)
+        self.assertEqual(self.counters(self.user), (0, 0, 0))
+        self.assertEqual(self.counters(self.guest), (0, 0, 0))
+
+    def test_reconcile_fixes_drift(self):
+        """Сверка пересчитывает счётчики после обхода сигналов"""
+        thread = Thread.objects.create(title='Тема', author=self.user, subsection=self.subsection)
+        Post.objects.bulk_create([Post(text=f'Сообщение {i}', author=self.user, thread=thread) for i in range(3)])
+        self.assertEqual(self.counters(self.user), (0, 1, 0))
+        self.assertEqual(reconcile_profile_counters(batch_size=1), (2, 1))
+        self.assertEqual(self.counters(self.user), (3, 1, 0))
+
+    def test_profile_page_reads_counters(self):
+        """Страница профиля не считает сообщения и темы запросом COUNT"""
+        thread = Thread.objects.create(title='Тема', author=self.user, subsection=self.subsection)
+        Post.objects.create(text='Первый', author=self.user, thread=thread)
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('user_profile', args=[self.user.id]))
+        self.assertEqual(response.context['post_count'], 1)
+        self.assertEqual(response.context['thread_count'], 1)
+
+
+class MetricsTestCase(TestCase):
+    def setUp(self):
+        metrics.reset()
+        self.staff = User.objects.create_user(username='moder', password='12345', is_staff=True)
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        section = Section.objects.create(title='Тестовый раздел')
+        subsection = Subsection.objects.create(title='Тестовый подраздел', section=section)
+        self.thread = Thread.objects.create(title='Тема', author=self.user, subsection=subsection)
+        Post.objects.create(text='Сообщение', author=self.user, thread=self.thread)
+
+    def tearDown(self):
+        metrics.reset()
+
+    def test_request_recorded_per_view(self):
+        """Запрос учитывается под именем URL вместе с SQL, шаблонами и размером"""
+        response = self.client.get(reverse('post_list', args=[self.thread.id]))
+        entry = metrics.snapshot()['post_list']
+        self.assertEqual(entry['count'], 1)
+        self.assertGreater(entry['queries'], 0)
+        self.assertGreater(entry['template_seconds'], 0)
+        self.assertEqual(entry['response_bytes'], len(response.content))
+
+    def test_endpoint_is_staff_only(self):
+        """/metrics отдаётся только персоналу или по токену"""
+        self.client.get(reverse('post_list', args=[self.thread.id]))
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        self.client.login(username='testuser', password='12345')
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+
+        self.client.login(username='moder', password='12345')
+        body = self.client.get('/metrics').content.decode()
+        self.assertIn('forum_request_duration_seconds_bucket{view="post_list",le="+Inf"} 1', body)
+        self.assertIn('forum_db_queries_total{view="post_list"}', body)
+
+        self.client.logout()
+        with override_settings(METRICS_TOKEN='secret'):
+            response = self.client.get('/metrics', headers={'Authorization': 'Bearer secret'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_shared_dir_sums_workers(self):
+        """В общем каталоге снимки воркеров суммируются"""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with override_settings(METRICS_SHARED_DIR=directory):
+            self.client.get(reverse('post_list', args=[self.thread.id]))
+            other_worker = metrics.snapshot()
+            with open(os.path.join(directory, f'{os.getppid()}-1.json'), 'w') as fh:
+                json.dump(other_worker, fh)
+            self.assertEqual(metrics.collect()['post_list']['count'], 2)
+
+    def test_dead_worker_snapshots_retired(self):
+        """Снимок умершего воркера переносится в сводку и удаляется, не теряя счётчиков"""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with override_settings(METRICS_SHARED_DIR=directory):
+            self.client.get(reverse('post_list', args=[self.thread.id]))
+            other_worker = metrics.snapshot()
+            with mock.patch.object(metrics, '_is_alive', side_effect=lambda pid: pid != 999999):
+                with open(os.path.join(directory, '999999-1.json'), 'w') as fh:
+                    json.dump(other_worker, fh)
+                self.assertEqual(metrics.collect()['post_list']['count'], 2)
+                self.assertNotIn('999999-1.json', os.listdir(directory))
+                self.assertIn(metrics.RETIRED_FILE, os.listdir(directory))
+                self.assertEqual(metrics.collect()['post_list']['count'], 2)
+            # Новый процесс с тем же pid пишет свой файл и не затирает учтённые счётчики.
+            with open(os.path.join(directory, '999999-2.json'), 'w') as fh:
+                json.dump(other_worker, fh)
+            self.assertEqual(metrics.collect()['post_list']['count'], 3)
+
+
+@override_settings(QUERY_BUDGETS_STRICT=True)
+class QueryBudgetTestCase(TestCase):
+    def setUp(self):
+        self.users = [User.objects.create_user(username=f'user{i}', password='12345') for i in range(10)]
+        self.me = self.users[0]
+        for i in range(5):
+            section = Section.objects.create(title=f'Раздел {i}')
+            subsection = Subsection.objects.create(title=f'Подраздел {i}', section=section)
+            for k in range(3):
+                self.thread = Thread.objects.create(title=f'Тема {i}.{k}', author=self.users[i + k],
+                                                    subsection=subsection, is_pinned=i % 2 == 0)
+                Post.objects.bulk_create([Post(text=f'Сообщение {j}', author=user, thread=self.thread)
+                                          for j, user in enumerate(self.users)])
+        for user in self.users[1:]:
+            conversation = Conversation.objects.create()
+            conversation.participants.add(self.me, user)
+            Message.objects.create(conversation=conversation, sender=user, recipient=self.me, body='Привет')
+        self.client.force_login(self.me)
+
+    def test_views_fit_budgets(self):
+        """Представления укладываются в бюджет запросов при заполненной базе"""
+        for url in (reverse('post_list', args=[self.thread.id]),
+                    reverse('section_list'),
+                    reverse('messages_poll'),
+                    reverse('thread_list', args=[self.thread.subsection_id]),
+                    reverse('user_profile', args=[self.me.id])):
+            self.assertEqual(self.client.get(url).status_code, 200, url)
+
+    def test_exceeded_budget_fails(self):
+        """Превышение бюджета в строгом режиме — исключение"""
+        with override_settings(QUERY_BUDGETS={'post_list': 1}):
+            with self.assertRaises(QueryBudgetExceeded):
+                self.client.get(reverse('post_list', args=[self.thread.id]))
+
+    @override_settings(NPLUSONE_THRESHOLD=3)
+    def test_nplusone_reports_call_site(self):
+        """Повторяющийся запрос попадает в лог вместе с местом вызова"""
+        inspector = QueryInspector(track_shapes=True)
+        with connection.execute_wrapper(inspector):
+            for user in self.users[:4]:
+                Profile.objects.get(user=user)
+        with self.assertLogs('main.query_budgets', 'WARNING') as logs:
+            inspector.report('test')
+        self.assertIn('main/tests.py', logs.output[0])
+        self.assertIn('test_nplusone_reports_call_site', logs.output[0])
+
+
+class SlowQueryLogTestCase(TestCase):
+    def setUp(self):
+        slow_queries.reset()
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        section = Section.objects.create(title='Тестовый раздел')
+        subsection = Subsection.objects.create(title='Тестовый подраздел', section=section)
+        self.thread = Thread.objects.create(title='Тема', author=self.user, subsection=subsection)
+
+    def test_slow_query_logged_with_view_and_call_site(self):
+        """Медленный запрос пишется с параметрами, представлением и местом вызова"""
+        with override_settings(SLOW_QUERY_THRESHOLD_MS=0), self.assertLogs('main.slow_queries', 'WARNING') as logs:
+            self.client.get(reverse('post_list', args=[self.thread.id]))
+        thread_query = next(line for line in logs.output if 'FROM "main_thread"' in line)
+        self.assertIn('в post_list', thread_query)
+        self.assertIn('main/views.py', thread_query)
+        self.assertIn(f'({self.thread.id},', thread_query)
+
+    def test_only_read_queries_explained(self):
+        """План снимается для SELECT и WITH, но не для изменяющих данные или блокирующих строки"""
+        self.assertTrue(slow_queries.is_read_only('  select 1'))
+        self.assertTrue(slow_queries.is_read_only('WITH t AS (SELECT updated_at FROM x) SELECT * FROM t'))
+        self.assertFalse(slow_queries.is_read_only('WITH moved AS (DELETE FROM x RETURNING *) INSERT INTO y SELECT * FROM moved'))
+        self.assertFalse(slow_queries.is_read_only('UPDATE x SET a = 1'))
+        self.assertFalse(slow_queries.is_read_only('SELECT * FROM x WHERE id = 1 FOR UPDATE'))
+        self.assertFalse(slow_queries.is_read_only('SELECT * FROM x FOR NO KEY UPDATE SKIP LOCKED'))
+        self.assertFalse(slow_queries.is_read_only('SELECT * FROM x FOR  share'))
+
+    @override_settings(SLOW_QUERY_EXPLAIN_AFTER=2, SLOW_QUERY_EXPLAIN_RATE=1)
+    def test_repeat_offender_explained(self):
+        """Для повторно медленного запроса снимается план"""
+        with override_settings(SLOW_QUERY_THRESHOLD_MS=0), self.assertLogs('main.slow_queries', 'WARNING') as logs:
+            list(Thread.objects.filter(title='Тема'))
+            self.assertFalse([line for line in logs.output if 'План запроса' in line])
+            list(Thread.objects.filter(title='Другая'))
+        plans = [line for line in logs.output if 'План запроса' in line]
+        self.assertEqual(len(plans), 1)
+        self.assertIn('main_thread', plans[0].split('\n', 1)[1])
+
+
+class SlowQueryReconnectTestCase(TransactionTestCase):
+    @classmethod
+    def setUpClass(cls):
+        # Файловая «реплика»: в отличие от базы в памяти, её соединение можно закрыть и открыть заново.
+        cls.directory = tempfile.mkdtemp()
+        connections.settings = connections.configure_settings({
+            **connections.settings,
+            'late': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': os.path.join(cls.directory, 'late.sqlite3')},
+        })
+        from django.core.management import call_command
+        call_command('migrate', database='late', verbosity=0)
+        cls.databases = {'default', 'late'}
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        connections['late'].close()
+        del connections['late']
+        del connections.settings['late']
+        shutil.rmtree(cls.directory, ignore_errors=True)
+
+    def test_connection_opened_inside_request_keeps_log(self):
+        """Соединение, открытое посреди запроса, не теряет журнал после него"""
+        # Свежий объект соединения, как в новом потоке: к нему ещё не подключён журнал.
+        connections['late'].close()
+        del connections['late']
+        # Чтения уходят на late: соединение открывается внутри обёрток метрик, бюджета и трассировки.
+        with override_settings(DATABASE_REPLICAS=['late'], SLOW_QUERY_THRESHOLD_MS=0):
+            for _ in range(2):
+                cache.clear()
+                with self.assertLogs('main.slow_queries', 'WARNING') as logs:
+                    self.assertEqual(self.client.get(reverse('section_list')).status_code, 200)
+                self.assertTrue(any('FROM "main_section"' in line for line in logs.output))
+                self.assertEqual(connections['late'].execute_wrappers, [slow_queries.log_slow_queries])
+
+
+class TracingTestCase(TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'traces.jsonl')
+        user = User.objects.create_user(username='testuser', password='12345')
+        section = Section.objects.create(title='Тестовый раздел')
+        subsection = Subsection.objects.create(title='Тестовый подраздел', section=section)
+        self.thread = Thread.objects.create(title='Тема', author=user, subsection=subsection)
+        Post.objects.create(text='Привет :smile:', author=user, thread=self.thread)
+
+    def test_sampled_request_exports_nested_spans(self):
+        """Трасса запроса содержит вложенные интервалы view, db, template и emoji"""
+        with override_settings(TRACING_SAMPLE_RATE=1, TRACING_EXPORT_PATH=self.path):
+            self.client.get(reverse('post_list', args=[self.thread.id]))
+        with open(self.path) as fh:
+            lines = fh.readlines()
+        self.assertEqual(len(lines), 1)
+        spans = json.loads(lines[0])['resourceSpans'][0]['scopeSpans'][0]['spans']
+        by_id = {item['spanId']: item for item in spans}
+        root = next(item for item in spans if 'parentSpanId' not in item)
+        self.assertEqual(root['name'], 'GET post_list')
+        view = next(item for item in spans if item['name'] == 'view post_list')
+        self.assertEqual(view['parentSpanId'], root['spanId'])
+        self.assertTrue(any(item['name'] == 'db' for item in spans))
+        emoji = next(item for item in spans if item['name'] == 'emoji')
+        self.assertEqual(by_id[emoji['parentSpanId']]['name'], 'template')
+        self.assertEqual({item['traceId'] for item in spans}, {root['traceId']})
+
+    def test_templates_share_one_render_hook(self):
+        """Метрики и трассировка подписаны на один перехват рендеринга и обе видят шаблон"""
+        from django.template.backends.django import Template
+
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+        with override_settings(TRACING_SAMPLE_RATE=1, TRACING_EXPORT_PATH=self.path):
+            self.client.get(reverse('post_list', args=[self.thread.id]))
+        self.assertEqual(Template.render.__module__, 'main.template_hooks')
+        self.assertGreater(metrics.snapshot()['post_list']['template_seconds'], 0)
+        with open(self.path) as fh:
+            spans = json.loads(fh.readline())['resourceSpans'][0]['scopeSpans'][0]['spans']
+        self.assertTrue(any(item['name'] == 'template' for item in spans))
+
+    def test_db_span_stores_query_shape(self):
+        """В db.statement пишется форма запроса со свёрнутым списком IN"""
+        trace = tracing.Trace()
+        token = tracing._current_trace.set(trace)
+        try:
+            with connection.execute_wrapper(tracing.trace_query):
+                list(Post.objects.filter(id__in=[1, 2, 3]))
+        finally:
+            tracing._current_trace.reset(token)
+        statement = trace.spans[0].attributes['db.statement']
+        self.assertIn('IN (…)', statement)
+        self.assertNotIn('%s, %s', statement)
+
+    def test_unsampled_request_not_exported(self):
+        """Запрос вне выборки не пишет трассу"""
+        with override_settings(TRACING_SAMPLE_RATE=0, TRACING_EXPORT_PATH=self.path):
+            self.client.get(reverse('post_list', args=[self.thread.id]))
+        self.assertFalse(os.path.exists(self.path))
+
+
+class SeedForumTestCase(TestCase):
+    def test_seed_small_forum(self):
+        """seed_forum создаёт заданные объёмы и пересчитывает счётчики"""
+        from django.core.management import call_command
+
+        call_command('seed_forum', users=6, sections=2, subsections=2, threads=5, posts=40, wall_posts=4,
+                     comments=7, conversations=3, messages=12, batch_size=4, seed=1, stdout=io.StringIO())
+        self.assertEqual(User.objects.count(), 6)
+        self.assertEqual(Subsection.objects.count(), 4)
+        self.assertEqual(Post.objects.count(), 40)
+        self.assertEqual(WallComment.objects.count(), 7)
+        self.assertEqual(Message.objects.count(), 12)
+        self.assertEqual(Conversation.participants.through.objects.count(), 6)
+        self.assertFalse(Thread.objects.filter(last_post_id__isnull=True).exists())
+        self.assertEqual(get_forum_stats(), {'users': 6, 'threads': 5, 'posts': 40})
+        self.assertEqual(sum(Profile.objects.values_list('posts_count', flat=True)), 40)
+        # Даты заданы в прошлом, а auto_now_add после команды снова работает.
+        self.assertLess(Post.objects.order_by('created_at').first().created_at,
+                        timezone.now() - timezone.timedelta(minutes=1))
+        self.assertTrue(Post._meta.get_field('created_at').auto_now_add)
+
+
+class ForumBenchTestCase(TestCase):
+    def setUp(self):
+        users = [User.objects.create_user(username=f'user{i}', password='12345') for i in range(3)]
+        section = Section.objects.create(title='Тестовый раздел')
+        subsection = Subsection.objects.create(title='Тестовый подраздел', section=section)
+        thread = Thread.objects.create(title='Тема', author=users[0], subsection=subsection)
+        Post.objects.bulk_create([Post(text=f'Сообщение {i}', author=users[i % 3], thread=thread) for i in range(25)])
+        conversation = Conversation.objects.create()
+        conversation.participants.add(users[0], users[1])
+        Message.objects.create(conversation=conversation, sender=users[1], recipient=users[0], body='Привет')
+
+    def test_report_and_rollback(self):
+        """Отчёт содержит все точки входа, а new_post не оставляет сообщений"""
+        report = benchmark.run(iterations=2, warmup=0)
+        self.assertEqual(set(report['views']), {
+            'section_list', 'thread_list', 'post_list?page=1', 'post_list?page=middle', 'post_list?page=last',
+            'user_profile', 'messages_list', 'messages_poll', 'message_poll', 'new_post',
+        })
+        self.assertEqual(report['views']['post_list?page=last']['status'], 200)
+        self.assertEqual(report['views']['new_post']['status'], 302)
+        self.assertEqual(Post.objects.count(), 25)
+
+    def test_compare_flags_regressions(self):
+        """Сравнение с базовым отчётом находит рост запросов и p95"""
+        baseline = {'views': {'post_list': {'status': 200, 'p95_ms': 10, 'queries': 9}}}
+        report = {'views': {'post_list': {'status': 200, 'p95_ms': 11, 'queries': 9}}}
+        self.assertEqual(benchmark.compare(report, baseline), [])
+        report['views']['post_list'].update(p95_ms=15, queries=12)
+        self.assertEqual(len(benchmark.compare(report, baseline)), 2)
+
+
+class ChatLoadTestCase(TransactionTestCase):
+    def setUp(self):
+        self.users = [User.objects.create_user(username=f'user{i}', password='12345') for i in range(2)]
+        self.last_message_at = timezone.now() - timezone.timedelta(days=1)
+        self.conversation = Conversation.objects.create(last_message_at=self.last_message_at)
+        self.conversation.participants.add(*self.users)
+        Message.objects.create(conversation=self.conversation, sender=self.users[0], recipient=self.users[1], body='Привет')
+        self.typing_at = timezone.now() - timezone.timedelta(hours=1)
+        TypingStatus.objects.create(conversation=self.conversation, user=self.users[0], updated_at=self.typing_at)
+
+    def test_simulation_report(self):
+        """Модель чата опрашивает и пишет через ASGI и убирает за собой"""
+        from forum.asgi import application
+
+        timings = chat_load.ChatTimings(message_poll=0.5, inbox_poll=1, typing_ping=0.5, think=0.5, typing_speed=100)
+        report = chat_load.simulate(application, 2, duration=1, timings=timings, speed=5, seed=1)
+        self.assertEqual(report['users'], 2)
+        self.assertEqual(report['views']['message_poll']['errors'], 0)
+        self.assertEqual(report['views']['messages_poll']['errors'], 0)
+        self.assertIn('message_send', report['views'])
+        self.assertGreater(report['queries'], 0)
+        self.assertEqual(Message.objects.count(), 1)
+        # Прочтение, статусы набора и дата диалога — как до прогона.
+        self.assertFalse(Message.objects.get().is_read)
+        self.assertIsNone(Message.objects.get().read_at)
+        self.assertEqual(list(TypingStatus.objects.values_list('user_id', 'updated_at')),
+                         [(self.users[0].id, self.typing_at)])
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.last_message_at, self.last_message_at)
+
+
+class ReplicaRoutingTestCase(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # «Отстающая» реплика: SQLite в памяти со схемой, но без данных.
+        # Алиас добавляется здесь, а не в DATABASES: тестовые базы уже созданы.
+        connections.settings = connections.configure_settings({
+            **connections.settings,
+            'replica': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'},
+        })
+        from django.core.management import call_command
+        call_command('migrate', database='replica', verbosity=0)
+        cls.databases = {'default', 'replica'}
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        connections['replica'].close()
+        del connections['replica']
+        del connections.settings['replica']
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='reader', password='12345')
+        section = Section.objects.create(title='Раздел')
+        subsection = Subsection.objects.create(title='Подраздел', section=section)
+        self.thread = Thread.objects.create(title='Тема', author=self.user, subsection=subsection)
+        Post.objects.create(text='Первое', author=self.user, thread=self.thread)
+
+    def test_get_reads_from_replica_until_post(self):
+        """GET читает с реплики, а после POST браузер прилипает к основной базе"""
+        url = reverse('post_list', args=[self.thread.id])
+        with override_settings(DATABASE_REPLICAS=['replica']):
+            self.assertEqual(self.client.get(url).status_code, 404)
+            response = self.client.post(reverse('login'), {'username': 'reader', 'password': '12345'})
+            self.assertEqual(response.status_code, 302)
+            self.assertIn('db_primary', response.cookies)
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.context['user'], self.user)
+
+            self.client.cookies.pop('db_primary')
+            self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_benchmark_counts_replica_queries(self):
+        """forumbench считает и запросы, ушедшие на реплику"""
+        from django.test import Client
+
+        url = reverse('post_list', args=[self.thread.id])
+        with override_settings(DATABASE_REPLICAS=['replica']):
+            with CaptureQueriesContext(connection) as default_queries, \
+                    CaptureQueriesContext(connections['replica']) as replica_queries:
+                result = benchmark._measure(Client(), 'get', url, None, iterations=1, warmup=0)
+        # Анонимный GET целиком читает с реплики: до правки замер показывал 0.
+        self.assertEqual(result['status'], 404)
+        self.assertEqual(len(default_queries), 0)
+        self.assertGreater(result['queries'], 0)
+
+    def test_write_pins_rest_of_request(self):
+        """После записи остальные чтения запроса идут в основную базу"""
+        router = db_routing.ReplicaRouter()
+        token = db_routing._state.set(db_routing.RoutingState(use_replica=True))
+        try:
+            with override_settings(DATABASE_REPLICAS=['replica']):
+                self.assertEqual(router.db_for_read(Thread), 'replica')
+                self.assertEqual(router.db_for_write(Thread), 'default')
+                self.assertEqual(router.db_for_read(Thread), 'default')
+        finally:
+            db_routing._state.reset(token)
+
+    def test_without_replicas(self):
+        """Без реплик всё читается из основной базы и cookie не ставится"""
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(reverse('post_list', args=[self.thread.id])).status_code, 200)
+        response = self.client.post(reverse('new_post', args=[self.thread.id]), {'text': 'Ответ'})
+        self.assertNotIn('db_primary', response.cookies)
+
+
+class MessageArchiveTestCase(TestCase):
+    def setUp(self):
+        self.archive_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.archive_dir, ignore_errors=True)
+        self.user1 = User.objects.create_user(username='user1', password='12345')
+        self.user2 = User.objects.create_user(username='user2', password='12345')
+        self.conversation = Conversation.objects.create(last_message_at=timezone.now())
+        self.conversation.participants.add(self.user1, self.user2)
+        old = timezone.now() - timezone.timedelta(days=500)
+        for i in range(3):
+            message = Message.objects.create(
+                conversation=self.conversation, sender=self.user2, recipient=self.user1, body=f'Старое {i} :fire:',
+            )
+            Message.objects.filter(pk=message.pk).update(created_at=old)
+        Message.objects.create(conversation=self.conversation, sender=self.user1, recipient=self.user2, body='Новое')
+
+    def test_archive_and_serve(self):
+        """Старые месяцы уходят в файл и отдаются из него по запросу"""
+        from django.core.management import call_command
+
+        with override_settings(MESSAGE_ARCHIVE_DIR=self.archive_dir):
+            call_command('archive_messages', older_than=6, stdout=io.StringIO())
+            self.assertEqual(list(Message.objects.values_list('body', flat=True)), ['Новое'])
+            archive = MessageArchive.objects.get(conversation=self.conversation)
+            self.assertEqual(archive.messages_count, 3)
+            self.assertTrue(os.path.exists(os.path.join(self.archive_dir, archive.path)))
+
+            self.client.force_login(self.user1)
+            response = self.client.get(reverse('message_detail', args=[self.conversation.id]))
+            self.assertContains(response, reverse('message_archive', args=[self.conversation.id, archive.id]))
+            response = self.client.get(reverse('message_archive', args=[self.conversation.id, archive.id]))
+            data = response.json()['messages']
+            self.assertEqual([item['body'] for item in data], [f'Старое {i} :fire:' for i in range(3)])
+            self.assertEqual(data[0]['sender_name'], 'user2')
+
+            outsider = User.objects.create_user(username='user3', password='12345')
+            self.client.force_login(outsider)
+            response = self.client.get(reverse('message_archive', args=[self.conversation.id, archive.id]))
+            self.assertEqual(response.status_code, 404)
+
+    def test_purge_erases_archived_bodies(self):
+        """Очистка пользователя вырезает его диалоги из архивного файла, остальные читаются"""
+        from django.core.management import call_command
+
+        user3 = User.objects.create_user(username='user3', password='12345')
+        other = Conversation.objects.create(last_message_at=timezone.now())
+        other.participants.add(self.user2, user3)
+        message = Message.objects.create(conversation=other, sender=user3, recipient=self.user2, body='Чужое')
+        Message.objects.filter(pk=message.pk).update(created_at=timezone.now() - timezone.timedelta(days=500))
+        with override_settings(MESSAGE_ARCHIVE_DIR=self.archive_dir):
+            call_command('archive_messages', older_than=6, stdout=io.StringIO())
+            old_path = MessageArchive.objects.get(conversation=other).path
+            self.assertEqual(MessageArchive.objects.get(conversation=self.conversation).path, old_path)
+
+            Profile.objects.filter(user=self.user1).update(deleted_at=timezone.now())
+            with self.captureOnCommitCallbacks(execute=True):
+                purge.purge_user(self.user1.pk)
+
+            archive = MessageArchive.objects.get(conversation=other)
+            self.assertNotEqual(archive.path, old_path)
+            self.assertFalse(os.path.exists(os.path.join(self.archive_dir, old_path)))
+            self.assertEqual([row['body'] for row in message_archive.read_archive(archive)], ['Чужое'])
+            self.assertEqual(os.listdir(self.archive_dir), [archive.path])
+            with open(os.path.join(self.archive_dir, archive.path), 'rb') as fh:
+                self.assertNotIn('Старое', gzip.decompress(fh.read()).decode())
+
+    def test_conversations_share_month_file(self):
+        """Диалоги месяца лежат в одном файле отдельными gzip-членами"""
+        month = message_archive.month_start(timezone.localdate())
+        rows = [{'conversation_id': c, 'id': i, 'body': f'{c}-{i}'} for c in (1, 2) for i in range(2)]
+        with override_settings(MESSAGE_ARCHIVE_DIR=self.archive_dir):
+            path, chunks = message_archive.write_archive(month, iter(rows))
+            second = MessageArchive(path=path.name, offset=chunks[2][0], length=chunks[2][1])
+            self.assertEqual([row['body'] for row in message_archive.read_archive(second)], ['2-0', '2-1'])
+
+
+class ShardingTestCase(TestCase):
+    SHARDS = ['default', 'shard1']
+
+    @classmethod
+    def setUpClass(cls):
+        # Второй шард — SQLite в памяти только с таблицами личных сообщений.
+        connections.settings = connections.configure_settings({
+            **connections.settings,
+            'shard1': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'},
+        })
+        from django.core.management import call_command
+        with override_settings(MESSAGE_SHARDS=cls.SHARDS):
+            call_command('migrate', database='shard1', verbosity=0)
+        cls.databases = {'default', 'shard1'}
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        connections['shard1'].close()
+        del connections['shard1']
+        del connections.settings['shard1']
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='owner', password='12345')
+        self.others = [User.objects.create_user(username=f'other{i}', password='12345') for i in range(8)]
+
+    def test_shard_schema(self):
+        """На шарде есть таблица пользователей для ранних миграций, но таблицы диалогов на неё не ссылаются"""
+        connection = connections['shard1']
+        tables = connection.introspection.table_names()
+        self.assertIn('auth_user', tables)
+        self.assertNotIn('main_thread', tables)
+        with connection.cursor() as cursor:
+            # У таблицы участников с db_constraint=False внешних ключей нет вовсе.
+            expected = {'main_message': {'main_conversation'}, 'main_typingstatus': {'main_conversation'},
+                        'main_conversation_participants': set()}
+            for table, references in expected.items():
+                constraints = connection.introspection.get_constraints(cursor, table).values()
+                targets = {constraint['foreign_key'][0] for constraint in constraints if constraint['foreign_key']}
+                self.assertEqual(targets, references)
+
+    def test_shard_for_is_stable(self):
+        """Шард зависит только от id, а новый шард забирает диалоги только себе"""
+        two = [sharding.shard_for(i, self.SHARDS) for i in range(1, 201)]
+        self.assertEqual(two, [sharding.shard_for(i, self.SHARDS) for i in range(1, 201)])
+        self.assertEqual(set(two), set(self.SHARDS))
+        three = [sharding.shard_for(i, [*self.SHARDS, 'shard2']) for i in range(1, 201)]
+        self.assertTrue(all(new in (old, 'shard2') for old, new in zip(two, three)))
+
+    def test_conversations_across_shards(self):
+        """Диалоги создаются на своих шардах, а список собирает их со всех"""
+        self.client.force_login(self.user)
+        with override_settings(MESSAGE_SHARDS=self.SHARDS):
+            ids = []
+            for other in self.others:
+                response = self.client.post(reverse('start_conversation', args=[other.id]))
+                conversation_id = int(response.url.rstrip('/').split('/')[-1])
+                ids.append(conversation_id)
+                self.client.post(reverse('message_detail', args=[conversation_id]), {'body': f'Привет, {other}'})
+            for conversation_id in ids:
+                alias = sharding.shard_for(conversation_id)
+                self.assertTrue(Conversation.objects.using(alias).filter(id=conversation_id).exists())
+                self.assertEqual(Message.objects.using(alias).filter(conversation_id=conversation_id).count(), 1)
+            self.assertEqual({sharding.shard_for(i) for i in ids}, set(self.SHARDS))
+
+            response = self.client.post(reverse('start_conversation', args=[self.others[0].id]))
+            self.assertEqual(response.url, reverse('message_detail', args=[ids[0]]))
+            response = self.client.get(reverse('messages_list'))
+            items = response.context['conversation_items']
+            self.assertEqual([item['conversation'].id for item in items], ids[::-1])
+            self.assertEqual(items[0]['other_user'], self.others[-1])
+
+            self.client.force_login(self.others[3])
+            response = self.client.get(reverse('message_detail', args=[ids[3]]))
+            self.assertContains(response, 'Привет, other3')
+            self.assertEqual(sharding.unread_count(self.others[3]), 0)
+
+    def test_rebalance_moves_conversations(self):
+        """После добавления шарда команда переносит диалоги вместе с сообщениями"""
+        from django.core.management import call_command
+        ids = []
+        for other in self.others:
+            conversation = sharding.create_conversation(self.user, other)
+            conversation.messages.create(sender=self.user, recipient=other, body=f'Для {other}')
+            ids.append(conversation.id)
+        self.assertEqual(Conversation.objects.count(), len(ids))
+
+        out = io.StringIO()
+        with override_settings(MESSAGE_SHARDS=self.SHARDS):
+            call_command('rebalance_message_shards', stdout=out)
+            moved = [i for i in ids if sharding.shard_for(i) == 'shard1']
+            self.assertTrue(moved)
+            self.assertIn(f'default → shard1: перенесено диалогов {len(moved)}', out.getvalue())
+            self.assertEqual(set(Conversation.objects.using('shard1').values_list('id', flat=True)), set(moved))
+            self.assertFalse(Conversation.objects.filter(id__in=moved).exists())
+            for conversation_id in moved:
+                self.assertEqual(
+                    set(sharding.participant_ids([Conversation.objects.using('shard1').get(id=conversation_id)])
+                        [conversation_id]),
+                    {self.user.id, self.others[ids.index(conversation_id)].id},
+                )
+                self.assertEqual(Message.objects.using('shard1').get(conversation_id=conversation_id).body,
+                                 f'Для {self.others[ids.index(conversation_id)]}')
+
+            # Новые диалоги не занимают id, выданные до включения шардирования.
+            conversation = sharding.create_conversation(self.user, User.objects.create_user(username='late'))
+            self.assertGreater(conversation.id, max(ids))
+            out = io.StringIO()
+            call_command('rebalance_message_shards', stdout=out)
+            self.assertIn('Все диалоги на своих шардах', out.getvalue())
@@ -0,0 +1,231 @@
+"""Трассировка запросов: вложенные интервалы (spans).
+
+``TracingMiddleware`` (первый в MIDDLEWARE) с вероятностью
+``TRACING_SAMPLE_RATE`` начинает трассу запроса. Внутри неё пишутся
+интервалы:
+
+- корневой — весь запрос со всеми слоями middleware;
+- ``view`` — от ``ViewTracingMiddleware`` (последний в MIDDLEWARE) до
+  ответа представления; разница с корневым — время middleware, например
+  запись сессии;
+- ``db`` — каждый SQL-запрос (через ``connection.execute_wrapper``); в
+  ``db.statement`` пишется форма запроса без развёрнутых списков ``IN``;
+- ``template`` — рендеринг шаблона (через общий перехват в
+  template_hooks.py, на который подписаны и метрики);
+- любые участки кода, обёрнутые в ``with span(...)`` (например, эмодзи).
+
+Для запросов вне выборки ``span()`` ничего не делает. Готовая трасса
+дописывается одной строкой в ``TRACING_EXPORT_PATH`` в формате OTLP/JSON
+(``ExportTraceServiceRequest``, как у файлового экспортёра OpenTelemetry
+Collector) — такой файл открывают Jaeger и другие просмотрщики.
+"""
+import contextvars
+import json
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.db import connections
+
+from . import template_hooks
+from .query_budgets import WRAPPER_FILES, sql_shape
+
+logger = logging.getLogger(__name__)
+WRAPPER_FILES.add(__file__)
+
+SERVICE_NAME = 'forum'
+KIND_INTERNAL = 1
+KIND_SERVER = 2
+KIND_CLIENT = 3
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+_current_trace = contextvars.ContextVar('forum_trace', default=None)
+_current_span = contextvars.ContextVar('forum_span', default=None)
+_export_lock = threading.Lock()
+
+
+def sample_rate():
+    return getattr(settings, 'TRACING_SAMPLE_RATE', 0.0)
+
+
+def _random_id(size):
+    return os.urandom(size).hex()
+
+
+class Span:
+    def __init__(self, name, trace_id, parent_id, kind, attributes):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = _random_id(8)
+        self.parent_id = parent_id
+        self.kind = kind
+        self.attributes = dict(attributes)
+        self.status = STATUS_OK
+        self.start = time.time_ns()
+        self.end = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def to_otlp(self):
+        data = {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'name': self.name,
+            'kind': self.kind,
+            'startTimeUnixNano': str(self.start),
+            'endTimeUnixNano': str(self.end),
+            'attributes': [_otlp_attribute(key, value) for key, value in self.attributes.items()],
+            'status': {'code': self.status},
+        }
+        if self.parent_id:
+            data['parentSpanId'] = self.parent_id
+        return data
+
+
+def _otlp_attribute(key, value):
+    if isinstance(value, bool):
+        typed = {'boolValue': value}
+    elif isinstance(value, int):
+        typed = {'intValue': str(value)}
+    elif isinstance(value, float):
+        typed = {'doubleValue': value}
+    else:
+        typed = {'stringValue': str(value)}
+    return {'key': key, 'value': typed}
+
+
+class Trace:
+    """Завершённые интервалы одной трассы."""
+
+    def __init__(self):
+        self.trace_id = _random_id(16)
+        self.spans = []
+
+
+def is_recording():
+    return _current_trace.get() is not None
+
+
+@contextmanager
+def span(name, kind=KIND_INTERNAL, **attributes):
+    """Интервал внутри текущей трассы; вне выборки — None и никаких затрат."""
+    trace = _current_trace.get()
+    if trace is None:
+        yield None
+        return
+    parent = _current_span.get()
+    current = Span(name, trace.trace_id, parent.span_id if parent else None, kind, attributes)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as exc:
+        current.status = STATUS_ERROR
+        current.set_attribute('exception.type', type(exc).__name__)
+        raise
+    finally:
+        current.end = time.time_ns()
+        _current_span.reset(token)
+        trace.spans.append(current)
+
+
+def trace_query(execute, sql, params, many, context):
+    """execute_wrapper: SQL-запрос как интервал ``db``."""
+    with span('db', KIND_CLIENT, **{
+        'db.system': context['connection'].vendor,
+        'db.statement': sql_shape(sql),
+        'db.name': context['connection'].alias,
+    }):
+        return execute(sql, params, many, context)
+
+
+def _template_hook(template):
+    if _current_trace.get() is None:
+        return None
+    return span('template', template=template.template.name or '')
+
+
+def instrument_templates():
+    """Интервал ``template`` для верхнеуровневого рендеринга шаблонов."""
+    template_hooks.subscribe(_template_hook)
+
+
+def export(trace):
+    """Дописать трассу строкой OTLP/JSON в ``TRACING_EXPORT_PATH``."""
+    path = getattr(settings, 'TRACING_EXPORT_PATH', None)
+    if not path or not trace.spans:
+        return
+    payload = {
+        'resourceSpans': [{
+            'resource': {'attributes': [
+                _otlp_attribute('service.name', SERVICE_NAME),
+                _otlp_attribute('process.pid', os.getpid()),
+            ]},
+            'scopeSpans': [{
+                'scope': {'name': __name__},
+                'spans': [item.to_otlp() for item in trace.spans],
+            }],
+        }],
+    }
+    line = json.dumps(payload, ensure_ascii=False) + '\n'
+    try:
+        with _export_lock, open(path, 'a', encoding='utf-8') as output:
+            output.write(line)
+    except OSError:
+        logger.exception('Не удалось записать трассу в %s', path)
+
+
+class TracingMiddleware:
+    """Начинает трассу запроса (с вероятностью TRACING_SAMPLE_RATE)."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        instrument_templates()
+
+    def __call__(self, request):
+        if random.random() >= sample_rate():
+            return self.get_response(request)
+
+        trace = Trace()
+        trace_token = _current_trace.set(trace)
+        try:
+            with span(f'{request.method} {request.path}', KIND_SERVER, **{
+                'http.method': request.method,
+                'http.target': request.get_full_path(),
+            }) as root:
+                with ExitStack() as stack:
+                    for connection in connections.all():
+                        stack.enter_context(connection.execute_wrapper(trace_query))
+                    response = self.get_response(request)
+                match = getattr(request, 'resolver_match', None)
+                if match:
+                    root.name = f'{request.method} {match.view_name}'
+                    root.set_attribute('http.route', match.route)
+                root.set_attribute('http.status_code', response.status_code)
+        finally:
+            _current_trace.reset(trace_token)
+        export(trace)
+        return response
+
+
+class ViewTracingMiddleware:
+    """Интервал ``view``: всё, что глубже последнего middleware."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not is_recording():
+            return self.get_response(request)
+        with span('view') as current:
+            response = self.get_response(request)
+            match = getattr(request, 'resolver_match', None)
+            if match:
+                current.name = f'view {match.view_name}'
+                current.set_attribute('code.function', match._func_path)
+            return response
@@ -0,0 +1,150 @@
+"""Потоковая проверка загружаемых изображений.
+
+``ImageUploadHandler`` проверяет файл ещё во время приёма запроса:
+по первым байтам определяется формат (сигнатура, а не расширение), по
+заголовку — заявленные размеры в пикселях. Превышение лимита по байтам или
+пикселям обрывает приём файла сразу, не дожидаясь конца загрузки, поэтому
+«бомба» вида PNG 30000×30000 никогда не доходит до декодирования в PIL.
+
+Файлы пишутся во временный файл на диске, а не в память. Лимиты задаются
+по полю формы (``UPLOAD_IMAGE_FIELDS``) и по формату
+(``UPLOAD_IMAGE_FORMATS``); действует меньший из двух. Причина отказа
+сохраняется в ``request.upload_errors`` — см. ``upload_error()``.
+"""
+import io
+import struct
+
+from django.conf import settings
+from django.core.files.uploadhandler import SkipFile, TemporaryFileUploadHandler
+from django.template.defaultfilters import filesizeformat
+from PIL import Image
+
+# Сколько начальных байт файла держать для разбора заголовка. У JPEG перед
+# размерами может идти EXIF, поэтому запас нужен заметный.
+HEADER_LIMIT = 256 * 1024
+
+SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'\xff\xd8\xff', 'jpeg'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+)
+SIGNATURE_LENGTH = max(len(magic) for magic, _ in SIGNATURES)
+
+
+def detect_format(header):
+    for magic, image_format in SIGNATURES:
+        if header.startswith(magic):
+            return image_format
+    return None
+
+
+def header_dimensions(image_format, header):
+    """Заявленные в заголовке (ширина, высота) или None, если данных мало.
+
+    У PNG и GIF размеры лежат по фиксированному смещению; у JPEG маркер SOF
+    ищет PIL — ``Image.open`` разбирает только заголовок и не декодирует пиксели.
+    """
+    if image_format == 'png':
+        # Сигнатура (8), длина и тип чанка IHDR (8), затем ширина и высота.
+        if len(header) < 24 or header[12:16] != b'IHDR':
+            return None
+        return struct.unpack('>II', header[16:24])
+    if image_format == 'gif':
+        if len(header) < 10:
+            return None
+        return struct.unpack('<HH', header[6:10])
+    try:
+        with Image.open(io.BytesIO(header), formats=[image_format.upper()]) as img:
+            return img.size
+    except (OSError, SyntaxError, ValueError):
+        return None
+
+
+def field_limits(field_name):
+    return getattr(settings, 'UPLOAD_IMAGE_FIELDS', {}).get(field_name)
+
+
+def effective_limits(field_name, image_format):
+    """Лимиты для файла: меньшее из ограничений поля и формата."""
+    limits = dict(field_limits(field_name) or {})
+    for key, value in getattr(settings, 'UPLOAD_IMAGE_FORMATS', {}).get(image_format, {}).items():
+        limits[key] = min(value, limits.get(key, value))
+    return limits
+
+
+def upload_error(request, field_name):
+    """Причина, по которой файл из поля ``field_name`` был отклонён, или None."""
+    return getattr(request, 'upload_errors', {}).get(field_name)
+
+
+class ImageUploadHandler(TemporaryFileUploadHandler):
+    """Обработчик загрузки, проверяющий изображения на лету.
+
+    Поля, не перечисленные в ``UPLOAD_IMAGE_FIELDS``, принимаются как есть
+    (во временный файл).
+    """
+
+    def new_file(self, field_name, *args, **kwargs):
+        super().new_file(field_name, *args, **kwargs)
+        self.limits = field_limits(field_name)
+        self.header = bytearray()
+        self.image_format = None
+        self.dimensions = None
+
+    def receive_data_chunk(self, raw_data, start):
+        if self.limits is not None:
+            self._check(raw_data, start)
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        if self.limits is not None and self.dimensions is None:
+            # Файл кончился раньше, чем удалось прочитать заголовок.
+            self.file.close()
+            self._record_error('Файл не является изображением допустимого формата.')
+            return None
+        return super().file_complete(file_size)
+
+    def _check(self, raw_data, start):
+        if self.dimensions is None:
+            self.header += raw_data[:max(0, HEADER_LIMIT - len(self.header))]
+            if self.image_format is None and len(self.header) >= SIGNATURE_LENGTH:
+                self.image_format = detect_format(bytes(self.header))
+                if self.image_format is None:
+                    self._reject('Файл не является изображением допустимого формата.')
+                self.limits = effective_limits(self.field_name, self.image_format)
+
+        max_bytes = self.limits.get('max_bytes')
+        if max_bytes and start + len(raw_data) > max_bytes:
+            self._reject(f'Размер файла не должен превышать {filesizeformat(max_bytes)}.')
+
+        if self.dimensions is None and self.image_format is not None:
+            self._read_dimensions()
+            if self.dimensions is None and len(self.header) >= HEADER_LIMIT:
+                self._reject('Не удалось прочитать заголовок изображения.')
+
+    def _read_dimensions(self):
+        try:
+            dimensions = header_dimensions(self.image_format, bytes(self.header))
+        except Image.DecompressionBombError:
+            self._reject('Слишком большое изображение.')
+        if dimensions is None:
+            return  # Заголовок ещё не дочитан.
+
+        width, height = dimensions
+        max_pixels = self.limits.get('max_pixels')
+        if width <= 0 or height <= 0 or (max_pixels and width * height > max_pixels):
+            self._reject(f'Слишком большое изображение: {width}×{height} пикселей.')
+        self.dimensions = dimensions
+        self.header = bytearray()
+
+    def _record_error(self, message):
+        if self.request is not None:
+            if not hasattr(self.request, 'upload_errors'):
+                self.request.upload_errors = {}
+            self.request.upload_errors[self.field_name] = message
+
+    def _reject(self, message):
+        self._record_error(message)
+        # Парсер закроет (и удалит) временный файл и пропустит остаток поля.
+        raise SkipFile(message)
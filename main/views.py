@@ -1,19 +1,33 @@
 from django.shortcuts import render, get_object_or_404, redirect
-from django.http import JsonResponse
+from django.template.loader import render_to_string
+from django.urls import reverse
+from django.http import Http404, JsonResponse
 from django.contrib.auth.decorators import login_required
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib import messages
 from django.db import IntegrityError, transaction
-from django.db.models import Count, OuterRef, Subquery, Q
+from django.db.models import Count, F, FilteredRelation, OuterRef, Subquery, Q, Window
+from django.db.models.functions import RowNumber
 from django.utils import timezone
+from django.utils.functional import SimpleLazyObject
 from django.core.paginator import Paginator
 from django.contrib.auth.models import User
 from django.views.decorators.http import require_http_methods
 from django_ratelimit.decorators import ratelimit
+from datetime import datetime, timedelta, timezone as dt_timezone
 import logging
 
 from .models import Section, Subsection, Thread, Post, Profile, Conversation, Message, TypingStatus, WallPost, WallComment
 from .emoji import render_emoji_html
+from .message_archive import read_archive
+from .caching import get_home_version, home_cache_timeout
+from .stats import get_forum_stats
+from .search import SearchResults
+from . import read_markers, sharding
+from .images import schedule_post_variants
+from .uploads import upload_error
+from .query_budgets import query_budget
+from .purge import soft_delete_thread, soft_delete_wall_post
 from .forms import ThreadForm, AvatarForm, UserRegisterForm, WallPostForm, WallCommentForm
 
 logger = logging.getLogger(__name__)
@@ -254,6 +268,9 @@ def update_avatar(request):
     
     if request.method == 'POST':
         form = AvatarForm(request.POST, request.FILES, instance=profile)
+        rejected = upload_error(request, 'avatar')
+        if rejected:
+            form.add_error('avatar', rejected)
         if form.is_valid():
             try:
                 form.save()
@@ -272,30 +289,129 @@ def update_avatar(request):
 # ==============================================================================
 # ПРОФИЛЬ ПОЛЬЗОВАТЕЛЯ
 
+WALL_POSTS_PER_PAGE = 20
+WALL_INLINE_COMMENTS = 3
+WALL_COMMENTS_PER_PAGE = 20
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+def encode_cursor(obj):
+    """Курсор keyset-пагинации: created_at в микросекундах и id."""
+    delta = obj.created_at - _EPOCH
+    micros = (delta.days * 86400 + delta.seconds) * 1_000_000 + delta.microseconds
+    return f'{micros}-{obj.id}'
+
+
+def decode_cursor(value):
+    """(created_at, id) из курсора или None, если курсор некорректен."""
+    try:
+        micros, object_id = (int(part) for part in value.split('-', 1))
+        return _EPOCH + timedelta(microseconds=micros), object_id
+    except (AttributeError, ValueError, OverflowError):
+        return None
+
+
+def _before(queryset, cursor):
+    """Строки строго старше курсора в порядке (-created_at, -id)."""
+    created_at, object_id = cursor
+    return queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=object_id))
+
+
+def _attach_latest_comments(wall_posts):
+    """
+    Последние WALL_INLINE_COMMENTS комментариев к каждой записи — одним
+    запросом с оконной функцией ROW_NUMBER() OVER (PARTITION BY post_id).
+    Заодно считается общее число комментариев записи.
+    """
+    by_id = {item.id: item for item in wall_posts}
+    for item in wall_posts:
+        item.latest_comments = []
+        item.comments_total = 0
+    if not by_id:
+        return
+    comments = without_deleted_authors(WallComment.objects.filter(post_id__in=by_id))
+    comments = comments.select_related('author').annotate(
+        position=Window(
+            RowNumber(),
+            partition_by=[F('post_id')],
+            order_by=[F('created_at').desc(), F('id').desc()],
+        ),
+        total=Window(Count('id'), partition_by=[F('post_id')]),
+    ).filter(position__lte=WALL_INLINE_COMMENTS).order_by('post_id', 'created_at', 'id')
+    for comment in comments:
+        item = by_id[comment.post_id]
+        item.latest_comments.append(comment)
+        item.comments_total = comment.total
+    for item in wall_posts:
+        item.hidden_comments = item.comments_total - len(item.latest_comments)
+        item.comments_cursor = encode_cursor(item.latest_comments[0]) if item.hidden_comments else ''
+
+
+@query_budget(8)
 def user_profile(request, user_id):
     """
     Отображает публичный профиль пользователя:
     - имя, дата регистрации
-    - количество сообщений и созданных тем
+    - количество сообщений и созданных тем (Profile.posts_count / threads_count)
+    - стену: WALL_POSTS_PER_PAGE записей (keyset по индексу (owner, -created_at),
+      курсор ?wall_before=) и последние комментарии к каждой
     """
-    user = get_object_or_404(User, id=user_id)
-    post_count = user.posts.count()
-    thread_count = user.threads.count()
-    wall_posts = WallPost.objects.filter(owner=user)
-    wall_posts = wall_posts.select_related('author', 'owner').prefetch_related('comments__author')
-    recent_posts = Post.objects.filter(author=user)
+    user = get_object_or_404(
+        User.objects.select_related('profile'), id=user_id, profile__deleted_at__isnull=True
+    )
+    # Счётчики активности хранятся в профиле — без COUNT(*) по сообщениям и темам.
+    post_count = user.profile.posts_count
+    thread_count = user.profile.threads_count
+    wall_posts = WallPost.objects.filter(owner=user).select_related('author').order_by('-created_at', '-id')
+    cursor = decode_cursor(request.GET.get('wall_before', ''))
+    if cursor:
+        wall_posts = _before(wall_posts, cursor)
+    wall_posts = list(wall_posts[:WALL_POSTS_PER_PAGE + 1])
+    wall_next_cursor = encode_cursor(wall_posts[WALL_POSTS_PER_PAGE - 1]) if len(wall_posts) > WALL_POSTS_PER_PAGE else ''
+    wall_posts = wall_posts[:WALL_POSTS_PER_PAGE]
+    _attach_latest_comments(wall_posts)
+    recent_posts = Post.objects.filter(author=user, thread__deleted_at__isnull=True)
     recent_posts = recent_posts.select_related('thread', 'thread__subsection__section').order_by('-created_at')[:5]
     return render(request, 'main/user_profile.html', {
         'profile_user': user,
         'post_count': post_count,
         'thread_count': thread_count,
         'wall_posts': wall_posts,
+        'wall_next_cursor': wall_next_cursor,
+        'wall_is_first_page': cursor is None,
         'recent_posts': recent_posts,
         'wall_form': WallPostForm() if request.user.is_authenticated else None,
         'wall_comment_form': WallCommentForm() if request.user.is_authenticated else None,
     })
 
 
+@require_http_methods(['GET'])
+def wall_comments(request, user_id, post_id):
+    """
+    «Показать ещё»: комментарии записи старше курсора ?before=
+    (по WALL_COMMENTS_PER_PAGE). Возвращает HTML-фрагмент и следующий курсор.
+    """
+    post = get_object_or_404(WallPost, id=post_id, owner_id=user_id)
+    comments = without_deleted_authors(WallComment.objects.filter(post=post)).select_related('author')\
+        .order_by('-created_at', '-id')
+    cursor = decode_cursor(request.GET.get('before', ''))
+    if cursor:
+        comments = _before(comments, cursor)
+    comments = list(comments[:WALL_COMMENTS_PER_PAGE + 1])
+    has_more = len(comments) > WALL_COMMENTS_PER_PAGE
+    comments = comments[:WALL_COMMENTS_PER_PAGE][::-1]
+    html = render_to_string('main/wall_comments.html', {
+        'comments': comments,
+        'item': post,
+        'profile_user_id': user_id,
+    }, request=request)
+    return JsonResponse({
+        'html': html,
+        'next': encode_cursor(comments[0]) if has_more else None,
+    })
+
+
 @login_required
 @require_http_methods(['POST'])
 def wall_post_create(request, user_id):
@@ -356,7 +472,7 @@ def wall_post_delete(request, user_id, post_id):
     if request.user != post.author and not request.user.is_staff:
         messages.error(request, 'Вы не можете удалить эту запись.')
         return redirect('user_profile', user_id=owner.id)
-    post.delete()
+    soft_delete_wall_post(post)
     messages.success(request, 'Запись удалена.')
     return redirect('user_profile', user_id=owner.id)
 
@@ -405,6 +521,7 @@ def wall_comment_delete(request, user_id, post_id, comment_id):
 # ==============================================================================
 # ГЛАВНАЯ СТРАНИЦА — список разделов и статистика
 
+@query_budget(10)
 def section_list(request):
     """
     Главная страница форума.
@@ -413,6 +530,8 @@ def section_list(request):
       - закреплённые темы (из любого подраздела)
       - последние активные темы
       - общую статистику (пользователи, темы, посты)
+    Блоки страницы кэшируются как фрагменты шаблона (см. main/caching.py),
+    поэтому запросы выполняются лениво — только при промахе кэша.
     """
     sections = Section.objects.prefetch_related('subsections').all()
     
@@ -426,23 +545,22 @@ def section_list(request):
         'author', 'subsection__section'
     ).filter(is_pinned=False).order_by('-created_at')[:10]
 
-    # Общая статистика
-    stats = {
-        'users': User.objects.count(),
-        'threads': Thread.objects.count(),
-        'posts': Post.objects.count(),
-    }
+    # Общая статистика (читается только если фрагмент не найден в кэше)
+    stats = SimpleLazyObject(get_forum_stats)
     return render(request, 'main/section_list.html', {
         'sections': sections,
         'pinned_threads': pinned_threads,
         'latest_threads': latest_threads,
         'stats': stats,
+        'home_version': get_home_version(),
+        'home_cache_timeout': home_cache_timeout(),
     })
 
 
 # ==============================================================================
 # ТЕМЫ В ПОДРАЗДЕЛЕ
 
+@query_budget(10)
 def thread_list(request, subsection_id):
     """
     Список тем в конкретном подразделе.
@@ -453,13 +571,18 @@ def thread_list(request, subsection_id):
     subsection = get_object_or_404(Subsection, id=subsection_id)
     order = request.GET.get('order', 'latest')
 
+    # Автор и число ответов — в том же запросе, а не по запросу на тему.
+    threads = subsection.threads.select_related('author').annotate(posts_total=Count('posts'))
     if order == 'active':
-        threads = subsection.threads.order_by('-last_reply_at')
+        threads = threads.order_by('-last_reply_at')
         order_label = "По последнему ответу"
     else:
-        threads = subsection.threads.order_by('-created_at')
+        threads = threads.order_by('-created_at')
         order_label = "Последние темы"
 
+    if request.user.is_authenticated:
+        threads = _with_read_state(threads, request.user)
+
     return render(request, 'main/thread_list.html', {
         'subsection': subsection,
         'threads': threads,
@@ -468,22 +591,50 @@ def thread_list(request, subsection_id):
     })
 
 
+def _with_read_state(threads, user):
+    """
+    Добавляет темам признак is_unread одним LEFT JOIN на отметки о прочтении.
+    Отметки, ещё лежащие в буфере (main/read_markers.py), учитываются поверх.
+    """
+    threads = list(threads.annotate(
+        read_marker=FilteredRelation('read_markers', condition=Q(read_markers__user=user)),
+        last_read_post_id=F('read_marker__last_read_post_id'),
+    ))
+    pending = read_markers.pending_markers(user.id)
+    for thread in threads:
+        last_read = max(thread.last_read_post_id or 0, pending.get(thread.id, 0))
+        thread.is_unread = bool(thread.last_post_id) and thread.last_post_id > last_read
+    return threads
+
+
 # ==============================================================================
 # СООБЩЕНИЯ В ТЕМЕ (с пагинацией)
 
+POSTS_PER_PAGE = 10
+
+
+def without_deleted_authors(queryset):
+    """Без сообщений и комментариев удалённых пользователей: они скрыты сразу, а удаляются в фоне."""
+    return queryset.filter(author__profile__deleted_at__isnull=True)
+
+
+@query_budget(10)
 def post_list(request, thread_id):
     """
     Отображает все сообщения в теме с пагинацией (10 постов на страницу).
     Использует select_related для оптимизации запросов к автору и его профилю.
     """
     thread = get_object_or_404(Thread, id=thread_id)
-    posts_list = thread.posts.select_related(
+    posts_list = without_deleted_authors(thread.posts).select_related(
         'author', 'author__profile'  # ← важно для отображения аватарок!
-    ).all()
+    ).prefetch_related('image_variants').order_by('created_at', 'id')  # id — для однозначного порядка (см. post_page_url)
     
-    paginator = Paginator(posts_list, 10)
+    paginator = Paginator(posts_list, POSTS_PER_PAGE)
     page_number = request.GET.get('page')
     posts = paginator.get_page(page_number)
+
+    if request.user.is_authenticated and posts:
+        read_markers.mark_read(request.user.id, thread.id, max(post.id for post in posts))
     
     return render(request, 'main/post_list.html', {
         'thread': thread,
@@ -491,6 +642,66 @@ def post_list(request, thread_id):
     })
 
 
+def post_page_url(post):
+    """
+    Адрес страницы темы, на которой находится сообщение, с якорем на него.
+    Номер страницы считается диапазонным COUNT по индексу
+    (thread, created_at) одной таблицы сообщений: пересчитывать ничего не
+    нужно ни при добавлении, ни при удалении сообщений. Сообщения
+    удалённых пользователей вычитаются вторым COUNT — только пока такие
+    пользователи ждут фоновой очистки.
+    """
+    before = Post.objects.filter(thread_id=post.thread_id).filter(
+        Q(created_at__lt=post.created_at) | Q(created_at=post.created_at, id__lt=post.id)
+    )
+    position = before.count()
+    deleted_authors = Profile.objects.filter(deleted_at__isnull=False).values('user_id')
+    if deleted_authors.exists():
+        position -= before.filter(author_id__in=deleted_authors).count()
+    page = position // POSTS_PER_PAGE + 1
+    url = reverse('post_list', args=[post.thread_id])
+    if page > 1:
+        url = f'{url}?page={page}'
+    return f'{url}#post-{post.id}'
+
+
+def first_unread(request, thread_id):
+    """
+    Переход к первому непрочитанному сообщению темы.
+    Ищется по ключу (created_at, id) после последнего прочитанного —
+    тем же индексом (thread, created_at), что и страницы темы.
+    """
+    thread = get_object_or_404(Thread, id=thread_id)
+    if not request.user.is_authenticated:
+        return redirect('post_list', thread_id=thread.id)
+
+    posts = without_deleted_authors(Post.objects.filter(thread=thread)).only('id', 'thread_id', 'created_at')\
+        .order_by('created_at', 'id')
+    last_read_id = read_markers.get_last_read(request.user.id, thread.id)
+    if last_read_id is None:
+        return redirect('post_list', thread_id=thread.id)
+
+    last_read = posts.filter(id=last_read_id).first()
+    if last_read:
+        target = posts.filter(
+            Q(created_at__gt=last_read.created_at) | Q(created_at=last_read.created_at, id__gt=last_read.id)
+        ).first()
+    else:
+        # Прочитанное сообщение удалено — ориентируемся на id.
+        target = posts.filter(id__gt=last_read_id).first()
+    if target is None:
+        target = posts.last()
+    if target is None:
+        return redirect('post_list', thread_id=thread.id)
+    return redirect(post_page_url(target))
+
+
+def post_permalink(request, post_id):
+    """Постоянная ссылка на сообщение: редирект на нужную страницу темы."""
+    post = get_object_or_404(Post.objects.only('id', 'thread_id', 'created_at'), id=post_id)
+    return redirect(post_page_url(post))
+
+
 # ==============================================================================
 # УПРАВЛЕНИЕ ТЕМОЙ (закрепление/открепление)
 
@@ -528,11 +739,13 @@ def new_thread(request, subsection_id):
                 subsection=subsection,
                 last_reply_at=timezone.now()
             )
-            Post.objects.create(
+            post = Post.objects.create(
                 text=form.cleaned_data['text'],
                 author=request.user,
                 thread=thread
             )
+            thread.last_post_id = post.id
+            thread.save(update_fields=['last_post_id'])
             return redirect('post_list', thread_id=thread.id)
     else:
         form = ThreadForm()
@@ -556,15 +769,21 @@ def new_post(request, thread_id):
     if request.method == 'POST':
         text = request.POST.get('text', '').strip()
         image = request.FILES.get('image')
-        if text or image:
-            Post.objects.create(
+        rejected = upload_error(request, 'image')
+        if rejected:
+            messages.error(request, rejected)
+        elif text or image:
+            post = Post.objects.create(
                 text=text,
                 image=image,
                 author=request.user,
                 thread=thread
             )
             thread.last_reply_at = timezone.now()
-            thread.save(update_fields=['last_reply_at'])
+            thread.last_post_id = post.id
+            thread.save(update_fields=['last_reply_at', 'last_post_id'])
+            if post.image:
+                schedule_post_variants(post.id)
             messages.success(request, "Сообщение добавлено.")
         else:
             messages.error(request, "Сообщение не может быть пустым.")
@@ -602,7 +821,8 @@ def delete_thread(request, thread_id):
     thread = get_object_or_404(Thread, id=thread_id)
     subsection_id = thread.subsection_id
     title = thread.title
-    thread.delete()
+    # Тема скрывается сразу, сообщения удаляются в фоне (main/purge.py).
+    soft_delete_thread(thread)
     messages.success(request, f'Тема «{title}» удалена.')
     return redirect('thread_list', subsection_id=subsection_id)
 
@@ -613,6 +833,11 @@ def delete_post(request, post_id):
     post = get_object_or_404(Post, id=post_id)
     thread_id = post.thread_id
     post.delete()
+    Thread.objects.filter(id=thread_id, last_post_id=post_id).update(
+        last_post_id=Subquery(
+            Post.objects.filter(thread_id=thread_id).order_by('-created_at', '-id').values('id')[:1]
+        )
+    )
     messages.success(request, 'Сообщение удалено.')
     return redirect('post_list', thread_id=thread_id)
 
@@ -629,6 +854,26 @@ def choose_subsection(request):
     return render(request, 'main/choose_subsection.html', {'sections': sections})
 
 
+# ==============================================================================
+# ПОИСК
+
+SEARCH_RESULTS_PER_PAGE = 20
+
+
+def search(request):
+    """
+    Полнотекстовый поиск по темам и сообщениям (см. main/search.py).
+    Результаты ранжируются по релевантности и разбиваются на страницы.
+    """
+    query = request.GET.get('q', '').strip()[:200]
+    paginator = Paginator(SearchResults(query), SEARCH_RESULTS_PER_PAGE)
+    results = paginator.get_page(request.GET.get('page'))
+    return render(request, 'main/search.html', {
+        'query': query,
+        'results': results,
+    })
+
+
 # ==============================================================================
 # ЛИЧНЫЕ СООБЩЕНИЯ
 
@@ -644,8 +889,8 @@ def messages_list(request):
 @login_required
 @require_http_methods(["GET", "POST"])
 def message_detail(request, conversation_id):
-    conversation = get_object_or_404(Conversation, id=conversation_id, participants=request.user)
-    other_user = conversation.participants.exclude(id=request.user.id).first()
+    conversation = sharding.get_conversation_or_404(conversation_id, request.user)
+    other_user = sharding.other_participant(conversation, request.user)
     if not other_user:
         messages.error(request, 'Диалог недоступен.')
         return redirect('messages_list')
@@ -655,8 +900,7 @@ def message_detail(request, conversation_id):
         if not body:
             messages.error(request, 'Сообщение не может быть пустым.')
         else:
-            Message.objects.create(
-                conversation=conversation,
+            conversation.messages.create(
                 sender=request.user,
                 recipient=other_user,
                 body=body
@@ -665,19 +909,19 @@ def message_detail(request, conversation_id):
             conversation.save(update_fields=['last_message_at', 'updated_at'])
             return redirect('message_detail', conversation_id=conversation.id)
 
-    Message.objects.filter(
-        conversation=conversation,
+    conversation.messages.filter(
         recipient=request.user,
         is_read=False
     ).update(is_read=True, read_at=timezone.now())
 
-    message_list = conversation.messages.select_related('sender').all()
+    # Отправители — в основной базе, а диалог может быть на шарде: без JOIN.
+    message_list = conversation.messages.prefetch_related('sender').all()
+    archives = conversation.archives.all()
 
     conversation_items = _get_conversation_items(request.user)
 
     typing_cutoff = timezone.now() - timezone.timedelta(seconds=7)
-    typing_active = TypingStatus.objects.filter(
-        conversation=conversation,
+    typing_active = conversation.typing_statuses.filter(
         user=other_user,
         updated_at__gte=typing_cutoff
     ).exists()
@@ -686,6 +930,7 @@ def message_detail(request, conversation_id):
         'conversation': conversation,
         'other_user': other_user,
         'message_list': message_list,
+        'archives': archives,
         'conversation_items': conversation_items,
         'typing_active': typing_active,
     })
@@ -699,53 +944,68 @@ def start_conversation(request, user_id):
 
     other_user = get_object_or_404(User, id=user_id)
 
-    existing = Conversation.objects.filter(participants=request.user).filter(
-        participants=other_user
-    ).annotate(participant_count=Count('participants')).filter(participant_count=2).first()
+    existing = sharding.find_conversation_between(request.user, other_user)
 
     if existing:
         return redirect('message_detail', conversation_id=existing.id)
 
-    conversation = Conversation.objects.create()
-    conversation.participants.add(request.user, other_user)
+    conversation = sharding.create_conversation(request.user, other_user)
     return redirect('message_detail', conversation_id=conversation.id)
 
 
 def _get_conversation_items(user):
-    last_message_subquery = Message.objects.filter(
-        conversation=OuterRef('pk')
-    ).order_by('-created_at')
-
-    conversations = Conversation.objects.filter(participants=user).annotate(
-        unread_count=Count(
-            'messages',
-            filter=Q(messages__recipient=user, messages__is_read=False),
-            distinct=True
-        ),
-        last_message_id=Subquery(last_message_subquery.values('id')[:1])
-    ).prefetch_related('participants', 'participants__profile').order_by('-last_message_at', '-updated_at')
-
-    last_message_ids = [c.last_message_id for c in conversations if c.last_message_id]
-    last_messages = Message.objects.filter(id__in=last_message_ids).select_related('sender', 'recipient')
-    last_message_map = {m.id: m for m in last_messages}
-
+    """Диалоги пользователя со всех шардов, свежие сверху."""
     typing_cutoff = timezone.now() - timezone.timedelta(seconds=7)
-    typing_statuses = TypingStatus.objects.filter(
-        conversation__in=conversations,
-        updated_at__gte=typing_cutoff
+    conversations = []
+    last_message_map = {}
+    typing_map = {}
+    for alias in sharding.shards():
+        last_message_subquery = Message.objects.filter(
+            conversation=OuterRef('pk')
+        ).order_by('-created_at')
+
+        shard_conversations = list(Conversation.objects.using(alias).filter(participants=user).annotate(
+            unread_count=Count(
+                'messages',
+                filter=Q(messages__recipient=user, messages__is_read=False),
+                distinct=True
+            ),
+            last_message_id=Subquery(last_message_subquery.values('id')[:1])
+        ))
+        if not shard_conversations:
+            continue
+        conversations.extend(shard_conversations)
+
+        last_message_ids = [c.last_message_id for c in shard_conversations if c.last_message_id]
+        for message in Message.objects.using(alias).filter(id__in=last_message_ids):
+            last_message_map[message.conversation_id] = message
+
+        typing_statuses = TypingStatus.objects.using(alias).filter(
+            conversation_id__in=[c.id for c in shard_conversations],
+            updated_at__gte=typing_cutoff
+        )
+        typing_map.update({(ts.conversation_id, ts.user_id): True for ts in typing_statuses})
+
+    conversations.sort(
+        key=lambda c: (c.last_message_at is not None, c.last_message_at or c.updated_at, c.updated_at),
+        reverse=True,
     )
-    typing_map = {(ts.conversation_id, ts.user_id): True for ts in typing_statuses}
+    # Участники — из основной базы одним запросом на все шарды.
+    sharding.attach_participants(conversations)
 
     conversation_items = []
     for conversation in conversations:
-        other_user = conversation.participants.exclude(id=user.id).first()
+        other_user = next((p for p in conversation.participant_list if p.id != user.id), None)
+        if other_user is not None and other_user.profile.deleted_at:
+            # Собеседник удалён: диалог скрыт сразу, а удаляется в фоне (main/purge.py).
+            continue
         is_typing = False
         if other_user:
             is_typing = typing_map.get((conversation.id, other_user.id), False)
         conversation_items.append({
             'conversation': conversation,
             'other_user': other_user,
-            'last_message': last_message_map.get(conversation.last_message_id),
+            'last_message': last_message_map.get(conversation.id),
             'unread_count': conversation.unread_count,
             'is_typing': is_typing,
         })
@@ -753,6 +1013,8 @@ def _get_conversation_items(user):
     return conversation_items
 
 
+# На каждый шард: диалоги, последние сообщения, «печатает…», участники.
+@query_budget(8, per_shard=4)
 @login_required
 def messages_poll(request):
     conversation_items = _get_conversation_items(request.user)
@@ -765,7 +1027,7 @@ def messages_poll(request):
             'other_user': {
                 'id': other_user.id if other_user else None,
                 'username': other_user.username if other_user else '',
-                'avatar_url': other_user.profile.avatar_url if other_user else '',
+                'avatar_url': other_user.profile.avatar_medium_url if other_user else '',
             },
             'last_message': {
                 'body': last_message.body if last_message else '',
@@ -782,11 +1044,13 @@ def messages_poll(request):
 @login_required
 @require_http_methods(["GET"])
 def message_poll(request, conversation_id):
-    conversation = get_object_or_404(Conversation, id=conversation_id, participants=request.user)
-    other_user = conversation.participants.exclude(id=request.user.id).first()
+    conversation = sharding.get_conversation_or_404(conversation_id, request.user)
+    other_user = sharding.other_participant(conversation, request.user)
+    if not other_user:
+        raise Http404('Диалог недоступен')
 
     after = request.GET.get('after')
-    message_qs = conversation.messages.select_related('sender').order_by('created_at')
+    message_qs = conversation.messages.prefetch_related('sender').order_by('created_at')
     if after and after.isdigit():
         message_qs = message_qs.filter(id__gt=int(after))
 
@@ -802,13 +1066,10 @@ def message_poll(request, conversation_id):
         })
 
     typing_cutoff = timezone.now() - timezone.timedelta(seconds=7)
-    typing_active = False
-    if other_user:
-        typing_active = TypingStatus.objects.filter(
-            conversation=conversation,
-            user=other_user,
-            updated_at__gte=typing_cutoff
-        ).exists()
+    typing_active = conversation.typing_statuses.filter(
+        user=other_user,
+        updated_at__gte=typing_cutoff
+    ).exists()
 
     return JsonResponse({
         'messages': messages_payload,
@@ -816,12 +1077,39 @@ def message_poll(request, conversation_id):
     })
 
 
+@login_required
+@require_http_methods(["GET"])
+def message_archive(request, conversation_id, archive_id):
+    """Архивная история диалога за месяц — читается из файла по запросу."""
+    conversation = sharding.get_conversation_or_404(conversation_id, request.user)
+    archive = get_object_or_404(conversation.archives, id=archive_id)
+    try:
+        rows = read_archive(archive)
+    except OSError:
+        logger.exception('Archive file is unavailable: %s', archive.path)
+        raise Http404('Архив недоступен')
+
+    usernames = dict(User.objects.filter(id__in={row['sender_id'] for row in rows}).values_list('id', 'username'))
+    return JsonResponse({
+        'messages': [
+            {
+                'id': row['id'],
+                'sender_id': row['sender_id'],
+                'sender_name': usernames.get(row['sender_id'], ''),
+                'created_at': row['created_at'],
+                'body': row['body'],
+                'body_html': render_emoji_html(row['body']),
+            }
+            for row in rows
+        ],
+    })
+
+
 @login_required
 @require_http_methods(["POST"])
 def typing_ping(request, conversation_id):
-    conversation = get_object_or_404(Conversation, id=conversation_id, participants=request.user)
-    TypingStatus.objects.update_or_create(
-        conversation=conversation,
+    conversation = sharding.get_conversation_or_404(conversation_id, request.user)
+    conversation.typing_statuses.update_or_create(
         user=request.user,
         defaults={'updated_at': timezone.now()}
     )